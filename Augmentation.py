@@ -1,21 +1,24 @@
 import argparse
+import random
 from os.path import exists, splitext
 from PIL import Image, ImageFilter, ImageEnhance
+import image_cache
+from image_cache import load_image
+from instrumentation import add_arguments, file_size, setup, span, timed
 
 
-def rotate_image(image: Image):
-    img_rotated = image.rotate(60)
-    name, ext = splitext(image.filename)
-    img_rotated.save(name + "_Rotate" + ext)
+@timed("augment.rotate")
+def rotate(image: Image):
+    return image.rotate(60)
 
 
-def blur_image(image: Image):
-    img_blurred = image.filter(filter=ImageFilter.BoxBlur(15))
-    name, ext = splitext(image.filename)
-    img_blurred.save(name + "_Blur" + ext)
+@timed("augment.blur")
+def blur(image: Image):
+    return image.filter(filter=ImageFilter.BoxBlur(15))
 
 
-def zoom_into_image(image: Image):
+@timed("augment.zoom_into")
+def zoom_into(image: Image):
     initial_width, initial_heigth = image.size
     width_offset = (initial_width * 0.5) / 2
     heigth_offset = (initial_heigth * 0.5) / 2
@@ -23,29 +26,120 @@ def zoom_into_image(image: Image):
     new_right = initial_width - width_offset
     new_top = heigth_offset
     new_bottom = initial_heigth - heigth_offset
-    img_zoomed = image.crop((new_left, new_top, new_right, new_bottom))
-    name, ext = splitext(image.filename)
-    img_zoomed.save(name + "_Zoom" + ext)
+    return image.crop((new_left, new_top, new_right, new_bottom))
+
+
+@timed("augment.flip")
+def flip(image: Image):
+    return image.transpose(method=Image.Transpose.FLIP_LEFT_RIGHT)
+
+
+@timed("augment.illuminate")
+def illuminate(image: Image):
+    enhancer = ImageEnhance.Brightness(image)
+    return enhancer.enhance(1.5)
+
+
+@timed("augment.contrast")
+def contrast(image: Image):
+    enhancer = ImageEnhance.Contrast(image)
+    return enhancer.enhance(2)
+
+
+# (output suffix, operation, parameters); the parameters identify the
+# operation's exact output and are part of augmentation cache keys
+AUGMENTATION_STEPS = [
+    ("_Rotate", rotate, {"angle": 60, "resample": "nearest"}),
+    ("_Blur", blur, {"box_radius": 15}),
+    ("_Zoom", zoom_into, {"crop": 0.5}),
+    ("_Flip", flip, {"axis": "left_right"}),
+    ("_Illuminate", illuminate, {"brightness": 1.5}),
+    ("_Contrast", contrast, {"contrast": 2}),
+]
+
+
+def random_params(seed):
+    """Parameters of a random augmentation, reproducible from seed"""
+    rng = random.Random(seed)
+    return {
+        "angle": rng.choice([0, rng.uniform(-180, 180)]),
+        "flip": rng.random() < 0.5,
+        "crop": rng.choice([1.0, rng.uniform(0.6, 0.95)]),
+        "brightness": rng.uniform(0.7, 1.3),
+        "contrast": rng.uniform(0.7, 1.5),
+        "blur": rng.choice([0, 0, 0, rng.randint(1, 3)]),
+    }
+
+
+@timed("augment.random")
+def augment_with_params(image: Image, params):
+    """Chain the basic augmentations with the given parameters"""
+    img = image
+    if params["angle"]:
+        img = img.rotate(params["angle"])
+    if params["flip"]:
+        img = flip(img)
+    if params["crop"] < 1:
+        width, height = img.size
+        width_offset = width * (1 - params["crop"]) / 2
+        height_offset = height * (1 - params["crop"]) / 2
+        img = img.crop((width_offset, height_offset,
+                        width - width_offset, height - height_offset))
+    img = ImageEnhance.Brightness(img).enhance(params["brightness"])
+    img = ImageEnhance.Contrast(img).enhance(params["contrast"])
+    if params["blur"]:
+        img = img.filter(filter=ImageFilter.BoxBlur(params["blur"]))
+    return img
+
+
+def save_augmented(augmented: Image, source: Image, suffix):
+    name, ext = splitext(source.filename)
+    with span("encode_save") as s:
+        augmented.save(name + suffix + ext)
+        if s:
+            s.bytes_written = file_size(name + suffix + ext)
+
+
+def rotate_image(image: Image):
+    save_augmented(rotate(image), image, "_Rotate")
+
+
+def blur_image(image: Image):
+    save_augmented(blur(image), image, "_Blur")
+
+
+def zoom_into_image(image: Image):
+    save_augmented(zoom_into(image), image, "_Zoom")
 
 
 def flip_image(image: Image):
-    img_flipped = image.transpose(method=Image.Transpose.FLIP_LEFT_RIGHT)
-    name, ext = splitext(image.filename)
-    img_flipped.save(name + "_Flip" + ext)
+    save_augmented(flip(image), image, "_Flip")
 
 
 def illuminate_image(image: Image):
-    enhancer = ImageEnhance.Brightness(image)
-    img_illuminated = enhancer.enhance(1.5)
-    name, ext = splitext(image.filename)
-    img_illuminated.save(name + "_Illuminate" + ext)
+    save_augmented(illuminate(image), image, "_Illuminate")
 
 
 def contrast_image(image):
-    enhancer = ImageEnhance.Contrast(image)
-    img_contrasted = enhancer.enhance(2)
-    name, ext = splitext(image.filename)
-    img_contrasted.save(name + "_Contrast" + ext)
+    save_augmented(contrast(image), image, "_Contrast")
+
+
+AUGMENTATIONS = [rotate_image, blur_image, zoom_into_image,
+                 flip_image, illuminate_image, contrast_image]
+
+
+def augment_file(pic, n=len(AUGMENTATIONS)):
+    """Decode a picture once and write its first n augmentations
+
+    Returns the number of augmented pictures written.
+    """
+    num_to_create = min(n, len(AUGMENTATIONS))
+    img = Image.fromarray(load_image(pic))
+    # save_augmented names the outputs after the source file
+    img.filename = pic
+    for i in range(num_to_create):
+        AUGMENTATIONS[i](img)
+    return num_to_create
 
 
 if __name__ == "__main__":
@@ -62,16 +156,15 @@ if __name__ == "__main__":
         default=6,
         help="Number of augmentations to create (default: 6)"
     )
+    add_arguments(parser)
+    image_cache.add_arguments(parser)
     args = parser.parse_args()
+    setup(args)
+    image_cache.setup(args)
     pic = args.pic_path
     print("Pic:", pic)
     if (not exists(pic) or not pic.lower().endswith((".jpg",
                                                      ".jpeg", ".png"))):
         print("Provided argument should be a path to a picture.")
         exit(1)
-    augmentations = [rotate_image, blur_image, zoom_into_image,
-                     flip_image, illuminate_image, contrast_image]
-    num_to_create = min(args.n, len(augmentations))
-    with Image.open(pic) as img:
-        for i in range(num_to_create):
-            augmentations[i](img)
+    augment_file(pic, args.n)
@@ -1,84 +1,201 @@
 import argparse
-from os import listdir
-from os.path import join, isdir, isfile
-import subprocess
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from os.path import basename, splitext
+from Augmentation import random_params
+from augmentation_cache import (DEFAULT_CACHE_DIR, RANDOM_SUFFIX, STEPS,
+                                apply_task, augment_with_cache, fixed_tasks,
+                                is_derived)
+from dataset_index import DatasetIndex
+import image_cache
+from instrumentation import add_arguments, setup, span
 
 
-def count_images(directory):
-    """Count images in a directory"""
-    return len([f for f in listdir(directory)
-                if isfile(join(directory, f)) and
-                f.lower().endswith((".jpg", ".jpeg", ".png"))])
+def run_augmentations(jobs, workers=None, cache_dir=DEFAULT_CACHE_DIR,
+                      total=None, link=False):
+    """Augment (image_path, tasks) jobs across a pool of processes
 
+    jobs may be a lazy iterable; at most a few jobs per worker are in
+    flight at any time, so memory stays bounded however large the plan.
+    """
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    created = 0
+    hits = 0
+    jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
 
-def get_images(directory):
-    """Get list of image paths in a directory"""
-    return [join(directory, f) for f in listdir(directory)
-            if isfile(join(directory, f)) and
-            f.lower().endswith((".jpg", ".jpeg", ".png"))]
+        def submit_next():
+            for path, tasks in jobs:
+                future = pool.submit(augment_with_cache, path, tasks,
+                                     cache_dir, link)
+                pending[future] = path
+                return True
+            return False
 
+        while len(pending) < workers * 4 and submit_next():
+            pass
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = pending.pop(future)
+                try:
+                    written, cached = future.result()
+                    created += written
+                    hits += cached
+                except (OSError, ValueError) as e:
+                    print("\n  Error augmenting {}: {}".format(path, e))
+                submit_next()
+            elapsed = time.perf_counter() - start
+            print("\r  {}{} images created ({} from cache), "
+                  "{:.1f} images/sec".format(
+                      created, "/{}".format(total) if total else "", hits,
+                      created / elapsed if elapsed else 0.0),
+                  end="", flush=True)
+    print()
+    return created
+
+
+def plan_balance(index, target=None, max_ratio=None):
+    """Work out how many pictures each class needs and from which sources
+
+    The target defaults to the largest class. max_ratio caps a class at
+    max_ratio times its number of source pictures. Augmented pictures are
+    never used as sources, and each source first gets the fixed
+    Augmentation.py steps it is still missing, then seeded random
+    augmentations, so any target can be reached.
+    """
+    counts = index.counts()
+    if target is None:
+        target = max(counts.values()) if counts else 0
+    plan = []
+    for name, current in counts.items():
+        existing = set(index.classes[name]["files"])
+        sources = [p for p in index.images(name) if not is_derived(p)]
+        goal = target
+        if max_ratio is not None:
+            goal = min(goal, max(current, int(len(sources) * max_ratio)))
+        needed = max(0, goal - current)
+        fixed = 0
+        if needed and sources:
+            per_source, remainder = divmod(needed, len(sources))
+            for i, source in enumerate(sources):
+                count = per_source + (1 if i < remainder else 0)
+                stem, ext = splitext(basename(source))
+                fixed += min(count, sum(
+                    1 for suffix in STEPS
+                    if stem + suffix + ext not in existing))
+        plan.append({
+            "class": name,
+            "current": current,
+            "target": target,
+            "goal": goal,
+            "needed": needed if sources else 0,
+            "fixed": fixed,
+            "random": needed - fixed if sources else 0,
+            "sources": sources,
+            "existing": existing,
+        })
+    return plan
+
+
+def iter_jobs(class_plan):
+    """Yield (source, tasks) jobs for one class of a plan, lazily"""
+    sources, existing = class_plan["sources"], class_plan["existing"]
+    if not class_plan["needed"]:
+        return
+    per_source, remainder = divmod(class_plan["needed"], len(sources))
+    for i, source in enumerate(sources):
+        count = per_source + (1 if i < remainder else 0)
+        if not count:
+            continue
+        stem, ext = splitext(basename(source))
+        suffixes = [suffix for suffix in STEPS
+                    if stem + suffix + ext not in existing][:count]
+        tasks = fixed_tasks(suffixes)
+        k = 0
+        while len(tasks) < count:
+            suffix = RANDOM_SUFFIX.format(k)
+            if stem + suffix + ext not in existing:
+                tasks.append((suffix, random_params(stem + suffix)))
+            k += 1
+        yield source, tasks
 
-def balance_dataset(root_directory):
-    """Balance the number of images across all subdirectories"""
-    subdirs = {}
 
-    for subdir_name in listdir(root_directory):
-        subdir_path = join(root_directory, subdir_name)
-        if isdir(subdir_path):
-            image_count = count_images(subdir_path)
-            subdirs[subdir_path] = image_count
-            print("{}: {} images".format(subdir_name, image_count))
+def estimate_seconds_per_image(plan, samples=5):
+    """Time a few planned augmentations in memory, decode to encode"""
+    from io import BytesIO
+    from PIL import Image
 
-    if not subdirs:
+    sampled = []
+    for class_plan in plan:
+        for source, tasks in iter_jobs(class_plan):
+            sampled.extend((source, task) for task in tasks)
+            break
+        if len(sampled) >= samples:
+            break
+    if not sampled:
+        return 0.0
+    start = time.perf_counter()
+    for source, (suffix, params) in sampled[:samples]:
+        with Image.open(source) as img:
+            out = apply_task(img, suffix, params)
+            out.save(BytesIO(), format=img.format)
+    return (time.perf_counter() - start) / len(sampled[:samples])
+
+
+def print_plan(plan, workers):
+    print("\n{:<30} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+        "class", "current", "goal", "create", "fixed", "random"))
+    for p in plan:
+        print("{:<30} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            p["class"], p["current"], p["goal"], p["needed"], p["fixed"],
+            p["random"]))
+        if p["goal"] < p["target"]:
+            print("  capped by --max-ratio below the target of {}".format(
+                p["target"]))
+        if p["current"] < p["goal"] and not p["sources"]:
+            print("  no source images, cannot augment")
+    total = sum(p["needed"] for p in plan)
+    per_image = estimate_seconds_per_image(plan)
+    print("\nTotal to create: {} images".format(total))
+    if total:
+        print("Estimated time: {:.1f}s on {} workers "
+              "(~{:.1f} ms per image without cache hits)".format(
+                  total * per_image / workers, workers, per_image * 1000))
+
+
+def balance_dataset(root_directory, workers=None,
+                    cache_dir=DEFAULT_CACHE_DIR, target=None,
+                    max_ratio=None, dry_run=False, link=False):
+    """Balance the number of images across all subdirectories"""
+    workers = workers or os.cpu_count()
+    with span("index_scan"):
+        index = DatasetIndex.scan(root_directory)
+    if not index.classes:
         print("No subdirectories found.")
         return
 
-    max_count = max(subdirs.values())
-    print("\nTarget count: {} images per subdirectory".format(max_count))
-
-    for subdir_path, current_count in subdirs.items():
-        needed = max_count - current_count
-        if needed > 0:
-            print("\n{}: need {} more images".format(subdir_path, needed))
-            images = get_images(subdir_path)
-
-            if not images:
-                msg = "  No images to augment in {}, skipping..."
-                print(msg.format(subdir_path))
-                continue
-
-            augmentations_per_image = needed // len(images)
-            remainder = needed % len(images)
-
-            for i, image_path in enumerate(images):
-                num_augmentations = augmentations_per_image
-                if i < remainder:
-                    num_augmentations += 1
-
-                if num_augmentations > 0:
-                    try:
-                        subprocess.run(
-                            ["python", "Augmentation.py", image_path,
-                             "-n", str(num_augmentations)],
-                            check=True,
-                            capture_output=True,
-                            text=True
-                        )
-                    except subprocess.CalledProcessError as e:
-                        print("  Error augmenting {}: {}".format(
-                            image_path, e))
-                        print("  stdout: {}".format(e.stdout))
-                        print("  stderr: {}".format(e.stderr))
-        else:
-            msg = "\n{}: already balanced ({} images)"
-            print(msg.format(subdir_path, current_count))
+    with span("plan"):
+        plan = plan_balance(index, target, max_ratio)
+    print("Target count: {} images per subdirectory".format(
+        plan[0]["target"]))
+    print_plan(plan, workers)
+    if dry_run:
+        return
+
+    total = sum(p["needed"] for p in plan)
+    if total:
+        print("\nAugmenting...")
+        jobs = (job for class_plan in plan for job in iter_jobs(class_plan))
+        run_augmentations(jobs, workers, cache_dir, total, link)
 
     print("\n=== Final counts ===")
-    for subdir_name in listdir(root_directory):
-        subdir_path = join(root_directory, subdir_name)
-        if isdir(subdir_path):
-            image_count = count_images(subdir_path)
-            print("{}: {} images".format(subdir_name, image_count))
+    for subdir_name, image_count in DatasetIndex.scan(
+            root_directory).counts().items():
+        print("{}: {} images".format(subdir_name, image_count))
 
 
 if __name__ == "__main__":
@@ -91,6 +208,55 @@ if __name__ == "__main__":
         "directory",
         help="Root directory containing subdirectories with images"
     )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of augmentation processes (default: all CPUs)"
+    )
+    parser.add_argument(
+        "--target",
+        type=int,
+        help="Images wanted per subdirectory (default: the largest one)"
+    )
+    parser.add_argument(
+        "--max-ratio",
+        type=float,
+        help="Never grow a subdirectory beyond this many times its "
+             "number of source images"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the plan and a time estimate without writing anything"
+    )
+    parser.add_argument(
+        "--cache",
+        default=DEFAULT_CACHE_DIR,
+        help="Augmentation cache directory (default: {})".format(
+            DEFAULT_CACHE_DIR)
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Compute every augmentation without reading or filling the "
+             "cache"
+    )
+    parser.add_argument(
+        "--link-cache",
+        action="store_true",
+        help="Hard-link augmented pictures to their cache entries instead "
+             "of copying them: no second copy on disk, but evicting an "
+             "entry frees nothing while the picture exists"
+    )
+    add_arguments(parser)
+    image_cache.add_arguments(parser)
     args = parser.parse_args()
+    setup(args)
+    image_cache.setup(args)
 
-    balance_dataset(args.directory)
+    balance_dataset(args.directory, args.workers,
+                    None if args.no_cache else args.cache,
+                    args.target, args.max_ratio, args.dry_run,
+                    args.link_cache)
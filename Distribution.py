@@ -1,59 +1,50 @@
-from sys import argv
-from os import listdir
-from os.path import isfile, join, exists, isdir
-import matplotlib
-import matplotlib.pyplot as plt
-matplotlib.use('TkAgg')  # Configurer le backend
+import argparse
+import json
+from os.path import isfile, join, exists
+from dataset_index import DatasetIndex
+import reporting
 
 
 def analyze_subdirectories(directory):
-    subdirectories = {}
-    for subdir in listdir(directory):
-        subpath = (join(directory, subdir))
-        if isdir(subpath):
-            contained_pics = [
-                pic
-                for pic in listdir(subpath)
-                if isfile(join(subpath, pic))
-                and pic.lower().endswith((".jpg", ".jpeg", ".png"))
-            ]
-            subdirectories[subdir] = len(contained_pics)
-    return subdirectories
+    index_path = join(directory, "index.json")
+    if isfile(index_path):
+        # Directory packed by shards.py, the index already has the counts
+        with open(index_path) as f:
+            return json.load(f)["class_counts"]
+    return DatasetIndex.scan(directory).counts()
 
 
-def plot_distribution(subdirectories, directory):
-    fig, axes = plt.subplots(1, 2, figsize=(12, 5))  # 1 ligne, 2 colonnes
+def plot_distribution(subdirectories, directory, output=None):
     values = list(subdirectories.values())  # number of pics in the folder
-    labels = list(subdirectories.keys())  # name of the folder
     if not values:
         print("No subdirectories to plot")
+    elif sum(values) == 0:
+        print("Found subdirectories but no images to plot")
     else:
-        if sum(values) == 0:
-            print("Found subdirectories but no images to plot")
+        reporting.get_pyplot(interactive=output is None)
+        fig = reporting.distribution_figure(subdirectories, directory)
+        if output:
+            reporting.save_figure(fig, output)
+            print("Distribution chart saved to {}".format(output))
         else:
-            axes[0].pie(values, labels=labels, autopct='%1.1f%%')
-            # axes[0].set_title(directory)
-            axes[1].bar(labels, values)
-            # axes[1].set_title(directory)
-            axes[1].set_xlabel('Folders')
-            axes[1].set_ylabel('Number of Images')
-            # Rotation des labels pour éviter les chevauchements
-            axes[1].tick_params(axis='x', rotation=45)
-            # Alignement à droite pour meilleure lisibilité
-            plt.setp(axes[1].xaxis.get_majorticklabels(),
-                     rotation=45, ha='right')
-            plt.suptitle("Distribution in folder \"{}\"".format(directory))
-            plt.tight_layout()
-            plt.show()
+            reporting.show_figure(fig)
 
 
 if __name__ == "__main__":
-    if len(argv) != 2:
-        print("Please call with one argument which should be a directory.")
-        exit(1)
-    directory = argv[1]
+    parser = argparse.ArgumentParser(
+        prog='Distribution.py',
+        description='Plot how many images each subdirectory contains.'
+    )
+    parser.add_argument("directory")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Save the chart to this PNG file instead of displaying it"
+    )
+    args = parser.parse_args()
+    directory = args.directory
     if not exists(directory):
         print(f"The directory {directory} does not exist.")
         exit(1)
     subdirectories = analyze_subdirectories(directory)
-    plot_distribution(subdirectories, directory)
+    plot_distribution(subdirectories, directory, args.output)
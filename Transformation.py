@@ -1,91 +1,682 @@
 import argparse
-import cv2
-from plantcv import plantcv as pcv
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import cached_property
+import image_cache
+from image_cache import load_image
+from instrumentation import add_arguments, file_size, setup, span, timed
+from lazy_import import lazy_import
 from os.path import exists, splitext, join, isdir, isfile, basename, normpath
 from os import listdir, makedirs
 
+MANIFEST_NAME = ".transformation_manifest.jsonl"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
 
-def threshold_image(image: str, outdir=None):
-    color_img, imgpath, imgname = pcv.readimage(image)
-    grayscale_img = pcv.rgb2gray_lab(color_img, "l")
-    thresholded_img = pcv.threshold.otsu(grayscale_img, "light")
+# PlantCV takes seconds to import; load it on first use, not for --help
+pcv = lazy_import("plantcv.plantcv")
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+
+class TransformationPipeline:
+    """Decode an image once and derive every transformation from it
+
+    Intermediates shared by several transformations (grayscale channels,
+    Otsu masks, filled mask) are computed on first use and then reused.
+    """
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+
+    @cached_property
+    def _read(self):
+        # Same pixels and (img, path, name) result as pcv.readimage, but
+        # through the decoded-image cache shared with the other stages
+        rgb = load_image(self.image_path)
+        path, img_name = os.path.split(self.image_path)
+        return rgb[..., ::-1].copy(), path, img_name
+
+    @property
+    def color_img(self):
+        return self._read[0]
+
+    @property
+    def imgname(self):
+        return self._read[2]
+
+    @cached_property
+    def lab_l(self):
+        return pcv.rgb2gray_lab(self.color_img, "l")
+
+    @cached_property
+    def lab_mask(self):
+        return pcv.threshold.otsu(self.lab_l, "light")
+
+    @cached_property
+    def hsv_s(self):
+        return pcv.rgb2gray_hsv(rgb_img=self.color_img, channel='s')
+
+    @cached_property
+    def hsv_mask(self):
+        return pcv.threshold.otsu(gray_img=self.hsv_s, object_type='light')
+
+    @cached_property
+    def filled_mask(self):
+        return pcv.fill(self.hsv_mask, size=200)
+
+    def threshold(self):
+        return self.lab_mask
+
+    def edges(self):
+        return pcv.canny_edge_detect(self.color_img, sigma=1.3)
+
+    def analyzed(self):
+        pcv.params.line_thickness = 1
+        analyzed_img = pcv.analyze.size(self.color_img, self.lab_mask)
+        # Observations pile up in the global outputs otherwise
+        pcv.outputs.clear()
+        return analyzed_img
+
+    @cached_property
+    def size_observations(self):
+        """pcv.analyze.size observations of the Otsu mask"""
+        # Measured apart from analyzed(): longest_path depends on the
+        # line thickness that one sets
+        with span("plantcv.analyze_size"):
+            pcv.analyze.size(self.color_img, self.lab_mask)
+        observations = next(iter(pcv.outputs.observations.values()), {})
+        pcv.outputs.clear()
+        return observations
+
+    def blurred(self):
+        return pcv.gaussian_blur(self.color_img, (7, 7), 0)
+
+    def isolated(self):
+        return pcv.apply_mask(img=self.color_img, mask=self.hsv_mask,
+                              mask_color='white')
+
+    @cached_property
+    def landmark_points(self):
+        img, mask = self.color_img, self.filled_mask
+        with span("plantcv.homology"):
+            top, bottom, center_v = pcv.homology.y_axis_pseudolandmarks(
+                img=img, mask=mask
+            )
+            left, right, center_h = pcv.homology.x_axis_pseudolandmarks(
+                img=img, mask=mask
+            )
+        pcv.outputs.clear()
+        return {"top": top, "bottom": bottom, "left": left, "right": right,
+                "center_v": center_v, "center_h": center_h}
+
+    def landmarks(self):
+        points = self.landmark_points
+        landmark_img = self.color_img.copy()
+        landmark_sets = [
+            (points["top"], (255, 255, 0), "TOP"),  # cyan - en haut
+            (points["bottom"], (255, 0, 255), "BOTTOM"),  # magenta - en bas
+            (points["left"], (0, 255, 0), "LEFT"),  # vert - à gauche
+            (points["right"], (0, 0, 255), "RIGHT"),  # rouge - à droite
+            (points["center_v"], (0, 128, 255), "CENTER_V"),  # bleu clair
+            (points["center_h"], (255, 128, 0), "CENTER_H")  # orange
+        ]
+        for points_array, color, label in landmark_sets:
+            if points_array is not None and len(points_array) > 0:
+                for pt in points_array:
+                    x, y = int(pt[0][0]), int(pt[0][1])
+                    cv2.circle(landmark_img, (x, y), 3, color, -1)
+                    cv2.circle(landmark_img, (x, y), 4, (255, 255, 255), 1)
+        return landmark_img
+
+    def features(self):
+        """Size, shape and pseudolandmarks of the leaf as a flat dict
+
+        Measurements are those of pcv.analyze.size on the Otsu mask;
+        points become <name>_x and <name>_y entries, landmark i of a set
+        <set>_<i>_x and <set>_<i>_y.
+        """
+        row = {}
+        for name, observation in self.size_observations.items():
+            value = observation["value"]
+            if isinstance(value, (tuple, list)):
+                for axis, v in zip(observation["label"], value):
+                    row["{}_{}".format(name, axis)] = v
+            else:
+                row[name] = value
+        for name, points in self.landmark_points.items():
+            for i, point in enumerate(points if points is not None else []):
+                row["{}_{}_x".format(name, i)] = float(point[0][0])
+                row["{}_{}_y".format(name, i)] = float(point[0][1])
+        return row
+
+    def save(self, names=None, outdir=None):
+        """Write the selected transformations (all by default)"""
+        for name in names or TRANSFORMATIONS:
+            method, suffix = TRANSFORMATIONS[name]
+            with span("transform." + name):
+                # By name, so subclasses' overrides are used
+                result = getattr(self, method.__name__)()
+            path = output_path(self.imgname, suffix, outdir)
+            with span("encode_save") as s:
+                pcv.print_image(result, path)
+                if s:
+                    s.bytes_written = file_size(path)
+
+
+class FastTransformationPipeline(TransformationPipeline):
+    """TransformationPipeline working on a downsampled copy of the image
+
+    Masks, edges and the size analysis are computed with the longest side
+    reduced to work_size, then scaled back up; fill only sees the
+    bounding box of the leaf (the saturation Otsu mask without specks
+    smaller than the fill size). Outputs keep the source resolution:
+    measurements are mapped back to source pixels, analysis annotations
+    are pasted over the full-size image, and pseudolandmarks are found on
+    the filled mask scaled back up to the source.
+    """
+
+    def __init__(self, image_path, work_size=512, margin=0.05):
+        super().__init__(image_path)
+        self.work_size = work_size
+        self.margin = margin
+
+    @cached_property
+    def scale(self):
+        """Working over source resolution, at most 1"""
+        return min(1.0, self.work_size / max(self.color_img.shape[:2]))
+
+    @cached_property
+    def work_img(self):
+        if self.scale == 1.0:
+            return self.color_img
+        h, w = self.color_img.shape[:2]
+        size = (max(1, round(w * self.scale)), max(1, round(h * self.scale)))
+        with span("downsample"):
+            return cv2.resize(self.color_img, size,
+                              interpolation=cv2.INTER_AREA)
+
+    def upsample(self, img):
+        """Nearest-neighbour resize of a working image to source size"""
+        if img.shape[:2] == self.color_img.shape[:2]:
+            return img
+        h, w = self.color_img.shape[:2]
+        return cv2.resize(img, (w, h), interpolation=cv2.INTER_NEAREST)
+
+    def to_source(self, points, offset=(0, 0)):
+        """Working pixel coordinates (of the ROI at offset) to source ones"""
+        points = np.asarray(points, dtype=np.float64) + offset
+        return (points + 0.5) / self.scale - 0.5
+
+    @cached_property
+    def work_lab_mask(self):
+        return pcv.threshold.otsu(pcv.rgb2gray_lab(self.work_img, "l"),
+                                  "light")
+
+    @cached_property
+    def work_hsv_mask(self):
+        return pcv.threshold.otsu(
+            gray_img=pcv.rgb2gray_hsv(rgb_img=self.work_img, channel='s'),
+            object_type='light')
+
+    @cached_property
+    def lab_mask(self):
+        return self.upsample(self.work_lab_mask)
+
+    @cached_property
+    def hsv_mask(self):
+        return self.upsample(self.work_hsv_mask)
+
+    @cached_property
+    def fill_size(self):
+        """pcv.fill size of 200 source pixels, in working pixels"""
+        return max(1, round(200 * self.scale ** 2))
+
+    @cached_property
+    def roi(self):
+        """(x0, y0, x1, y1) around the leaf on the working image"""
+        mask = self.work_hsv_mask
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        # Label 0 is the background; the rest would survive pcv.fill
+        kept = [i for i in range(1, count)
+                if stats[i, cv2.CC_STAT_AREA] >= self.fill_size]
+        h, w = mask.shape
+        if not kept:
+            return 0, 0, w, h
+        x0 = min(stats[i, cv2.CC_STAT_LEFT] for i in kept)
+        y0 = min(stats[i, cv2.CC_STAT_TOP] for i in kept)
+        x1 = max(stats[i, cv2.CC_STAT_LEFT] + stats[i, cv2.CC_STAT_WIDTH]
+                 for i in kept)
+        y1 = max(stats[i, cv2.CC_STAT_TOP] + stats[i, cv2.CC_STAT_HEIGHT]
+                 for i in kept)
+        pad = round(self.margin * max(h, w))
+        return (int(max(0, x0 - pad)), int(max(0, y0 - pad)),
+                int(min(w, x1 + pad)), int(min(h, y1 + pad)))
+
+    def edges(self):
+        return self.upsample(
+            pcv.canny_edge_detect(self.work_img, sigma=1.3))
+
+    def isolated(self):
+        # pcv.apply_mask with a white background, without its slow indexing
+        white = np.full_like(self.color_img, 255)
+        return cv2.copyTo(self.color_img, self.hsv_mask, white)
+
+    def analyzed(self):
+        pcv.params.line_thickness = 1
+        annotated = pcv.analyze.size(self.work_img, self.work_lab_mask)
+        pcv.outputs.clear()
+        # Paste the annotation pixels, scaled up, over the source image
+        drawn = self.upsample(np.any(annotated != self.work_img, axis=2)
+                              .astype(np.uint8))
+        return cv2.copyTo(self.upsample(annotated), drawn,
+                          self.color_img.copy())
+
+    @cached_property
+    def size_observations(self):
+        with span("plantcv.analyze_size"):
+            pcv.analyze.size(self.work_img, self.work_lab_mask)
+        observations = next(iter(pcv.outputs.observations.values()), {})
+        pcv.outputs.clear()
+        return {name: dict(observation, value=self.rescale(name, observation))
+                for name, observation in observations.items()}
+
+    def rescale(self, name, observation):
+        """An analyze.size value of the working image, in source pixels"""
+        value, label = observation["value"], observation["label"]
+        if isinstance(value, (tuple, list)):
+            return tuple(float(v) for v in self.to_source(value))
+        if label != "pixels":
+            return value
+        if name.endswith("area"):
+            return value / self.scale ** 2
+        return value / self.scale
+
+    @cached_property
+    def landmark_points(self):
+        # pcv cuts the leaf into bands int(extent / 21) pixels wide, which
+        # on the working image fall tens of source pixels away from the
+        # full pipeline's; on the scaled-up mask they usually match. When
+        # the extent differs by a pixel the band width can still change,
+        # and the bands far from the first drift by up to ~50 pixels.
+        x0, y0, x1, y1 = self.roi
+        filled = np.zeros_like(self.work_hsv_mask)
+        filled[y0:y1, x0:x1] = pcv.fill(self.work_hsv_mask[y0:y1, x0:x1],
+                                        size=self.fill_size)
+        mask = self.upsample(filled)
+        (h, w), (work_h, work_w) = mask.shape, filled.shape
+        x0, x1 = x0 * w // work_w, min(w, -(-x1 * w // work_w))
+        y0, y1 = y0 * h // work_h, min(h, -(-y1 * h // work_h))
+        img, mask = self.color_img[y0:y1, x0:x1], mask[y0:y1, x0:x1]
+        with span("plantcv.homology"):
+            top, bottom, center_v = pcv.homology.y_axis_pseudolandmarks(
+                img=img, mask=mask
+            )
+            left, right, center_h = pcv.homology.x_axis_pseudolandmarks(
+                img=img, mask=mask
+            )
+        pcv.outputs.clear()
+        points = {"top": top, "bottom": bottom, "left": left, "right": right,
+                  "center_v": center_v, "center_h": center_h}
+        return {name: None if p is None
+                else np.asarray(p, dtype=np.float64) + (x0, y0)
+                for name, p in points.items()}
+
+
+def make_pipeline(image_path, work_size=None):
+    """Full-resolution pipeline, or the fast one when work_size is set"""
+    if work_size:
+        return FastTransformationPipeline(image_path, work_size)
+    return TransformationPipeline(image_path)
+
+
+def _iou(a, b):
+    a, b = a > 0, b > 0
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.0
+
+
+def _near(a, b, distance):
+    """Share of the pixels set in a within distance pixels of one in b"""
+    a = a > 0
+    if not a.any():
+        return 1.0
+    kernel = np.ones((2 * distance + 1, 2 * distance + 1), np.uint8)
+    close = cv2.dilate((b > 0).astype(np.uint8), kernel) > 0
+    return np.count_nonzero(a & close) / np.count_nonzero(a)
+
+
+def fidelity(full, fast):
+    """How far a FastTransformationPipeline strays from the full one
+
+    Both pipelines are of the same image. Masks are compared by IoU,
+    edges by the share of edge pixels within one working pixel of an
+    edge of the other, landmarks and positions by their distance in
+    source pixels, sizes by relative error and angles in degrees.
+    """
+    tolerance = int(np.ceil(1 / fast.scale))
+    full_edges, fast_edges = full.edges(), fast.edges()
+    distances = []
+    for name, points in full.landmark_points.items():
+        other = fast.landmark_points[name]
+        if points is None or other is None or len(points) != len(other):
+            continue
+        distances.extend(np.hypot(*(np.asarray(points, np.float64) -
+                                    other).reshape(-1, 2).T))
+    measurements = {}
+    for name, observation in full.size_observations.items():
+        value = observation["value"]
+        other = fast.size_observations.get(name, {}).get("value")
+        if other is None or isinstance(value, bool):
+            continue
+        if isinstance(value, (tuple, list)):
+            measurements[name] = float(np.hypot(*np.subtract(value, other)))
+        elif observation["label"] == "pixels":
+            measurements[name] = abs(other - value) / max(abs(value), 1e-9)
+        elif observation["label"] == "degrees":
+            measurements[name] = abs(other - value)
+    analyzed = np.abs(full.analyzed().astype(np.int16) - fast.analyzed())
+    return {
+        "scale": fast.scale,
+        "threshold_iou": _iou(full.threshold(), fast.threshold()),
+        "isolate_iou": _iou(full.hsv_mask, fast.hsv_mask),
+        "edges_recall": _near(full_edges, fast_edges, tolerance),
+        "edges_precision": _near(fast_edges, full_edges, tolerance),
+        "landmarks_mean_px": float(np.mean(distances)) if distances else 0.0,
+        "landmarks_max_px": float(np.max(distances)) if distances else 0.0,
+        "analyzed_mean_abs_diff": float(analyzed.mean()),
+        "measurements": measurements,
+    }
+
+
+def output_path(imgname, suffix, outdir=None):
     name, ext = splitext(imgname)
-    output_path = (join(outdir, name + "_Threshold" + ext) if outdir
-                   else name + "_Threshold" + ext)
-    pcv.print_image(thresholded_img, output_path)
+    return (join(outdir, name + suffix + ext) if outdir
+            else name + suffix + ext)
+
+
+# name -> (pipeline method, output suffix), in the historical output order
+TRANSFORMATIONS = {
+    "threshold": (TransformationPipeline.threshold, "_Threshold"),
+    "edges": (TransformationPipeline.edges, "_Edges"),
+    "analyze": (TransformationPipeline.analyzed, "_Analyzed"),
+    "blur": (TransformationPipeline.blurred, "_Blurred"),
+    "pseudolandmarks": (TransformationPipeline.landmarks,
+                        "_Pseudolandmarks"),
+    "isolate": (TransformationPipeline.isolated, "_Isolated"),
+}
+
+
+def threshold_image(image: str, outdir=None):
+    TransformationPipeline(image).save(["threshold"], outdir)
 
 
 def canny_edge_detection(image: str, outdir=None):
-    color_img, imgpath, imgname = pcv.readimage(image)
-    edges = pcv.canny_edge_detect(color_img,  sigma=1.3)
-    name, ext = splitext(imgname)
-    output_path = (join(outdir, name + "_Edges" + ext) if outdir
-                   else name + "_Edges" + ext)
-    pcv.print_image(edges, output_path)
+    TransformationPipeline(image).save(["edges"], outdir)
 
 
 def analyze_size_and_shape(image: str, outdir=None):
-    color_img, imgpath, imgname = pcv.readimage(image)
-    pcv.params.line_thickness = 1
-    grayscale_img = pcv.rgb2gray_lab(color_img, "l")
-    thresholded_img = pcv.threshold.otsu(grayscale_img, "light")
-    analyzed_img = pcv.analyze.size(color_img, thresholded_img)
-    name, ext = splitext(imgname)
-    output_path = (join(outdir, name + "_Analyzed" + ext) if outdir
-                   else name + "_Analyzed" + ext)
-    pcv.print_image(analyzed_img, output_path)
+    TransformationPipeline(image).save(["analyze"], outdir)
 
 
 def gaussian_blur(image: str, outdir=None):
-    color_img, imgpath, imgname = pcv.readimage(image)
-    blurred_img = pcv.gaussian_blur(color_img, (7, 7), 0)
-    name, ext = splitext(imgname)
-    output_path = (join(outdir, name + "_Blurred" + ext) if outdir
-                   else name + "_Blurred" + ext)
-    pcv.print_image(blurred_img, output_path)
+    TransformationPipeline(image).save(["blur"], outdir)
 
 
 def isolate_from_bg(image_path, outdir=None):
-    img, path, filename = pcv.readimage(image_path)
-    s = pcv.rgb2gray_hsv(rgb_img=img, channel='s')
-    mask = pcv.threshold.otsu(gray_img=s, object_type='light')
-    masked = pcv.apply_mask(img=img, mask=mask, mask_color='white')
-    name, ext = splitext(filename)
-    output_path = (join(outdir, name + "_Isolated" + ext) if outdir
-                   else name + "_Isolated" + ext)
-    pcv.print_image(masked, output_path)
+    TransformationPipeline(image_path).save(["isolate"], outdir)
 
 
 def pseudolandmarks(image_path, outdir=None):
-    img, path, filename = pcv.readimage(image_path)
-    s = pcv.rgb2gray_hsv(img, channel='s')
-    mask = pcv.threshold.otsu(s, object_type='light')
-    mask = pcv.fill(mask, size=200)
-    top, bottom, center_v = pcv.homology.y_axis_pseudolandmarks(
-        img=img, mask=mask
-    )
-    left, right, center_h = pcv.homology.x_axis_pseudolandmarks(
-        img=img, mask=mask
-    )
-    landmark_img = img.copy()
-    landmark_sets = [
-        (top, (255, 255, 0), "TOP"),  # cyan - en haut
-        (bottom, (255, 0, 255), "BOTTOM"),  # magenta - en bas
-        (left, (0, 255, 0), "LEFT"),  # vert - à gauche
-        (right, (0, 0, 255), "RIGHT"),  # rouge - à droite
-        (center_v, (0, 128, 255), "CENTER_V"),  # bleu clair
-        (center_h, (255, 128, 0), "CENTER_H")  # orange
-    ]
-    for points_array, color, label in landmark_sets:
-        if points_array is not None and len(points_array) > 0:
-            for pt in points_array:
-                x, y = int(pt[0][0]), int(pt[0][1])
-                cv2.circle(landmark_img, (x, y), 3, color, -1)
-                cv2.circle(landmark_img, (x, y), 4, (255, 255, 255), 1)
-    name, ext = splitext(filename)
-    output_path = (join(outdir, name + '_Pseudolandmarks' + ext) if outdir
-                   else name + '_Pseudolandmarks' + ext)
-    pcv.print_image(landmark_img, output_path)
+    TransformationPipeline(image_path).save(["pseudolandmarks"], outdir)
+
+
+def file_signature(path, check="mtime"):
+    """Identify a source file version by size and mtime, or content hash"""
+    st = os.stat(path)
+    signature = {"size": st.st_size}
+    if check == "hash":
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        signature["sha256"] = digest.hexdigest()
+    else:
+        signature["mtime_ns"] = st.st_mtime_ns
+    return signature
+
+
+def load_manifest(output_dir):
+    """Read the append-only manifest, later records win"""
+    manifest = {}
+    path = join(output_dir, MANIFEST_NAME)
+    if not exists(path):
+        return manifest
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run
+                continue
+            manifest[record["source"]] = record
+    return manifest
+
+
+def is_up_to_date(record, image_path, names, output_dir, check,
+                  work_size=None):
+    if record is None or not set(names) <= set(record["outputs"]):
+        return False
+    if record.get("work_size") != work_size:
+        return False
+    if record["signature"] != file_signature(image_path, check):
+        return False
+    return all(exists(output_path(basename(image_path),
+                                  TRANSFORMATIONS[name][1], output_dir))
+               for name in names)
+
+
+def _init_worker():
+    # Each worker process owns its pcv.params; start from a clean state.
+    # Reset in place: PlantCV submodules hold a reference to this object.
+    vars(pcv.params).update(vars(pcv.Params()))
+
+
+@timed("transform_chunk")
+def _transform_chunk(image_paths, names, output_dir, check, work_size=None):
+    records = []
+    for image_path in image_paths:
+        try:
+            make_pipeline(image_path, work_size).save(names, output_dir)
+        except Exception as e:
+            records.append({"source": basename(image_path),
+                            "error": str(e)})
+            continue
+        record = {"source": basename(image_path),
+                  "signature": file_signature(image_path, check),
+                  "outputs": names}
+        if work_size:
+            record["work_size"] = work_size
+        records.append(record)
+    return records
+
+
+def transform_directory(src, output_dir, names=None, jobs=None,
+                        chunk_size=16, check="mtime", work_size=None):
+    """Transform every image of src in parallel, skipping finished ones
+
+    Outputs made at another work_size (fast path) count as outdated.
+    """
+    names = names or list(TRANSFORMATIONS)
+    manifest = load_manifest(output_dir)
+    filenames = [f for f in sorted(listdir(src))
+                 if f.lower().endswith((".jpg", ".jpeg", ".png"))]
+    todo = [join(src, f) for f in filenames
+            if not is_up_to_date(manifest.get(f), join(src, f), names,
+                                 output_dir, check, work_size)]
+    print("{} images to transform ({} already up to date)".format(
+        len(todo), len(filenames) - len(todo)))
+    if not todo:
+        return
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    done = 0
+    with open(join(output_dir, MANIFEST_NAME), "a") as manifest_file, \
+            ProcessPoolExecutor(max_workers=jobs,
+                                initializer=_init_worker) as pool:
+        futures = [pool.submit(_transform_chunk, chunk, names, output_dir,
+                               check, work_size) for chunk in chunks]
+        for future in as_completed(futures):
+            for record in future.result():
+                if "error" in record:
+                    print("\nError transforming {}: {}".format(
+                        record["source"], record["error"]))
+                    continue
+                manifest_file.write(json.dumps(record) + "\n")
+                done += 1
+            manifest_file.flush()
+            print("\r{}/{} images transformed".format(done, len(todo)),
+                  end="", flush=True)
+    print()
+
+
+def list_dataset_images(src):
+    """Image paths under src relative to it, class folders included"""
+    found = []
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        found.extend(os.path.relpath(join(root, f), src)
+                     for f in sorted(files)
+                     if f.lower().endswith(IMAGE_EXTENSIONS))
+    return found
+
+
+def read_table(path):
+    import pandas as pd
+
+    if not exists(path):
+        return None
+    if path.lower().endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def check_table_format(path):
+    """Fail early when a Parquet table has no engine to write it"""
+    if path.lower().endswith(".parquet"):
+        import pandas as pd
+        pd.io.parquet.get_engine("auto")
+
+
+@timed("extract_chunk")
+def _extract_chunk(src, relative_paths, names, output_dir, work_size=None):
+    rows = []
+    for relative in relative_paths:
+        image_path = join(src, relative)
+        pipeline = make_pipeline(image_path, work_size)
+        try:
+            features = pipeline.features()
+            if names:
+                outdir = join(output_dir, os.path.dirname(relative))
+                makedirs(outdir, exist_ok=True)
+                pipeline.save(names, outdir)
+        except Exception as e:
+            rows.append({"image": relative, "error": str(e)})
+            continue
+        st = os.stat(image_path)
+        parent = os.path.dirname(relative)
+        row = {"image": relative,
+               "class": parent.split(os.sep)[0] if parent else "",
+               "size_bytes": st.st_size,
+               "mtime_ns": st.st_mtime_ns}
+        if work_size:
+            row["work_size"] = work_size
+        rows.append(dict(row, **features))
+    return rows
+
+
+def extract_features(src, table_path, jobs=None, chunk_size=16, names=None,
+                     output_dir=None, work_size=None):
+    """Measure every image of src in parallel into a CSV or Parquet table
+
+    One row per image, keyed by its path relative to src. On reruns only
+    new images, or those whose size or mtime changed, are analysed; a CSV
+    table just gets the new rows appended when nothing was replaced.
+    Annotated images are written to output_dir only for the given names.
+    Rows of the fast path have a work_size column; rows measured at
+    another work_size are analysed again.
+    """
+    import pandas as pd
+
+    check_table_format(table_path)
+    table = read_table(table_path)
+    images = list_dataset_images(src)
+    known = {}
+    if table is not None:
+        work_sizes = (table["work_size"].fillna(0) if "work_size" in table
+                      else [0] * len(table))
+        known = {image: (size, mtime, int(ws)) for image, size, mtime, ws
+                 in zip(table["image"], table["size_bytes"],
+                        table["mtime_ns"], work_sizes)}
+    todo = []
+    for relative in images:
+        st = os.stat(join(src, relative))
+        if known.get(relative) != (st.st_size, st.st_mtime_ns,
+                                   work_size or 0):
+            todo.append(relative)
+    print("{} images to analyse ({} already in {})".format(
+        len(todo), len(images) - len(todo), table_path))
+    if not todo:
+        return table
+
+    rows = []
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_worker) as pool:
+        futures = [pool.submit(_extract_chunk, src, chunk, names, output_dir,
+                               work_size) for chunk in chunks]
+        for future in as_completed(futures):
+            for row in future.result():
+                if "error" in row:
+                    print("\nError analysing {}: {}".format(
+                        row["image"], row["error"]))
+                    continue
+                rows.append(row)
+            print("\r{}/{} images analysed".format(len(rows), len(todo)),
+                  end="", flush=True)
+    print()
+    if not rows:
+        return table
+
+    new = pd.DataFrame(rows).sort_values("image")
+    replaced = table is not None and new["image"].isin(table["image"]).any()
+    if (table is not None and not replaced and list(new.columns) ==
+            list(table.columns) and not table_path.endswith(".parquet")):
+        new.to_csv(table_path, mode="a", header=False, index=False)
+        return pd.concat([table, new], ignore_index=True)
+    if table is not None:
+        table = table[~table["image"].isin(new["image"])]
+        new = pd.concat([table, new], ignore_index=True).sort_values("image")
+        if "work_size" in new and new["work_size"].isna().all():
+            # Every fast-path row got replaced by a full-resolution one
+            new = new.drop(columns="work_size")
+    tmp_path = table_path + ".tmp"
+    if table_path.lower().endswith(".parquet"):
+        new.to_parquet(tmp_path, index=False)
+    else:
+        new.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, table_path)
+    return new
+
+
+def parse_only(value):
+    names = [n.strip() for n in value.split(",") if n.strip()]
+    unknown = [n for n in names if n not in TRANSFORMATIONS]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            "unknown transformation(s): {} (choose from {})".format(
+                ", ".join(unknown), ", ".join(TRANSFORMATIONS)))
+    return names
 
 
 if __name__ == "__main__":
@@ -99,18 +690,72 @@ if __name__ == "__main__":
         "-dst",
         help="Destination directory for batch processing"
     )
+    parser.add_argument(
+        "-j",
+        type=int,
+        default=1,
+        help="Worker processes for directory mode (default: 1)"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=16,
+        help="Images handed to a worker at a time (default: 16)"
+    )
+    parser.add_argument(
+        "--check",
+        choices=["mtime", "hash"],
+        default="mtime",
+        help="How to detect changed sources on reruns (default: mtime)"
+    )
+    parser.add_argument(
+        "--only",
+        type=parse_only,
+        help="Comma-separated transformations to write (default: all of "
+             "{})".format(", ".join(TRANSFORMATIONS))
+    )
+    parser.add_argument(
+        "--features",
+        metavar="TABLE",
+        help="Write size, shape and pseudolandmark measurements of every "
+             "image under -src (class folders included) to TABLE, Parquet "
+             "if it ends with .parquet, CSV otherwise. Rows of unchanged "
+             "images are kept; no images are written unless --only is set"
+    )
+    parser.add_argument(
+        "--work-size",
+        type=int,
+        metavar="PIXELS",
+        help="Fast path: run PlantCV with the longest side reduced to "
+             "PIXELS and fill on the leaf bounding box only; outputs, "
+             "measurements and pseudolandmarks stay at source resolution"
+    )
+    add_arguments(parser)
+    image_cache.add_arguments(parser)
     args = parser.parse_args()
+    setup(args)
+    image_cache.setup(args)
     src = args.src
     if not exists(src):
         print(f"Path {src} does not exist.")
         exit(1)
+    if args.features:
+        if not isdir(src):
+            print("--features needs a directory as -src.")
+            exit(1)
+        if args.only and not args.dst:
+            print("Destination directory (-dst) is required to write "
+                  "images with --only.")
+            exit(1)
+        try:
+            extract_features(src, args.features, args.j, args.chunk_size,
+                             args.only, args.dst, args.work_size)
+        except ImportError as e:
+            print("Cannot write {}: {}".format(args.features, e))
+            exit(1)
+        exit(0)
     if isfile(src) and src.lower().endswith((".jpg", ".jpeg", ".png")):
-        threshold_image(src)
-        canny_edge_detection(src)
-        analyze_size_and_shape(src)
-        gaussian_blur(src)
-        pseudolandmarks(src)
-        isolate_from_bg(src)
+        make_pipeline(src, args.work_size).save(args.only)
     elif isdir(src):
         if not args.dst:
             msg = ("Destination directory (-dst) is required when "
@@ -120,15 +765,8 @@ if __name__ == "__main__":
         source_folder_name = basename(normpath(src))
         output_dir = join(args.dst, source_folder_name)
         makedirs(output_dir, exist_ok=True)
-        for filename in listdir(src):
-            if filename.lower().endswith((".jpg", ".jpeg", ".png")):
-                image_path = join(src, filename)
-                threshold_image(image_path, output_dir)
-                canny_edge_detection(image_path, output_dir)
-                analyze_size_and_shape(image_path, output_dir)
-                gaussian_blur(image_path, output_dir)
-                pseudolandmarks(image_path, output_dir)
-                isolate_from_bg(image_path, output_dir)
+        transform_directory(src, output_dir, args.only, args.j,
+                            args.chunk_size, args.check, args.work_size)
     else:
         print("Source must be an image file or a directory.")
         exit(1)
@@ -0,0 +1,221 @@
+import argparse
+import time
+import cv2
+import numpy as np
+from PIL import Image
+from image_cache import load_image
+
+# Each kernel takes and returns a stacked (N, H, W, C) uint8 array and
+# reproduces the matching PIL function of Augmentation.py byte for byte,
+# except rotate_batch on odd sizes (see its docstring). verify() checks it.
+# OpenCV has no batched warp, blur or flip, and numpy's fancy indexing
+# and reversed-stride copies run several times slower than its per-image
+# calls, so those kernels loop over the stack into one preallocated
+# array; only a LUT shared by the whole batch is a single call.
+
+
+def rotate_batch(images, angle=60):
+    """Image.rotate: nearest neighbour around the centre, black corners
+
+    Exact for even widths and heights. With an odd dimension some source
+    coordinates fall exactly between two pixels and OpenCV breaks the tie
+    the other way, which changes well under 1% of the pixels.
+    """
+    h, w = images.shape[1:3]
+    # PIL puts pixel centres at +0.5, OpenCV at integer coordinates
+    matrix = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), angle, 1)
+    out = np.empty_like(images)
+    for i, img in enumerate(images):
+        cv2.warpAffine(img, matrix, (w, h), dst=out[i],
+                       flags=cv2.INTER_NEAREST,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return out
+
+
+def blur_batch(images, radius=15):
+    """ImageFilter.BoxBlur: separable box, edges extended
+
+    PIL rounds to uint8 between the horizontal and vertical passes, so
+    the two passes are kept separate to match it exactly.
+    """
+    size = 2 * radius + 1
+    out = np.empty_like(images)
+    for i, img in enumerate(images):
+        tmp = cv2.blur(img, (size, 1), borderType=cv2.BORDER_REPLICATE)
+        cv2.blur(tmp, (1, size), dst=out[i], borderType=cv2.BORDER_REPLICATE)
+    return out
+
+
+def zoom_batch(images, factor=0.5):
+    """Image.crop of the centre, same rounding of the box as PIL"""
+    h, w = images.shape[1:3]
+    w_off, h_off = (w * factor) / 2, (h * factor) / 2
+    x0, y0, x1, y1 = (int(round(v)) for v in
+                      (w_off, h_off, w - w_off, h - h_off))
+    return np.ascontiguousarray(images[:, y0:y1, x0:x1])
+
+
+def flip_batch(images):
+    """Transpose.FLIP_LEFT_RIGHT"""
+    out = np.empty_like(images)
+    for i, img in enumerate(images):
+        cv2.flip(img, 1, dst=out[i])
+    return out
+
+
+def apply_lut(images, tables):
+    """Map every uint8 value of image i through tables[i]"""
+    out = np.empty_like(images)
+    for i, (img, table) in enumerate(zip(images, tables)):
+        cv2.LUT(img, table, dst=out[i])
+    return out
+
+
+def apply_shared_lut(images, table):
+    """Map every uint8 value of the stack through one table, in one call"""
+    # cv2.LUT takes at most 4 channels, so hand it the stack as rows
+    rows = images.reshape(-1, images.shape[-1])
+    return cv2.LUT(rows, table).reshape(images.shape)
+
+
+def blend_table(base, factor):
+    """PIL's blend of a flat base level with the image, as a 256-entry LUT
+
+    PIL computes base + factor * (value - base) in float and truncates
+    toward zero before clipping.
+    """
+    values = np.arange(256, dtype=np.float32)
+    out = np.float32(base) + np.float32(factor) * (values - np.float32(base))
+    return np.clip(np.trunc(out), 0, 255).astype(np.uint8)
+
+
+def illuminate_batch(images, factor=1.5):
+    """ImageEnhance.Brightness: blend with black"""
+    return apply_shared_lut(images, blend_table(0, factor))
+
+
+def mean_grey(img):
+    """Rounded mean of PIL's RGB -> L conversion, as ImageEnhance uses"""
+    histogram = Image.fromarray(img).convert("L").histogram()
+    total = sum(i * count for i, count in enumerate(histogram))
+    return int(total / sum(histogram) + 0.5)
+
+
+def contrast_batch(images, factor=2.0):
+    """ImageEnhance.Contrast: blend with the rounded mean grey level"""
+    return apply_lut(images, [blend_table(mean_grey(img), factor)
+                              for img in images])
+
+
+# suffix -> kernel, in the order Augmentation.AUGMENTATIONS applies them
+BATCH_AUGMENTATIONS = {
+    "_Rotate": rotate_batch,
+    "_Blur": blur_batch,
+    "_Zoom": zoom_batch,
+    "_Flip": flip_batch,
+    "_Illuminate": illuminate_batch,
+    "_Contrast": contrast_batch,
+}
+
+
+def load_batch(paths):
+    """Decode same-sized pictures into one (N, H, W, 3) uint8 array"""
+    return np.stack([load_image(path) for path in paths])
+
+
+def pil_references():
+    from PIL import ImageEnhance, ImageFilter
+
+    return {
+        "_Rotate": lambda im: im.rotate(60),
+        "_Blur": lambda im: im.filter(ImageFilter.BoxBlur(15)),
+        "_Zoom": lambda im: im.crop((im.width * 0.25, im.height * 0.25,
+                                     im.width - im.width * 0.25,
+                                     im.height - im.height * 0.25)),
+        "_Flip": lambda im: im.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+        "_Illuminate": lambda im: ImageEnhance.Brightness(im).enhance(1.5),
+        "_Contrast": lambda im: ImageEnhance.Contrast(im).enhance(2),
+    }
+
+
+def verify(images):
+    """Compare every kernel with its PIL counterpart
+
+    Returns, per suffix, the max absolute difference and the fraction of
+    pixels that differ at all.
+    """
+    references = pil_references()
+    report = {}
+    for suffix, kernel in BATCH_AUGMENTATIONS.items():
+        expected = np.stack([np.asarray(references[suffix](
+            Image.fromarray(img))) for img in images])
+        diff = np.abs(expected.astype(np.int16) - kernel(images)).max(-1)
+        report[suffix] = {"max_abs_diff": int(diff.max()),
+                          "pixels_differing": float((diff > 0).mean())}
+    return report
+
+
+def throughput(images, batch_sizes=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+               repeats=3):
+    """Images per second of every kernel at each batch size"""
+    results = {}
+    for size in batch_sizes:
+        batch = np.resize(images, (size,) + images.shape[1:])
+        results[size] = {}
+        for suffix, kernel in BATCH_AUGMENTATIONS.items():
+            best = float("inf")
+            for _ in range(repeats):
+                start = time.perf_counter()
+                kernel(batch)
+                best = min(best, time.perf_counter() - start)
+            results[size][suffix] = size / best if best else 0.0
+    return results
+
+
+def pil_throughput(images):
+    """Images per second of the PIL functions, one image at a time"""
+    pictures = [Image.fromarray(img) for img in images]
+    results = {}
+    for suffix, reference in pil_references().items():
+        start = time.perf_counter()
+        for picture in pictures:
+            reference(picture)
+        elapsed = time.perf_counter() - start
+        results[suffix] = len(pictures) / elapsed if elapsed else 0.0
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='augment_batch.py',
+        description='Check the batch augmentation kernels against PIL and '
+                    'measure their throughput'
+    )
+    parser.add_argument("pictures", nargs="*",
+                        help="Same-sized pictures to test with (default: "
+                             "random 256x256 images)")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16, 32, 64, 128, 256],
+                        help="Batch sizes to time (default: 1 to 256)")
+    args = parser.parse_args()
+
+    if args.pictures:
+        images = load_batch(args.pictures)
+    else:
+        rng = np.random.default_rng(0)
+        images = rng.integers(0, 256, (8, 256, 256, 3), dtype=np.uint8)
+
+    print("Difference against PIL:")
+    for suffix, diff in verify(images).items():
+        print("  {:<12} max {:>3}  pixels {:.4%}".format(
+            suffix, diff["max_abs_diff"], diff["pixels_differing"]))
+
+    print("\nThroughput (images/sec):")
+    print("  {:>5} ".format("batch") + " ".join(
+        "{:>11}".format(s) for s in BATCH_AUGMENTATIONS))
+    row = pil_throughput(images)
+    print("  {:>5} ".format("PIL") + " ".join(
+        "{:>11.0f}".format(row[s]) for s in BATCH_AUGMENTATIONS))
+    for size, row in throughput(images, args.sizes).items():
+        print("  {:>5} ".format(size) + " ".join(
+            "{:>11.0f}".format(row[s]) for s in BATCH_AUGMENTATIONS))
@@ -0,0 +1,244 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+from os.path import join, splitext
+from PIL import Image
+from Augmentation import AUGMENTATION_STEPS, augment_with_params
+from image_cache import load_image
+from instrumentation import file_size, span, timed
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get(
+    "LEAFFLICTION_AUGMENT_CACHE",
+    join(os.path.expanduser("~"), ".cache", "leaffliction", "augmentations"))
+STEPS = {suffix: (op, params) for suffix, op, params in AUGMENTATION_STEPS}
+RANDOM_SUFFIX = "_Random{}"
+DIGEST_EXT = ".sha256"
+DERIVED_PATTERN = re.compile(
+    "({}|_Random\\d+)$".format("|".join(re.escape(s) for s in STEPS)))
+
+
+def is_derived(path):
+    """True for pictures written by an augmentation, e.g. leaf_Rotate.JPG"""
+    return bool(DERIVED_PATTERN.search(splitext(os.path.basename(path))[0]))
+
+
+def cache_key(source_hash, suffix, params):
+    payload = json.dumps([CACHE_VERSION, source_hash, suffix, params],
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class AugmentationCache:
+    """Augmented pictures stored under a key derived from their inputs
+
+    The key combines the source content hash, the augmentation and its
+    parameters, so an entry stays valid for as long as the bytes it was
+    made from exist anywhere. Each entry has a sidecar with the SHA-256
+    of its bytes, checked on every lookup: outputs hard-linked to an
+    entry share its bytes, so editing one in place would otherwise serve
+    the edit as the cached result. Eviction goes by last access time
+    where the filesystem keeps it, falling back to creation order.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        self.root = root
+
+    def path_for(self, key, ext):
+        return join(self.root, key[:2], key + ext.lower())
+
+    def lookup(self, key, ext):
+        """Path of the entry if it matches its digest, else None
+
+        An entry that no longer matches, or was stored without a digest,
+        is removed so the caller computes and stores it again.
+        """
+        path = self.path_for(key, ext)
+        try:
+            with open(path + DIGEST_EXT) as f:
+                digest = f.read().strip()
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if hashlib.sha256(data).hexdigest() != digest:
+            self.remove(path)
+            return None
+        return path
+
+    def store(self, image, key, ext):
+        path = self.path_for(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        image.save(buffer, format=Image.registered_extensions()[ext.lower()])
+        data = buffer.getvalue()
+        # The digest lands first, so a visible entry always has one
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(hashlib.sha256(data).hexdigest())
+        os.replace(tmp_path, path + DIGEST_EXT)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def remove(self, path):
+        for name in (path, path + DIGEST_EXT):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        """(path, size, last use, other links) of every entry"""
+        for dirpath, _, files in os.walk(self.root):
+            for f in files:
+                if f.endswith((DIGEST_EXT, ".tmp")):
+                    continue
+                path = join(dirpath, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield (path, st.st_size, max(st.st_atime, st.st_mtime),
+                       st.st_nlink - 1)
+
+    def size(self):
+        return sum(size for _, size, _, _ in self.entries())
+
+    def evict(self, max_bytes):
+        """Delete the least recently used entries until under max_bytes
+
+        Entries hard-linked to an output are kept and counted apart:
+        deleting them would free no disk space while the output exists.
+        Returns (entries removed, bytes left, bytes shared with outputs).
+        """
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _, links in entries if not links)
+        linked = sum(size for _, size, _, links in entries if links)
+        removed = 0
+        for path, size, _, links in entries:
+            if total <= max_bytes:
+                break
+            if links:
+                continue
+            self.remove(path)
+            total -= size
+            removed += 1
+        return removed, total, linked
+
+
+def materialize(cache_path, output_path, link=False):
+    """Copy a cache entry to output_path
+
+    With link, hard-link it instead where the filesystem allows: no copy
+    is written, but the entry then stays on disk while the output exists.
+    """
+    tmp_path = output_path + ".tmp"
+    if link:
+        try:
+            os.link(cache_path, tmp_path)
+        except OSError:
+            link = False
+    if not link:
+        shutil.copyfile(cache_path, tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+def fixed_tasks(suffixes):
+    """(suffix, params) tasks for the fixed Augmentation.py steps"""
+    return [(suffix, STEPS[suffix][1]) for suffix in suffixes]
+
+
+def apply_task(image, suffix, params):
+    if suffix in STEPS:
+        return STEPS[suffix][0](image)
+    return augment_with_params(image, params)
+
+
+@timed("augment_source")
+def augment_with_cache(source, tasks, cache_dir=DEFAULT_CACHE_DIR,
+                       link=False):
+    """Write the (suffix, params) augmentations of source, reusing cache
+
+    The source is read once; it is only decoded if at least one result is
+    not cached. Without a cache_dir every result is computed and saved
+    directly. Results are copied out of the cache, or hard-linked with
+    link. Returns (pictures written, cache hits).
+    """
+    with open(source, "rb") as f, span("read") as s:
+        data = f.read()
+        s.bytes_read = len(data)
+    name, ext = splitext(source)
+    image = None
+    hits = 0
+    if cache_dir:
+        cache = AugmentationCache(cache_dir)
+        source_hash = hashlib.sha256(data).hexdigest()
+    for suffix, params in tasks:
+        cached = None
+        if cache_dir:
+            key = cache_key(source_hash, suffix, params)
+            cached = cache.lookup(key, ext)
+        if cached:
+            hits += 1
+        else:
+            if image is None:
+                image = Image.fromarray(load_image(source))
+            augmented = apply_task(image, suffix, params)
+            with span("encode_save") as s:
+                if not cache_dir:
+                    augmented.save(name + suffix + ext)
+                    if s:
+                        s.bytes_written = file_size(name + suffix + ext)
+                    continue
+                cached = cache.store(augmented, key, ext)
+                if s:
+                    s.bytes_written = file_size(cached)
+        with span("cache_copy"):
+            materialize(cached, name + suffix + ext, link)
+    return len(tasks), hits
+
+
+def parse_size(value):
+    units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?", value.upper())
+    if not match:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(value))
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='augmentation_cache.py',
+        description='Inspect or shrink the augmentation cache.'
+    )
+    parser.add_argument("--cache", default=DEFAULT_CACHE_DIR,
+                        help="Cache directory (default: {})".format(
+                            DEFAULT_CACHE_DIR))
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("info", help="Show the number and size of entries")
+    clean = sub.add_parser("clean",
+                           help="Evict least recently used entries")
+    clean.add_argument("--max-size", type=parse_size, default=0,
+                       help="Size to shrink the cache to, e.g. 500M or 2G; "
+                            "entries hard-linked into a dataset are kept "
+                            "(default: 0, empty the cache)")
+    args = parser.parse_args()
+
+    cache = AugmentationCache(args.cache)
+    if args.command == "info":
+        entries = list(cache.entries())
+        print("{} entries, {:.1f} MB in {} ({:.1f} MB hard-linked into "
+              "datasets)".format(
+                  len(entries), sum(e[1] for e in entries) / 1e6,
+                  args.cache, sum(e[1] for e in entries if e[3]) / 1e6))
+    else:
+        removed, total, linked = cache.evict(args.max_size)
+        print("Removed {} entries, {:.1f} MB left, {:.1f} MB more "
+              "hard-linked into datasets".format(
+                  removed, total / 1e6, linked / 1e6))
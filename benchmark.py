@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+from PIL import Image, ImageDraw
+
+STAGES = ("augmentation", "augmentation_batch", "balancing",
+          "transformation", "transformation_fast", "training_input",
+          "inference")
+
+
+def make_synthetic_dataset(root, classes=4, images=20, resolution=256,
+                           seed=0):
+    """Write class folders of random leaf-like ellipses on a light ground
+
+    Class i gets images // (i + 1) pictures so the set is unbalanced,
+    which gives the balancing stage real work to do.
+    """
+    rng = np.random.default_rng(seed)
+    for c in range(classes):
+        class_dir = os.path.join(root, "class_{}".format(c))
+        os.makedirs(class_dir, exist_ok=True)
+        for i in range(max(1, images // (c + 1))):
+            img = Image.new("RGB", (resolution, resolution),
+                            tuple(int(v) for v in rng.integers(200, 255, 3)))
+            draw = ImageDraw.Draw(img)
+            cx, cy = rng.integers(resolution // 3, 2 * resolution // 3, 2)
+            rx, ry = rng.integers(resolution // 6, resolution // 3, 2)
+            leaf = (int(rng.integers(20, 80)), int(rng.integers(100, 200)),
+                    int(rng.integers(20, 80)))
+            draw.ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=leaf)
+            for _ in range(int(rng.integers(0, 6))):
+                sx, sy = rng.integers(cx - rx // 2, cx + rx // 2 + 1, 2)
+                r = int(rng.integers(2, max(3, resolution // 32)))
+                draw.ellipse((sx - r, sy - r, sx + r, sy + r),
+                             fill=(90 + 20 * c, 60, 30))
+            img.save(os.path.join(class_dir, "img_{:04d}.JPG".format(i)))
+    return root
+
+
+def list_dataset(root):
+    """Return (paths, class_names) without importing TensorFlow"""
+    class_names = sorted(os.listdir(root))
+    paths = [os.path.join(root, c, f) for c in class_names
+             for f in sorted(os.listdir(os.path.join(root, c)))]
+    return paths, class_names
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def time_model(model, batch, repeats=10):
+    """Median seconds per predict_on_batch call after one warm-up call"""
+    model.predict_on_batch(batch)
+    return float(np.median([timed(model.predict_on_batch, batch)[0]
+                            for _ in range(repeats)]))
+
+
+def bench_augmentation(data_dir, work_dir, limit=50):
+    from Augmentation import AUGMENTATIONS
+
+    paths = list_dataset(data_dir)[0][:limit]
+    aug_dir = os.path.join(work_dir, "augmentation")
+    os.makedirs(aug_dir, exist_ok=True)
+    copies = []
+    for i, path in enumerate(paths):
+        copies.append(os.path.join(aug_dir, "{}.JPG".format(i)))
+        shutil.copy(path, copies[-1])
+    results = {}
+    for augmentation in AUGMENTATIONS:
+        elapsed = 0.0
+        for path in copies:
+            with Image.open(path) as img:
+                img.load()
+                seconds, _ = timed(augmentation, img)
+                elapsed += seconds
+        results[augmentation.__name__] = {
+            "images": len(copies),
+            "seconds": elapsed,
+            "ms_per_image": elapsed / len(copies) * 1000,
+        }
+    return results
+
+
+def bench_augmentation_batch(data_dir, limit=32,
+                             batch_sizes=(1, 8, 32, 128, 256)):
+    from augment_batch import load_batch, throughput, verify
+
+    paths = list_dataset(data_dir)[0][:limit]
+    images = load_batch(paths)
+    return {
+        "difference_vs_pil": verify(images),
+        "images_per_sec": {str(size): row for size, row in
+                           throughput(images, batch_sizes).items()},
+    }
+
+
+def bench_balancing(data_dir, work_dir, workers=None):
+    from Balance_Dataset import balance_dataset
+    from dataset_index import DatasetIndex
+
+    balance_dir = os.path.join(work_dir, "balancing")
+    shutil.copytree(data_dir, balance_dir)
+    before = sum(DatasetIndex.scan(balance_dir).counts().values())
+    seconds, _ = timed(balance_dataset, balance_dir, workers, None)
+    after = sum(DatasetIndex.scan(balance_dir).counts().values())
+    created = after - before
+    return {
+        "images_created": created,
+        "seconds": seconds,
+        "images_per_sec": created / seconds if seconds else 0.0,
+    }
+
+
+def bench_transformation(data_dir, work_dir, limit=20):
+    from plantcv import plantcv as pcv
+    from Transformation import TRANSFORMATIONS, TransformationPipeline
+
+    paths = list_dataset(data_dir)[0][:limit]
+    results = {}
+    decode = 0.0
+    for path in paths:
+        seconds, _ = timed(lambda: TransformationPipeline(path).color_img)
+        decode += seconds
+    results["decode"] = {"images": len(paths),
+                         "ms_per_image": decode / len(paths) * 1000}
+    for name, (method, _) in TRANSFORMATIONS.items():
+        elapsed = 0.0
+        for path in paths:
+            pipeline = TransformationPipeline(path)
+            pipeline.color_img
+            seconds, _ = timed(method, pipeline)
+            elapsed += seconds
+        results[name] = {"images": len(paths),
+                         "ms_per_image": elapsed / len(paths) * 1000}
+    full_dir = os.path.join(work_dir, "transformation")
+    os.makedirs(full_dir, exist_ok=True)
+    seconds, _ = timed(lambda: [TransformationPipeline(p).save(
+        outdir=full_dir) for p in paths])
+    results["all_with_save"] = {"images": len(paths),
+                                "ms_per_image": seconds / len(paths) * 1000}
+    pcv.outputs.clear()
+    return results
+
+
+def bench_transformation_fast(data_dir, work_size=256, limit=20):
+    """Full resolution against the fast path, with the latter's fidelity"""
+    from plantcv import plantcv as pcv
+    from Transformation import (TRANSFORMATIONS, FastTransformationPipeline,
+                                TransformationPipeline, fidelity)
+
+    def run_all(pipeline):
+        for method, _ in TRANSFORMATIONS.values():
+            getattr(pipeline, method.__name__)()
+        pipeline.features()
+        return pipeline
+
+    paths = list_dataset(data_dir)[0][:limit]
+    full_seconds = fast_seconds = 0.0
+    reports = []
+    for path in paths:
+        seconds, full = timed(run_all, TransformationPipeline(path))
+        full_seconds += seconds
+        seconds, fast = timed(run_all,
+                              FastTransformationPipeline(path, work_size))
+        fast_seconds += seconds
+        reports.append(fidelity(full, fast))
+    pcv.outputs.clear()
+    with Image.open(paths[0]) as img:
+        resolution = max(img.size)
+    results = {
+        "images": len(paths),
+        "resolution": resolution,
+        "work_size": work_size,
+        "full_ms_per_image": full_seconds / len(paths) * 1000,
+        "fast_ms_per_image": fast_seconds / len(paths) * 1000,
+        "speedup": full_seconds / fast_seconds if fast_seconds else 0.0,
+        "fidelity": {},
+    }
+    for key, value in reports[0].items():
+        if key == "measurements":
+            values = {name: [r[key][name] for r in reports
+                             if name in r[key]] for name in value}
+            results["fidelity"][key] = {
+                name: {"mean": float(np.mean(v)), "max": float(np.max(v))}
+                for name, v in values.items()}
+        else:
+            v = [r[key] for r in reports]
+            results["fidelity"][key] = {"mean": float(np.mean(v)),
+                                        "min": float(np.min(v)),
+                                        "max": float(np.max(v))}
+    return results
+
+
+def bench_training_input(data_dir, steps=10, batch_size=32):
+    import train
+
+    results = {}
+    loaders = {
+        "generator": lambda: train.make_generators(
+            data_dir, batch_size=batch_size)[0],
+        "tfdata": lambda: iter(train.make_tf_datasets(
+            data_dir, batch_size=batch_size)[0].repeat()),
+    }
+    for name, build in loaders.items():
+        batches = build()
+        next(batches)
+        seconds, _ = timed(lambda: [next(batches) for _ in range(steps)])
+        results[name] = {
+            "steps": steps,
+            "batch_size": batch_size,
+            "steps_per_sec": steps / seconds if seconds else 0.0,
+        }
+    return results
+
+
+def bench_inference(data_dir, model_path=None, batch_sizes=(1, 8, 32),
+                    repeats=5):
+    import predict
+    from train import create_model
+
+    paths, class_names = list_dataset(data_dir)
+    if model_path:
+        seconds, model = timed(predict.load_model, model_path)
+    else:
+        seconds, model = timed(create_model, len(class_names),
+                               weights=None)
+    results = {"model": model_path or "untrained MobileNetV2",
+               "load_seconds": seconds}
+    images = np.stack([predict.load_and_preprocess(p)
+                       for p in paths[:max(batch_sizes)]])
+    for n in batch_sizes:
+        batch = np.resize(images, (n,) + images.shape[1:])
+        median = time_model(model, batch, repeats)
+        results["batch_{}".format(n)] = {
+            "latency_ms": median * 1000,
+            "images_per_sec": n / median if median else 0.0,
+        }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(stages=STAGES, classes=4, images=20, resolution=256,
+                   model_path=None, steps=10, workers=None, work_size=256,
+                   fast_resolution=1024):
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "dataset": {"classes": classes, "images": images,
+                    "resolution": resolution},
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="leaffliction_bench_") as tmp:
+        data_dir = make_synthetic_dataset(os.path.join(tmp, "images"),
+                                          classes, images, resolution)
+
+        def fast_data_dir():
+            # The fast path only differs once it has something to shrink
+            if fast_resolution == resolution:
+                return data_dir
+            return make_synthetic_dataset(os.path.join(tmp, "images_fast"),
+                                          classes, images, fast_resolution)
+
+        runners = {
+            "augmentation": lambda: bench_augmentation(data_dir, tmp),
+            "augmentation_batch": lambda: bench_augmentation_batch(
+                data_dir),
+            "balancing": lambda: bench_balancing(data_dir, tmp, workers),
+            "transformation": lambda: bench_transformation(data_dir, tmp),
+            "transformation_fast": lambda: bench_transformation_fast(
+                fast_data_dir(), work_size),
+            "training_input": lambda: bench_training_input(data_dir, steps),
+            "inference": lambda: bench_inference(data_dir, model_path),
+        }
+        for stage in stages:
+            print("Benchmarking {}...".format(stage))
+            report["results"][stage] = runners[stage]()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='benchmark.py',
+        description='Time every pipeline stage on a synthetic dataset and '
+                    'write the results as JSON'
+    )
+    parser.add_argument("--stages", nargs="+", choices=STAGES,
+                        default=list(STAGES),
+                        help="Stages to run (default: all)")
+    parser.add_argument("--classes", type=int, default=4,
+                        help="Synthetic classes (default: 4)")
+    parser.add_argument("--images", type=int, default=20,
+                        help="Images in the largest class (default: 20)")
+    parser.add_argument("--resolution", type=int, default=256,
+                        help="Synthetic image side in pixels (default: 256)")
+    parser.add_argument("--model",
+                        help="Model for the inference stage (default: an "
+                             "untrained network of the same architecture)")
+    parser.add_argument("--steps", type=int, default=10,
+                        help="Training input batches to time (default: 10)")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="Balancing processes (default: all CPUs)")
+    parser.add_argument("--work-size", type=int, default=256,
+                        help="Working resolution of the transformation_fast "
+                             "stage (default: 256)")
+    parser.add_argument("--fast-resolution", type=int, default=1024,
+                        help="Synthetic image side of the transformation_fast "
+                             "stage, above --work-size (default: 1024)")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help="JSON report path (default: benchmark.json)")
+    args = parser.parse_args()
+    if args.fast_resolution <= args.work_size:
+        parser.error("--fast-resolution must exceed --work-size, or the "
+                     "fast path has nothing to downsample")
+
+    report = run_benchmarks(args.stages, args.classes, args.images,
+                            args.resolution, args.model, args.steps,
+                            args.workers, args.work_size,
+                            args.fast_resolution)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Benchmark results written to {}".format(args.output))
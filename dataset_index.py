@@ -0,0 +1,136 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+INDEX_NAME = ".dataset_index.json"
+INDEX_VERSION = 1
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Timestamp granularity allowed for, as in git: 2 s covers FAT and NFS
+RACY_WINDOW_NS = 2 * 10**9
+
+
+def image_size(path):
+    """Width and height from the file header, without decoding pixels"""
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except OSError:
+        return None, None
+
+
+def scan_class(class_dir, previous=None):
+    """Index one class directory, reusing entries of unchanged files
+
+    previous is this directory's entry from the last manifest. When the
+    directory mtime is unchanged no file was added, removed or renamed,
+    so the old entry is returned without listing the directory.
+
+    As in git's racy-clean check, an mtime is only trusted when it is
+    older than the scan that recorded it by more than RACY_WINDOW_NS.
+    On filesystems with coarse timestamps (NFS, FAT) a change made in
+    the same tick as the scan would otherwise leave the mtime unchanged
+    and be missed for good.
+    """
+    scanned = time.time_ns()
+    scanned_before = previous.get("scanned_ns", 0) if previous else 0
+
+    def settled(mtime_ns):
+        return mtime_ns + RACY_WINDOW_NS < scanned_before
+
+    dir_mtime = os.stat(class_dir).st_mtime_ns
+    if (previous and previous["mtime_ns"] == dir_mtime and
+            settled(dir_mtime)):
+        return previous
+    old_files = previous["files"] if previous else {}
+    files = {}
+    with os.scandir(class_dir) as entries:
+        for entry in entries:
+            if not (entry.name.lower().endswith(IMAGE_EXTENSIONS) and
+                    entry.is_file()):
+                continue
+            st = entry.stat()
+            old = old_files.get(entry.name)
+            if (old and old[0] == st.st_size and
+                    old[1] == st.st_mtime_ns and settled(st.st_mtime_ns)):
+                files[entry.name] = old
+            else:
+                width, height = image_size(entry.path)
+                files[entry.name] = [st.st_size, st.st_mtime_ns,
+                                     width, height]
+    return {"mtime_ns": dir_mtime, "scanned_ns": scanned, "files": files}
+
+
+class DatasetIndex:
+    """Manifest of every image of an images/<class>/ tree
+
+    Each class stores its directory mtime, when it was scanned and, per
+    file, its size, mtime, width and height. The manifest lives in the
+    dataset root and is refreshed incrementally: only class directories
+    whose mtime changed, or changed too close to the last scan to be
+    trusted, are listed again, and only new or modified files are opened.
+    """
+
+    def __init__(self, root, classes):
+        self.root = root
+        self.classes = classes
+
+    @classmethod
+    def load(cls, root):
+        path = os.path.join(root, INDEX_NAME)
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return cls(root, {})
+        if manifest.get("version") != INDEX_VERSION:
+            return cls(root, {})
+        return cls(root, manifest["classes"])
+
+    @classmethod
+    def scan(cls, root, workers=8, persist=True):
+        """Load the manifest of root, bring it up to date and save it"""
+        previous = cls.load(root).classes
+        with os.scandir(root) as entries:
+            names = sorted(e.name for e in entries if e.is_dir())
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            scanned = pool.map(
+                lambda n: scan_class(os.path.join(root, n), previous.get(n)),
+                names)
+            index = cls(root, dict(zip(names, scanned)))
+        if persist and index.classes != previous:
+            index.save()
+        return index
+
+    def save(self):
+        path = os.path.join(self.root, INDEX_NAME)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"version": INDEX_VERSION,
+                           "classes": self.classes}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # A read-only dataset can still be indexed, just not cached
+            print("Warning: could not save dataset index: {}".format(e))
+
+    def counts(self):
+        return {name: len(entry["files"])
+                for name, entry in self.classes.items()}
+
+    def images(self, class_name):
+        """Sorted image paths of one class"""
+        class_dir = os.path.join(self.root, class_name)
+        return [os.path.join(class_dir, f)
+                for f in sorted(self.classes[class_name]["files"])]
+
+    def records(self):
+        """Yield one dict per image: path, class, size, mtime, dimensions"""
+        for class_name, entry in self.classes.items():
+            for name, (size, mtime_ns, width, height) in sorted(
+                    entry["files"].items()):
+                yield {"path": os.path.join(self.root, class_name, name),
+                       "class": class_name, "size": size,
+                       "mtime_ns": mtime_ns, "width": width,
+                       "height": height}
@@ -0,0 +1,533 @@
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import numpy as np
+
+# Keys a config file may set; anything missing takes these values
+DEFAULT_CONFIG = {
+    "workers": 2,
+    "data_dir": "./images",
+    "output_dir": "./model",
+    "checkpoint_dir": None,
+    "epochs": 10,
+    "batch_size": 32,
+    "img_size": 224,
+    "validation_split": 0.2,
+    "seed": 123,
+    "lr_schedule": "constant",
+    "intra_threads": 0,
+    "inter_threads": 0,
+    "precision": "float32",
+}
+
+
+def load_config(path, **overrides):
+    """Read a JSON training config, filling in DEFAULT_CONFIG
+
+    workers is either a number of local processes or the list of
+    "host:port" addresses of every worker, chief first. batch_size is per
+    worker. checkpoint_dir must be on storage every worker can reach
+    (default: <output_dir>/checkpoints).
+    """
+    with open(path) as f:
+        config = dict(DEFAULT_CONFIG, **json.load(f))
+    config.update((k, v) for k, v in overrides.items() if v is not None)
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError("unknown config keys: {}".format(
+            ", ".join(sorted(unknown))))
+    if not config["checkpoint_dir"]:
+        config["checkpoint_dir"] = os.path.join(config["output_dir"],
+                                                "checkpoints")
+    return config
+
+
+# What CheckpointManager writes, the scratch directories of non-chief
+# workers, and the per-run directories of a scaling launch
+CHECKPOINT_FILE = re.compile(r"checkpoint|ckpt-\d+\.(index|data-\d+-of-\d+)")
+SCRATCH_DIR = re.compile(r"worker-\d+")
+RUN_DIR = re.compile(r"workers-\d+")
+
+
+def stale_checkpoints(checkpoint_dir):
+    """Paths of the checkpoints a fresh run in checkpoint_dir deletes
+
+    Directories of other runs of a scaling launch are left alone. Raises
+    ValueError when checkpoint_dir holds anything else this code did not
+    write, so pointing it at other data never wipes that data.
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    paths, foreign = [], []
+    for name in sorted(os.listdir(checkpoint_dir)):
+        path = os.path.join(checkpoint_dir, name)
+        if not os.path.isdir(path):
+            ours = CHECKPOINT_FILE.fullmatch(name)
+        elif RUN_DIR.fullmatch(name):
+            continue
+        else:
+            ours = SCRATCH_DIR.fullmatch(name) and all(
+                CHECKPOINT_FILE.fullmatch(f) for f in os.listdir(path))
+        if ours:
+            paths.append(path)
+        else:
+            foreign.append(name)
+    if foreign:
+        raise ValueError("checkpoint_dir {} also holds {}; give training a "
+                         "directory of its own".format(
+                             checkpoint_dir, ", ".join(foreign)))
+    return paths
+
+
+def tf_config(addresses, index):
+    return json.dumps({"cluster": {"worker": list(addresses)},
+                       "task": {"type": "worker", "index": index}})
+
+
+def split_sources(config):
+    """Return (train, val, class_names) for a class tree or shard dir
+
+    train and val are (paths, labels) for a class tree and index arrays
+    for a shards.py directory, split with the same seed on every worker.
+    """
+    from shards import ShardDataset, is_shard_dir
+
+    if is_shard_dir(config["data_dir"]):
+        dataset = ShardDataset(config["data_dir"])
+        dataset.check_resize()
+        train_idx, val_idx = dataset.split(config["validation_split"],
+                                           config["seed"])
+        return train_idx, val_idx, dataset.class_names
+
+    from feature_cache import list_images
+
+    paths, labels, class_names = list_images(config["data_dir"])
+    paths = np.array(paths)
+    order = np.random.default_rng(config["seed"]).permutation(len(paths))
+    num_val = int(len(paths) * config["validation_split"])
+    val, train = np.sort(order[:num_val]), np.sort(order[num_val:])
+    return ((paths[train], labels[train]), (paths[val], labels[val]),
+            class_names)
+
+
+def source_dataset(config, source, num_classes, batch_size, shard=None,
+                   shuffle=False):
+    """Batched (images, one-hot labels) of one split, before preprocessing
+
+    shard is (count, index): the split is cut before any file is read, so
+    each worker only decodes its own share.
+    """
+    import tensorflow as tf
+    from shards import ShardDataset, is_shard_dir
+
+    count, index = shard or (1, 0)
+    size = config["img_size"]
+    if is_shard_dir(config["data_dir"]):
+        dataset = ShardDataset(config["data_dir"])
+        ds = dataset.as_tf_dataset(source[index::count], batch_size,
+                                   shuffle, config["seed"] + index)
+        if dataset.size != size:
+            ds = ds.map(lambda images, labels: (
+                tf.image.resize(images, (size, size), method="nearest"),
+                labels))
+        return ds
+
+    paths, labels = source
+    ds = tf.data.Dataset.from_tensor_slices(
+        (paths[index::count], labels[index::count]))
+    if shuffle:
+        ds = ds.shuffle(len(paths) // count + 1, seed=config["seed"] + index)
+
+    def load(path, label):
+        image = tf.io.decode_image(tf.io.read_file(path), channels=3,
+                                   expand_animations=False)
+        # Nearest, as train.py and predict.py resize
+        image = tf.image.resize(image, (size, size), method="nearest")
+        return image, tf.one_hot(label, num_classes)
+
+    return ds.map(load, num_parallel_calls=tf.data.AUTOTUNE).batch(
+        batch_size)
+
+
+def train_worker(config, resume=False):
+    """Run one worker of a MultiWorkerMirroredStrategy training
+
+    The cluster comes from TF_CONFIG. Every worker trains on its own
+    shard of the training split with synchronous gradient all-reduce, and
+    runs the same number of steps per epoch (whole batches of the
+    smallest shard). The chief validates, logs and writes the models;
+    every epoch all workers write a checkpoint of the model, optimizer and
+    epoch. With resume an interrupted run continues from that checkpoint,
+    otherwise the chief deletes it and training starts over.
+    """
+    import tensorflow as tf
+    from train import configure_runtime
+
+    configure_runtime(config["intra_threads"], config["inter_threads"],
+                      config["precision"])
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+
+    from tensorflow import keras
+    from model_bundle import (write_class_names, write_manifest,
+                              write_validation_files)
+    from train import (augment_dataset, create_model, learning_rate,
+                       preprocess_dataset)
+
+    task = json.loads(os.environ["TF_CONFIG"])["task"]
+    workers = strategy.num_replicas_in_sync
+    is_chief = task["index"] == 0
+    output_dir = config["output_dir"]
+    size = config["img_size"]
+    batch_size = config["batch_size"]
+    global_batch = batch_size * workers
+    os.makedirs(output_dir, exist_ok=True)
+    # Other workers only touch the directory once the first step, a
+    # collective the chief joins after this, has run
+    if is_chief and not resume:
+        for path in stale_checkpoints(config["checkpoint_dir"]):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    os.makedirs(config["checkpoint_dir"], exist_ok=True)
+
+    train_source, val_source, class_names = split_sources(config)
+    num_classes = len(class_names)
+    num_train = len(train_source if isinstance(train_source, np.ndarray)
+                    else train_source[1])
+    steps = num_train // workers // batch_size
+    if not steps:
+        raise ValueError("{} training images cannot fill a batch of {} "
+                         "on each of {} workers".format(
+                             num_train, batch_size, workers))
+
+    def make_train(context):
+        ds = source_dataset(config, train_source, num_classes, batch_size,
+                            (context.num_input_pipelines,
+                             context.input_pipeline_id), shuffle=True)
+        ds = ds.unbatch().batch(batch_size, drop_remainder=True)
+        return augment_dataset(ds).repeat().prefetch(tf.data.AUTOTUNE)
+
+    train_ds = iter(strategy.distribute_datasets_from_function(make_train))
+    val_ds = None
+    if is_chief:
+        val_ds = preprocess_dataset(source_dataset(
+            config, val_source, num_classes, batch_size)).cache()
+
+    keras.utils.set_random_seed(config["seed"])
+    with strategy.scope():
+        model = create_model(num_classes, size, size)
+        optimizer = keras.optimizers.Adam(learning_rate(
+            global_batch, steps, config["epochs"], config["lr_schedule"]))
+        optimizer.build(model.trainable_variables)
+        epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer,
+                                     epoch=epoch)
+    latest = None
+    if resume:
+        latest = tf.train.latest_checkpoint(config["checkpoint_dir"])
+        if latest is None:
+            raise ValueError("no checkpoint to resume in {}".format(
+                config["checkpoint_dir"]))
+        checkpoint.restore(latest)
+        if int(epoch.numpy()) >= config["epochs"]:
+            raise ValueError("{} already finished {} of {} epochs; start "
+                             "over without --resume".format(
+                                 latest, int(epoch.numpy()),
+                                 config["epochs"]))
+        print("Worker {}: resuming from {} at epoch {}".format(
+            task["index"], latest, int(epoch.numpy())))
+
+    # Non-chief workers must take part in saving but write to a scratch
+    # directory that is thrown away
+    save_dir = config["checkpoint_dir"] if is_chief else os.path.join(
+        config["checkpoint_dir"], "worker-{}".format(task["index"]))
+    manager = tf.train.CheckpointManager(checkpoint, save_dir,
+                                         max_to_keep=2)
+
+    @tf.function
+    def train_step(iterator):
+        def step(images, labels):
+            with tf.GradientTape() as tape:
+                probs = model(images, training=True)
+                loss = tf.nn.compute_average_loss(
+                    keras.losses.categorical_crossentropy(labels, probs),
+                    global_batch_size=global_batch)
+            grads = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            correct = tf.reduce_sum(tf.cast(tf.equal(
+                tf.argmax(probs, -1), tf.argmax(labels, -1)), tf.float32))
+            return loss, correct
+
+        loss, correct = strategy.run(step, args=next(iterator))
+        return (strategy.reduce("SUM", loss, axis=None),
+                strategy.reduce("SUM", correct, axis=None))
+
+    @tf.function
+    def val_step(images, labels):
+        probs = model(images, training=False)
+        loss = keras.losses.categorical_crossentropy(labels, probs)
+        correct = tf.equal(tf.argmax(probs, -1), tf.argmax(labels, -1))
+        return tf.reduce_sum(loss), tf.reduce_sum(tf.cast(correct,
+                                                          tf.float32))
+
+    state_path = os.path.join(output_dir, "distributed_profile.json")
+    log_path = os.path.join(output_dir, "training_log.csv")
+    if is_chief:
+        print("{} workers, global batch {}, {} steps per epoch".format(
+            workers, global_batch, steps))
+        write_class_names(output_dir, class_names)
+        write_validation_files(
+            output_dir, config["data_dir"],
+            None if isinstance(val_source, np.ndarray) else val_source[0])
+        profile = {"workers": workers, "global_batch_size": global_batch,
+                   "steps_per_epoch": steps, "epochs": [],
+                   "best_val_accuracy": 0.0}
+        if latest and os.path.exists(state_path):
+            with open(state_path) as f:
+                profile = json.load(f)
+        elif os.path.exists(log_path):
+            os.remove(log_path)
+
+    while int(epoch.numpy()) < config["epochs"]:
+        start = time.perf_counter()
+        total_loss = total_correct = 0.0
+        for _ in range(steps):
+            loss, correct = train_step(train_ds)
+            total_loss += float(loss)
+            total_correct += float(correct)
+        elapsed = time.perf_counter() - start
+        epoch.assign_add(1)
+
+        if is_chief:
+            val_loss = val_correct = val_count = 0.0
+            for images, labels in val_ds:
+                loss, correct = val_step(images, labels)
+                val_loss += float(loss)
+                val_correct += float(correct)
+                val_count += int(labels.shape[0])
+            row = {
+                "epoch": int(epoch.numpy()) - 1,
+                "accuracy": total_correct / (steps * global_batch),
+                "examples_per_sec": steps * global_batch / elapsed,
+                "loss": total_loss / steps,
+                "val_accuracy": val_correct / val_count if val_count else 0,
+                "val_loss": val_loss / val_count if val_count else 0,
+            }
+            print("Epoch {}/{}: loss {:.4f}, accuracy {:.4f}, val_accuracy "
+                  "{:.4f}, {:.1f} examples/sec".format(
+                      row["epoch"] + 1, config["epochs"], row["loss"],
+                      row["accuracy"], row["val_accuracy"],
+                      row["examples_per_sec"]), flush=True)
+            new_log = not os.path.exists(log_path)
+            with open(log_path, "a", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=sorted(row))
+                if new_log:
+                    writer.writeheader()
+                writer.writerow(row)
+            if row["val_accuracy"] > profile["best_val_accuracy"]:
+                profile["best_val_accuracy"] = row["val_accuracy"]
+                model.save(os.path.join(output_dir, "best_model.keras"))
+            profile["epochs"].append(row)
+
+        manager.save()
+        if is_chief:
+            with open(state_path, "w") as f:
+                json.dump(profile, f, indent=2)
+
+    if is_chief:
+        model.save(os.path.join(output_dir, "final_model.keras"))
+        # best_model.keras is only this run's once an epoch beat 0
+        models = ["final_model.keras"]
+        if profile["best_val_accuracy"] > 0:
+            models.insert(0, "best_model.keras")
+        write_manifest(output_dir, class_names, models, size, size,
+                       config["data_dir"], (1, batch_size))
+        print("Models saved to {}/".format(output_dir))
+    else:
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+
+def free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def wait_workers(processes, interval=0.2):
+    """Wait for (Popen, log file) pairs; False once any of them fails
+
+    The survivors of a failed worker would block in their next
+    collective, so they are all watched at once and the rest terminated
+    at the first non-zero exit.
+    """
+    failed = False
+    try:
+        running = [process for process, _ in processes]
+        while running and not failed:
+            time.sleep(interval)
+            for process in list(running):
+                if process.poll() is not None:
+                    running.remove(process)
+                    failed |= process.returncode != 0
+    finally:
+        for process, _ in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process, log in processes:
+            process.wait()
+            if log:
+                log.close()
+    return not failed
+
+
+def launch_local(config_path, workers, output_dir=None, checkpoint_dir=None,
+                 resume=False):
+    """Run a training with workers local processes, return the profile
+
+    Each process gets an equal share of the CPUs unless the config sets
+    intra_threads. The chief prints to the terminal, the others log to
+    <output_dir>/logs/worker-<i>.log.
+    """
+    config = load_config(config_path, output_dir=output_dir,
+                         checkpoint_dir=checkpoint_dir)
+    if not resume:
+        # Fail here rather than in the chief, with the others started
+        stale_checkpoints(config["checkpoint_dir"])
+    log_dir = os.path.join(config["output_dir"], "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    addresses = ["localhost:{}".format(p) for p in free_ports(workers)]
+    command = [sys.executable, os.path.abspath(__file__), "worker",
+               config_path, "--output-dir", config["output_dir"],
+               "--checkpoint-dir", config["checkpoint_dir"]]
+    if resume:
+        command.append("--resume")
+    if not config["intra_threads"]:
+        command += ["--intra-threads",
+                    str(max(1, (os.cpu_count() or 1) // workers))]
+
+    processes = []
+    for i in range(workers):
+        env = dict(os.environ, TF_CONFIG=tf_config(addresses, i))
+        log = None
+        if i:
+            log = open(os.path.join(log_dir, "worker-{}.log".format(i)), "w")
+        processes.append((subprocess.Popen(
+            command, env=env, stdout=log,
+            stderr=subprocess.STDOUT if log else None), log))
+    if not wait_workers(processes):
+        print("A worker failed, see {}".format(log_dir))
+        return None
+    with open(os.path.join(config["output_dir"],
+                           "distributed_profile.json")) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='distributed.py',
+        description='Data-parallel training across processes or hosts '
+                    'with MultiWorkerMirroredStrategy'
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    launch = sub.add_parser(
+        "launch", help="Run every worker as a local process")
+    launch.add_argument("config", help="JSON training config")
+    launch.add_argument(
+        "-n", "--workers", type=int, nargs="+",
+        help="Local worker counts; several counts run one training each, "
+             "in <output_dir>/workers-<n> with checkpoints in "
+             "<checkpoint_dir>/workers-<n>, and print a scaling table "
+             "(default: the config's workers)")
+    launch.add_argument(
+        "--resume", action="store_true",
+        help="Continue an interrupted training from its checkpoint "
+             "instead of starting over")
+    worker = sub.add_parser(
+        "worker", help="Run one worker, on each host of the cluster")
+    worker.add_argument("config", help="JSON training config")
+    worker.add_argument(
+        "--index", type=int,
+        help="Position of this host in the config's workers list; not "
+             "needed when TF_CONFIG is set")
+    worker.add_argument(
+        "--resume", action="store_true",
+        help="Continue from the checkpoint instead of starting over; give "
+             "it to every worker or to none")
+    worker.add_argument("--output-dir", help=argparse.SUPPRESS)
+    worker.add_argument("--checkpoint-dir", help=argparse.SUPPRESS)
+    worker.add_argument("--intra-threads", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        print("Error: cannot read config {}: {}".format(args.config, e))
+        exit(1)
+
+    if args.command == "worker":
+        config = load_config(args.config, output_dir=args.output_dir,
+                             checkpoint_dir=args.checkpoint_dir,
+                             intra_threads=args.intra_threads)
+        if "TF_CONFIG" not in os.environ:
+            if args.index is None or not isinstance(config["workers"],
+                                                    list):
+                print("Error: give --index and list the worker addresses "
+                      "in the config, or set TF_CONFIG")
+                exit(1)
+            os.environ["TF_CONFIG"] = tf_config(config["workers"],
+                                                args.index)
+        try:
+            train_worker(config, args.resume)
+        except ValueError as e:
+            print("Error: {}".format(e))
+            exit(1)
+        exit(0)
+
+    counts = args.workers or [config["workers"]]
+    if not all(isinstance(n, int) and n > 0 for n in counts):
+        print("Error: launch needs a number of local workers")
+        exit(1)
+    results = {}
+    for n in counts:
+        out = checkpoints = None
+        if len(counts) > 1:
+            # Every run trains from scratch and keeps its own checkpoints,
+            # so no run restores another one's finished model
+            run = "workers-{}".format(n)
+            out = os.path.join(config["output_dir"], run)
+            checkpoints = os.path.join(config["checkpoint_dir"], run)
+        print("\n=== {} worker{} ===".format(n, "s" if n > 1 else ""))
+        start = time.perf_counter()
+        try:
+            profile = launch_local(args.config, n, out, checkpoints,
+                                   args.resume)
+        except ValueError as e:
+            print("Error: {}".format(e))
+            exit(1)
+        if profile is None:
+            exit(1)
+        results[n] = (profile, time.perf_counter() - start)
+
+    print("\n{:>8} {:>12} {:>16} {:>10} {:>10}".format(
+        "workers", "global batch", "examples/sec", "speedup", "wall (s)"))
+    base = None
+    for n, (profile, wall) in results.items():
+        # The first epoch includes graph tracing, leave it out when we can
+        rates = [e["examples_per_sec"] for e in profile["epochs"]]
+        rate = float(np.median(rates[1:] or rates)) if rates else math.nan
+        base = base or rate
+        print("{:>8} {:>12} {:>16.1f} {:>10.2f} {:>10.1f}".format(
+            n, profile["global_batch_size"], rate, rate / base, wall))
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+CACHE_VERSION = 1
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def list_images(data_dir):
+    """Return (paths, labels, class_names) for a class-per-folder tree"""
+    class_names = sorted(d for d in os.listdir(data_dir)
+                         if os.path.isdir(os.path.join(data_dir, d)))
+    paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        class_dir = os.path.join(data_dir, class_name)
+        for f in sorted(os.listdir(class_dir)):
+            if f.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(class_dir, f))
+                labels.append(label)
+    return paths, np.array(labels, dtype=np.int32), class_names
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def preprocessing_signature(img_height, img_width):
+    """Everything that changes the features of an unchanged image"""
+    return {
+        "version": CACHE_VERSION,
+        "backbone": "MobileNetV2",
+        "weights": "imagenet",
+        "pooling": "avg",
+        "input": [img_height, img_width],
+        "resize": "nearest",
+        "preprocess": "mobilenet_v2",
+    }
+
+
+def build_extractor(img_height=224, img_width=224):
+    return keras.applications.MobileNetV2(
+        input_shape=(img_height, img_width, 3),
+        include_top=False,
+        weights='imagenet',
+        pooling='avg'
+    )
+
+
+def decode_images(paths, img_height=224, img_width=224, batch_size=64):
+    """tf.data pipeline decoding and preprocessing paths in parallel"""
+    preprocess = keras.applications.mobilenet_v2.preprocess_input
+
+    def load(path):
+        data = tf.io.read_file(path)
+        img = tf.io.decode_image(data, channels=3, expand_animations=False)
+        # Nearest, as predict.py resizes the images it serves
+        img = tf.image.resize(img, (img_height, img_width),
+                              method='nearest')
+        return preprocess(tf.cast(img, tf.float32))
+
+    return (tf.data.Dataset.from_tensor_slices(paths)
+            .map(load, num_parallel_calls=tf.data.AUTOTUNE)
+            .batch(batch_size)
+            .prefetch(tf.data.AUTOTUNE))
+
+
+class FeatureStore:
+    """Pooled backbone features on disk, keyed by image content hash
+
+    The store is a features.npy matrix opened memory-mapped plus a meta.json
+    holding the row keys and the preprocessing signature. A signature
+    mismatch discards the whole store; changed images simply get new keys.
+    """
+
+    def __init__(self, cache_dir, signature):
+        self.cache_dir = cache_dir
+        self.signature = signature
+        self.meta_path = os.path.join(cache_dir, "meta.json")
+        self.features_path = os.path.join(cache_dir, "features.npy")
+        self.keys = []
+        self.features = None
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.meta_path) and
+                os.path.exists(self.features_path)):
+            return
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        if meta.get("signature") != self.signature:
+            print("Feature cache is stale (preprocessing changed), "
+                  "rebuilding")
+            return
+        self.keys = meta["keys"]
+        self.features = np.load(self.features_path, mmap_mode="r")
+
+    def get_or_compute(self, paths, extractor=None, batch_size=64):
+        """Return an (N, D) feature matrix for paths, computing misses"""
+        if not paths:
+            raise ValueError("no images to compute features for")
+        keys = [hash_file(p) for p in paths]
+        rows = {key: i for i, key in enumerate(self.keys)}
+        missing = [i for i, key in enumerate(keys) if key not in rows]
+        if keys == self.keys:
+            return self.features
+        print("Feature cache: {} hits, {} misses".format(
+            len(keys) - len(missing), len(missing)))
+
+        computed = None
+        if missing:
+            if extractor is None:
+                extractor = build_extractor(*self.signature["input"])
+            ds = decode_images([paths[i] for i in missing],
+                               *self.signature["input"], batch_size)
+            computed = extractor.predict(ds, verbose=1).astype(np.float32)
+        dim = (computed.shape[1] if computed is not None
+               else self.features.shape[1])
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.features_path + ".tmp.npy"
+        out = np.lib.format.open_memmap(tmp_path, mode="w+",
+                                        dtype=np.float32,
+                                        shape=(len(keys), dim))
+        missing_rows = {i: j for j, i in enumerate(missing)}
+        for i, key in enumerate(keys):
+            if i in missing_rows:
+                out[i] = computed[missing_rows[i]]
+            else:
+                out[i] = self.features[rows[key]]
+        out.flush()
+        del out
+        os.replace(tmp_path, self.features_path)
+        with open(self.meta_path, "w") as f:
+            json.dump({"signature": self.signature, "keys": keys}, f)
+        self.keys = keys
+        self.features = np.load(self.features_path, mmap_mode="r")
+        return self.features
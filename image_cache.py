@@ -0,0 +1,321 @@
+import contextlib
+import hashlib
+import os
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from instrumentation import file_size, span
+
+# "SIZE" or "SIZE:shared", inherited by worker processes
+ENV_CACHE = "LEAFFLICTION_IMAGE_CACHE"
+DEFAULT_MAX_BYTES = 512 << 20
+SEGMENT_PREFIX = "lfimg_"
+
+# Segment layout: ready marker, height, width, channels, then the pixels.
+# The creator writes the marker last so readers never see half an image.
+_HEADER = struct.Struct("<4I")
+_READY = 0x4C46494D
+# Held while resource_tracker.register is swapped out, and by every
+# segment creation that must not be missed by the tracker meanwhile
+_tracker_lock = threading.Lock()
+
+
+def decode(source, size=None):
+    """RGB uint8 array of an image path or file object
+
+    size is (width, height). Resizing is nearest neighbour, as in
+    keras.utils.load_img, so predict.py sees the same pixels as before.
+    """
+    import numpy as np
+    from PIL import Image
+
+    with span("decode") as s:
+        if s:
+            s.bytes_read = file_size(source)
+        with Image.open(source) as img:
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            if size is not None and img.size != tuple(size):
+                img = img.resize(tuple(size), Image.NEAREST)
+            array = np.asarray(img)
+    array.flags.writeable = False
+    return array
+
+
+@contextlib.contextmanager
+def _untracked():
+    """Keep an attached segment away from the resource tracker
+
+    Before Python 3.13 the tracker also records segments a process only
+    attaches to, and unlinks them when it exits; only the creator should.
+    The hook is process-wide, so decode threads take turns with it.
+    """
+    from multiprocessing import resource_tracker
+
+    with _tracker_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            yield
+        finally:
+            resource_tracker.register = register
+
+
+class _Pixels:
+    """The image of a segment, closing the segment with its last array
+
+    Arrays made by numpy.asarray keep this object as their base, so the
+    mapping lives exactly as long as some view of it does.
+    """
+
+    def __init__(self, segment, shape):
+        import ctypes
+
+        self.segment = segment
+        self.data = (ctypes.c_uint8 * (shape[0] * shape[1] * shape[2])
+                     ).from_buffer(segment.buf, _HEADER.size)
+        self.__array_interface__ = {
+            "shape": shape, "typestr": "|u1", "version": 3,
+            "data": (ctypes.addressof(self.data), False)}
+
+    def __del__(self):
+        # close() fails while the ctypes view still exports the buffer
+        del self.data
+        self.segment.close()
+
+
+class ImageCache:
+    """Byte-bounded LRU of decoded images, optionally in shared memory
+
+    Entries are keyed by path, mtime, file size and target size, so an
+    edited file is decoded again. Arrays are read-only and shared by
+    every caller. With shared=True each decoded image also goes into a
+    named shared memory segment: other processes with a shared cache map
+    that segment instead of decoding, without copying it. Segments are
+    unlinked by their creator when it evicts them or exits; processes
+    that mapped one keep a valid view until they drop it.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, shared=False):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        # key -> (array, segment or None, pid that created the segment)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.shared_hits = self.misses = self.evictions = 0
+        if shared:
+            # Unlike atexit, also run by multiprocessing worker processes
+            from multiprocessing import util
+            util.Finalize(self, self.close, exitpriority=10)
+
+    @staticmethod
+    def key(path, size=None):
+        st = os.stat(path)
+        return "{}|{}|{}|{}".format(os.path.realpath(path), st.st_mtime_ns,
+                                    st.st_size, size and tuple(size))
+
+    @staticmethod
+    def segment_name(key):
+        digest = hashlib.sha1(key.encode()).hexdigest()[:24]
+        return SEGMENT_PREFIX + digest
+
+    def load(self, path, size=None):
+        """Decoded RGB uint8 array of path, resized to (width, height)"""
+        if not self.max_bytes:
+            with self._lock:
+                self.misses += 1
+            return decode(path, size)
+        key = self.key(path, size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        segment = creator = None
+        array = self._attach(key) if self.shared else None
+        if array is not None:
+            array, segment = array
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            array = decode(path, size)
+            with self._lock:
+                self.misses += 1
+            if self.shared and array.nbytes <= self.max_bytes:
+                array, segment = self._publish(key, array)
+                creator = os.getpid()
+        self._insert(key, (array, segment, creator))
+        return array
+
+    def _attach(self, key):
+        """(array, segment) of another process's segment for key, or None"""
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        with span("image_cache.attach"):
+            try:
+                if sys.version_info >= (3, 13):
+                    segment = shared_memory.SharedMemory(
+                        self.segment_name(key), track=False)
+                else:
+                    with _untracked():
+                        segment = shared_memory.SharedMemory(
+                            self.segment_name(key))
+            except FileNotFoundError:
+                return None
+            ready, height, width, channels = _HEADER.unpack_from(segment.buf)
+            if ready != _READY:
+                segment.close()
+                return None
+            array = np.asarray(_Pixels(segment, (height, width, channels)))
+        array.flags.writeable = False
+        return array, segment
+
+    def _publish(self, key, array):
+        """Copy array into a new segment; keep array if that fails"""
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        try:
+            with _tracker_lock:
+                segment = shared_memory.SharedMemory(
+                    self.segment_name(key), create=True,
+                    size=_HEADER.size + array.nbytes)
+        except FileExistsError:
+            # Another process is publishing the same image
+            return array, None
+        _HEADER.pack_into(segment.buf, 0, 0, *array.shape)
+        shared = np.asarray(_Pixels(segment, array.shape))
+        shared[...] = array
+        _HEADER.pack_into(segment.buf, 0, _READY, *array.shape)
+        shared.flags.writeable = False
+        return shared, segment
+
+    def _insert(self, key, entry):
+        evicted = []
+        with self._lock:
+            if key in self._entries or entry[0].nbytes > self.max_bytes:
+                evicted.append(entry)
+            else:
+                self._entries[key] = entry
+                self._bytes += entry[0].nbytes
+            while self._bytes > self.max_bytes:
+                _, entry = self._entries.popitem(last=False)
+                self._bytes -= entry[0].nbytes
+                self.evictions += 1
+                evicted.append(entry)
+        for _, segment, creator in evicted:
+            self._release(segment, creator)
+
+    @staticmethod
+    def _release(segment, creator):
+        # Mappings go with the last array; only names need removing
+        if segment is not None and creator == os.getpid():
+            with span("image_cache.unlink"):
+                try:
+                    segment.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """Drop every entry, unlinking the segments this process made"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self._bytes = 0
+        for _, segment, creator in entries:
+            self._release(segment, creator)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "shared_hits": self.shared_hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, "shared": self.shared}
+
+
+_default = None
+
+
+def parse_spec(spec):
+    """(max_bytes, shared) of a LEAFFLICTION_IMAGE_CACHE value"""
+    from augmentation_cache import parse_size
+
+    size, _, backend = spec.partition(":")
+    return parse_size(size) if size else 0, backend == "shared"
+
+
+def default_cache():
+    """This process's cache, configured by LEAFFLICTION_IMAGE_CACHE
+
+    Without it the cache keeps nothing and only counts decodes.
+    """
+    global _default
+    if _default is None:
+        _default = ImageCache(*parse_spec(os.environ.get(ENV_CACHE, "")))
+    return _default
+
+
+def _forget_default():
+    # A forked child starts its own cache; the parent's segments are not
+    # its to unlink
+    global _default
+    _default = None
+
+
+os.register_at_fork(after_in_child=_forget_default)
+
+
+def load_image(source, size=None):
+    """Decoded RGB uint8 array of a path or file object, through the cache
+
+    File objects (uploaded bytes) have no stable identity and are always
+    decoded. The array is read-only; copy it before modifying it.
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        return decode(source, size)
+    return default_cache().load(source, size)
+
+
+def print_stats(stats, stream=None):
+    print("Image cache: {} hits, {} from shared memory, {} decoded, "
+          "{} evicted; {:.1f} of {:.1f} MB held in {} images".format(
+              stats["hits"], stats["shared_hits"], stats["misses"],
+              stats["evictions"], stats["bytes"] / 1e6,
+              stats["max_bytes"] / 1e6, stats["entries"]), file=stream)
+
+
+def add_arguments(parser):
+    """The --image-cache options of the scripts that decode images"""
+    from augmentation_cache import parse_size
+
+    parser.add_argument(
+        "--image-cache",
+        metavar="SIZE",
+        type=parse_size,
+        help="Keep up to SIZE (e.g. 512M) of decoded images in memory and "
+             "reuse them across stages"
+    )
+    parser.add_argument(
+        "--shared-image-cache",
+        action="store_true",
+        help="Keep decoded images in shared memory so worker processes "
+             "reuse each other's decodes (default size {}M)".format(
+                 DEFAULT_MAX_BYTES >> 20)
+    )
+
+
+def setup(args):
+    """Configure this process and its workers, report counters at exit"""
+    import atexit
+
+    if not args.image_cache and not args.shared_image_cache:
+        return
+    max_bytes = args.image_cache or DEFAULT_MAX_BYTES
+    os.environ[ENV_CACHE] = "{}{}".format(
+        max_bytes, ":shared" if args.shared_image_cache else "")
+    _forget_default()
+    atexit.register(lambda: print_stats(default_cache().stats(), sys.stderr))
@@ -0,0 +1,238 @@
+import atexit
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Set in the environment so worker processes started later record too
+ENV_DIR = "LEAFFLICTION_INSTRUMENT_DIR"
+ENV_PID = "LEAFFLICTION_INSTRUMENT_PID"
+
+_dir = os.environ.get(ENV_DIR)
+_events = []
+_local = threading.local()
+_main_pid = int(os.environ.get(ENV_PID, os.getpid()))
+
+
+def _forget_parent_events():
+    _events.clear()
+
+
+os.register_at_fork(after_in_child=_forget_parent_events)
+
+
+class _NullSpan:
+    """What span() yields when instrumentation is off; falsy, ignores all"""
+
+    bytes_read = bytes_written = 0
+
+    def __bool__(self):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "bytes_read", "bytes_written", "ts", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __bool__(self):
+        return True
+
+    def __enter__(self):
+        _local.depth = getattr(_local, "depth", 0) + 1
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        _events.append((self.name, self.ts, duration, os.getpid(),
+                        threading.get_ident(), self.bytes_read,
+                        self.bytes_written))
+        _local.depth -= 1
+        # Worker processes hand their events over after each top-level call
+        if _local.depth == 0 and os.getpid() != _main_pid:
+            flush()
+        return False
+
+
+def enabled():
+    return _dir is not None
+
+
+def span(name):
+    """Context manager timing a block; set bytes_read/bytes_written on it
+
+    When instrumentation is off this returns a shared falsy object, so
+    `if s:` guards any work done only to measure.
+    """
+    if _dir is None:
+        return _NULL
+    return _Span(name)
+
+
+def timed(name=None):
+    """Decorator recording every call of a function as a span"""
+    def decorate(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _dir is None:
+                return fn(*args, **kwargs)
+            with _Span(label):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def enable():
+    """Start recording in this process and in processes started later"""
+    global _dir
+    if _dir is None:
+        _dir = tempfile.mkdtemp(prefix="leaffliction_instrument_")
+        os.environ[ENV_DIR] = _dir
+        os.environ[ENV_PID] = str(_main_pid)
+    return _dir
+
+
+def flush():
+    """Append this process's recorded events to the shared directory"""
+    global _events
+    if _dir is None or not _events:
+        return
+    events, _events = _events, []
+    path = os.path.join(_dir, "events-{}.jsonl".format(os.getpid()))
+    with open(path, "a") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+
+
+def collect():
+    """Every event recorded so far by this process and its workers"""
+    flush()
+    events = []
+    for name in sorted(os.listdir(_dir)):
+        with open(os.path.join(_dir, name)) as f:
+            events.extend(json.loads(line) for line in f)
+    return events
+
+
+def summarize(events):
+    """Per-name calls, total and mean seconds, bytes read and written"""
+    stats = {}
+    for name, _, duration, _, _, read, written in events:
+        entry = stats.setdefault(name, [0, 0.0, 0, 0])
+        entry[0] += 1
+        entry[1] += duration
+        entry[2] += read
+        entry[3] += written
+    return {name: {"calls": calls, "seconds": seconds,
+                   "mean_ms": seconds / calls * 1000,
+                   "bytes_read": read, "bytes_written": written}
+            for name, (calls, seconds, read, written) in stats.items()}
+
+
+def print_summary(events, stream=None):
+    rows = sorted(summarize(events).items(),
+                  key=lambda item: item[1]["seconds"], reverse=True)
+    print("\n{:<28} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "stage", "calls", "total s", "mean ms", "MB read", "MB written"),
+        file=stream)
+    for name, s in rows:
+        print("{:<28} {:>8} {:>10.3f} {:>10.3f} {:>10.2f} {:>10.2f}".format(
+            name, s["calls"], s["seconds"], s["mean_ms"],
+            s["bytes_read"] / 1e6, s["bytes_written"] / 1e6), file=stream)
+    print("Times are summed over processes and include nested stages.",
+          file=stream)
+
+
+def write_chrome_trace(events, path):
+    """Save events in the Trace Event format of chrome://tracing/Perfetto"""
+    trace = [{"name": name, "ph": "X", "ts": ts * 1e6, "dur": dur * 1e6,
+              "pid": pid, "tid": tid,
+              "args": {"bytes_read": read, "bytes_written": written}}
+             for name, ts, dur, pid, tid, read, written in events]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+    return path
+
+
+def add_arguments(parser):
+    """The --instrument, --trace and --profile options of every script"""
+    parser.add_argument(
+        "--instrument",
+        action="store_true",
+        help="Print time, calls and bytes read/written per stage at exit"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Write per-stage timings as Chrome trace JSON to FILE "
+             "(implies --instrument)"
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Run under cProfile, save the stats to FILE and print the "
+             "top functions (main process only)"
+    )
+
+
+def setup(args):
+    """Turn on what the parsed options ask for and report at exit"""
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    if args.instrument or args.trace:
+        enable()
+
+    def report():
+        import sys
+
+        if profiler is not None:
+            import pstats
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print("\ncProfile stats saved to {}".format(args.profile),
+                  file=sys.stderr)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+                "cumulative").print_stats(20)
+        if _dir is not None:
+            events = collect()
+            print_summary(events, sys.stderr)
+            if args.trace:
+                write_chrome_trace(events, args.trace)
+                print("Trace saved to {}".format(args.trace),
+                      file=sys.stderr)
+            shutil.rmtree(_dir, ignore_errors=True)
+
+    atexit.register(report)
+    if profiler is not None:
+        profiler.enable()
@@ -0,0 +1,22 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Return module name, executed only when an attribute is first used
+
+    Lets a script keep a heavy dependency as a module-level name while
+    `--help` and code paths that never touch it skip its import cost.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named '{}'".format(name),
+                                  name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
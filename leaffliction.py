@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import time
+
+_started = time.perf_counter()
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommand -> (script run as __main__, help); only the chosen script and
+# what it imports get loaded, so cheap commands never pay for TensorFlow
+COMMANDS = {
+    "predict": ("predict.py", "classify images with a trained model"),
+    "train": ("train.py", "train the classifier"),
+    "transform": ("Transformation.py",
+                  "PlantCV transformations and feature tables"),
+    "augment": ("Augmentation.py", "augment a single image"),
+    "balance": ("Balance_Dataset.py",
+                "augment a dataset until its classes are balanced"),
+    "distribution": ("Distribution.py", "plot images per class"),
+    "serve": ("serve.py", "HTTP prediction server"),
+    "shards": ("shards.py", "pack a dataset into memory-mapped shards"),
+    "export": ("tflite_export.py", "export the model to TFLite"),
+    "bundle": ("model_bundle.py", "write or verify a model bundle manifest"),
+    "distributed": ("distributed.py", "multi-worker training"),
+    "cache": ("augmentation_cache.py", "inspect the augmentation cache"),
+    "benchmark": ("benchmark.py", "time every pipeline stage"),
+}
+
+
+def interpreter_seconds():
+    """Seconds from process start to this module, or None off Linux"""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may hold spaces; fields resume after ')'
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    started = start_ticks / os.sysconf("SC_CLK_TCK")
+    # /proc/uptime is read now, so take off the time spent since _started
+    return max(uptime - started - (time.perf_counter() - _started), 0.0)
+
+
+class StartupTimer:
+    """Time a script up to its first parse_args() call, then to the end
+
+    Scripts import everything they need before building their parser,
+    so the first parse_args() marks the end of their startup.
+    """
+
+    def __init__(self):
+        self.modules = len(sys.modules)
+        self.start = time.perf_counter()
+        self.parsed = None
+        self._parse_args = argparse.ArgumentParser.parse_args
+        timer = self
+
+        def parse_args(parser, *args, **kwargs):
+            if timer.parsed is None:
+                timer.parsed = time.perf_counter()
+                timer.modules_at_parse = len(sys.modules)
+            return timer._parse_args(parser, *args, **kwargs)
+
+        argparse.ArgumentParser.parse_args = parse_args
+
+    def report(self, command, stream=sys.stderr):
+        argparse.ArgumentParser.parse_args = self._parse_args
+        end = time.perf_counter()
+        parsed = self.parsed or end
+        interpreter = interpreter_seconds()
+        rows = []
+        if interpreter is not None:
+            rows.append(("interpreter", interpreter))
+        rows += [
+            ("cli", self.start - _started),
+            ("{} imports".format(command), parsed - self.start),
+            ("{} run".format(command), end - parsed),
+            ("total", (interpreter or 0.0) + end - _started),
+        ]
+        print("\n{:<24} {:>10}".format("timing", "ms"), file=stream)
+        for name, seconds in rows:
+            print("{:<24} {:>10.1f}".format(name, seconds * 1000),
+                  file=stream)
+        imported = getattr(self, "modules_at_parse", len(sys.modules))
+        print("{} modules loaded at startup, {} more while running".format(
+            imported - self.modules, len(sys.modules) - imported),
+            file=stream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="leaffliction",
+        description="Run any Leaffliction tool; options after the command "
+                    "go to that tool (leaffliction COMMAND --help).",
+        epilog="commands:\n" + "\n".join(
+            "  {:<14}{}".format(name, text)
+            for name, (_, text) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="Print interpreter, import and run times of the command"
+    )
+    parser.add_argument("command", choices=COMMANDS, metavar="COMMAND")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    script = os.path.join(HERE, COMMANDS[args.command][0])
+    timer = StartupTimer() if args.timing else None
+    sys.argv = [script] + args.args
+    try:
+        import runpy
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        if timer is not None:
+            timer.report(args.command)
+
+
+if __name__ == "__main__":
+    main()
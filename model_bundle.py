@@ -0,0 +1,322 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+MANIFEST_NAME = "bundle.json"
+VALIDATION_FILES = "validation_files.txt"
+BUNDLE_VERSION = 1
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+MODEL_FILES = ("best_model.keras", "final_model.keras", "best_model.tflite",
+               "final_model.tflite")
+
+# How predict.load_and_preprocess turns a file into model input, and how
+# every training input pipeline resizes too; a bundle asking for anything
+# else cannot be served by this code
+PREPROCESSING = {
+    "color": "RGB",
+    "resize": "nearest",
+    "preprocess": "mobilenet_v2",
+}
+DEFAULT_WARMUP = (1, 32)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def training_files(data_dir):
+    """Relative paths of the files a training run reads, in a fixed order"""
+    if os.path.isfile(os.path.join(data_dir, "index.json")):
+        return sorted(f for f in os.listdir(data_dir)
+                      if f == "index.json" or f.endswith(".npy"))
+    files = []
+    for class_name in sorted(os.listdir(data_dir)):
+        class_dir = os.path.join(data_dir, class_name)
+        if not os.path.isdir(class_dir):
+            continue
+        files.extend(os.path.join(class_name, f)
+                     for f in sorted(os.listdir(class_dir))
+                     if f.lower().endswith(IMAGE_EXTENSIONS))
+    return files
+
+
+def dataset_hash(data_dir):
+    """{"files", "sha256"} over the names and bytes of a training set
+
+    Works on a class-per-folder tree or a shards.py directory; renaming,
+    adding, removing or editing any image changes the hash.
+    """
+    files = training_files(data_dir)
+    digest = hashlib.sha256()
+    for name in files:
+        digest.update("{}\0".format(name.replace(os.sep, "/")).encode())
+        with open(os.path.join(data_dir, name), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(b"\0")
+    return {"files": len(files), "sha256": digest.hexdigest()}
+
+
+def serving_signature(img_height, img_width, num_classes,
+                      warmup_batch_sizes=DEFAULT_WARMUP):
+    """Tensors of predict_on_batch and the batch sizes to trace at load"""
+    return {
+        "inputs": {"dtype": "float32",
+                   "shape": [None, img_height, img_width, 3]},
+        "outputs": {"dtype": "float32", "shape": [None, num_classes]},
+        "warmup_batch_sizes": list(warmup_batch_sizes),
+    }
+
+
+def write_class_names(output_dir, class_names):
+    with open(os.path.join(output_dir, "class_names.txt"), "w") as f:
+        for class_name in class_names:
+            f.write("{}\n".format(class_name))
+
+
+def write_validation_files(output_dir, data_dir, paths):
+    """Record the images of data_dir a training run validated on
+
+    tflite_export.py calibrates on the others and compares models on
+    these. paths is None when the split is not of image files (packed
+    shards), which removes the record of an older run.
+    """
+    path = os.path.join(output_dir, VALIDATION_FILES)
+    if paths is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w") as f:
+        for name in sorted(os.path.relpath(p, data_dir).replace(os.sep, "/")
+                           for p in paths):
+            f.write("{}\n".format(name))
+
+
+def read_validation_files(model_dir):
+    """Validation images recorded by training, relative to its data_dir"""
+    path = os.path.join(model_dir, VALIDATION_FILES)
+    if not os.path.exists(path):
+        raise ValueError("{} not found; train again to record the "
+                         "validation split".format(path))
+    with open(path) as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def _write_json(path, data):
+    # Readers never see a half-written manifest
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _model_record(path):
+    return {"bytes": os.path.getsize(path), "sha256": hash_file(path)}
+
+
+def build_manifest(class_names, img_height=224, img_width=224,
+                   data_dir=None, warmup_batch_sizes=DEFAULT_WARMUP):
+    """Manifest of models trained on data_dir, before any model is recorded"""
+    return {
+        "version": BUNDLE_VERSION,
+        "class_names": list(class_names),
+        "input_shape": [img_height, img_width, 3],
+        "preprocessing": dict(PREPROCESSING),
+        "signature": serving_signature(img_height, img_width,
+                                       len(class_names), warmup_batch_sizes),
+        "training_data": (dict(dataset_hash(data_dir),
+                               path=os.path.abspath(data_dir))
+                          if data_dir is not None else None),
+        "models": {},
+    }
+
+
+def write_manifest(output_dir, class_names, models, img_height=224,
+                   img_width=224, data_dir=None,
+                   warmup_batch_sizes=DEFAULT_WARMUP):
+    """Write bundle.json and class_names.txt for models in output_dir
+
+    models names the files the training run saved; anything else in the
+    directory, like an export of an older run, is left out of the bundle.
+    Call it once they are final: their sizes and hashes are recorded so a
+    later swap of either side is caught at load time.
+    """
+    manifest = build_manifest(class_names, img_height, img_width, data_dir,
+                              warmup_batch_sizes)
+    for name in models:
+        manifest["models"][name] = _model_record(
+            os.path.join(output_dir, name))
+    write_class_names(output_dir, class_names)
+    _write_json(os.path.join(output_dir, MANIFEST_NAME), manifest)
+    return manifest
+
+
+def add_model(model_dir, name):
+    """Record a model file written after the manifest, if there is one"""
+    path = os.path.join(model_dir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest["models"][name] = _model_record(os.path.join(model_dir, name))
+    _write_json(path, manifest)
+
+
+def read_class_names(model_dir):
+    path = os.path.join(model_dir, "class_names.txt")
+    if not os.path.exists(path):
+        raise FileNotFoundError("Class names file not found: {}".format(path))
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_manifest(model_dir):
+    """The manifest of model_dir, checked against what this code serves
+
+    A directory trained before bundles existed gets a manifest built from
+    its class_names.txt, with a 224x224 input and no recorded models.
+    Raises ValueError when the manifest cannot describe these models.
+    """
+    path = os.path.join(model_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return dict(build_manifest(read_class_names(model_dir)), version=0)
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("version", 0) > BUNDLE_VERSION:
+        raise ValueError("{} has bundle version {}, this code reads up to "
+                         "{}".format(path, manifest["version"],
+                                     BUNDLE_VERSION))
+    if manifest["preprocessing"] != PREPROCESSING:
+        raise ValueError("{} asks for preprocessing {}, only {} is "
+                         "supported".format(path, manifest["preprocessing"],
+                                            PREPROCESSING))
+    if (os.path.exists(os.path.join(model_dir, "class_names.txt")) and
+            read_class_names(model_dir) != manifest["class_names"]):
+        raise ValueError("class_names.txt in {} does not match {}".format(
+            model_dir, MANIFEST_NAME))
+    return manifest
+
+
+class ModelBundle:
+    """A model directory: its manifest and the checks tying models to it
+
+    Loading reads only the manifest; check() then proves a loaded model
+    belongs to it, so a model trained on other classes fails before
+    answering instead of mapping its outputs to the wrong labels.
+    """
+
+    def __init__(self, model_dir, manifest):
+        self.model_dir = model_dir
+        self.manifest = manifest
+        self.class_names = manifest["class_names"]
+        self.input_shape = tuple(manifest["input_shape"])
+        self.img_height, self.img_width = self.input_shape[:2]
+
+    @classmethod
+    def load(cls, model_dir):
+        return cls(model_dir, read_manifest(model_dir))
+
+    def check(self, model, path=None):
+        """Raise ValueError unless model, loaded from path, fits the bundle"""
+        name = os.path.basename(path) if path else "model"
+        record = self.manifest["models"].get(name)
+        if record is None and path and self.manifest.get("version", 0):
+            raise ValueError("{} is not part of the bundle in {}; it may be "
+                             "left from an older run, export it again or "
+                             "rewrite the manifest with model_bundle.py"
+                             .format(path, MANIFEST_NAME))
+        if record is not None and (
+                os.path.getsize(path) != record["bytes"] or
+                hash_file(path) != record["sha256"]):
+            raise ValueError("{} changed since {} was written; retrain or "
+                             "rewrite the manifest with model_bundle.py"
+                             .format(path, MANIFEST_NAME))
+        outputs = model.output_shape[-1]
+        if outputs != len(self.class_names):
+            raise ValueError("{} predicts {} classes but the bundle lists "
+                             "{}: {}".format(name, outputs,
+                                             len(self.class_names),
+                                             ", ".join(self.class_names)))
+        if tuple(model.input_shape[1:]) != self.input_shape:
+            raise ValueError("{} takes {} inputs, the bundle expects {}"
+                             .format(name, tuple(model.input_shape[1:]),
+                                     self.input_shape))
+
+    def warmup(self, model, batch_sizes=None):
+        """Trace model at every batch size so no request pays for it"""
+        import numpy as np
+
+        if batch_sizes is None:
+            batch_sizes = self.manifest["signature"]["warmup_batch_sizes"]
+        for size in batch_sizes:
+            model.predict_on_batch(
+                np.zeros((size,) + self.input_shape, dtype=np.float32))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="model_bundle.py",
+        description="Write or verify the bundle.json manifest of a model "
+                    "directory"
+    )
+    parser.add_argument(
+        "model_dir",
+        nargs="?",
+        default="./model",
+        help="Directory holding the models and class_names.txt "
+             "(default: ./model)"
+    )
+    parser.add_argument(
+        "-data",
+        "--data_dir",
+        help="Training images to hash into a new manifest"
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Load and warm up every recorded model instead of writing "
+             "the manifest"
+    )
+    args = parser.parse_args()
+
+    from predict import load_model
+
+    try:
+        if args.verify:
+            bundle = ModelBundle.load(args.model_dir)
+            for name in sorted(bundle.manifest["models"]):
+                path = os.path.join(args.model_dir, name)
+                backend = "tflite" if name.endswith(".tflite") else "keras"
+                start = time.perf_counter()
+                model = load_model(path, backend)
+                bundle.check(model, path)
+                loaded = time.perf_counter()
+                bundle.warmup(model)
+                print("{}: loaded in {:.2f}s, warmed up in {:.2f}s".format(
+                    name, loaded - start, time.perf_counter() - loaded))
+            print("{} classes: {}".format(len(bundle.class_names),
+                                          ", ".join(bundle.class_names)))
+            exit(0)
+        class_names = read_class_names(args.model_dir)
+        path = os.path.join(args.model_dir, "best_model.keras")
+        model = load_model(path)
+        height, width = model.input_shape[1:3]
+        ModelBundle(args.model_dir,
+                    build_manifest(class_names, height, width)).check(model)
+        models = [name for name in MODEL_FILES if os.path.isfile(
+            os.path.join(args.model_dir, name))]
+        manifest = write_manifest(args.model_dir, class_names, models,
+                                  height, width, args.data_dir)
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e))
+        exit(1)
+    print("Bundle of {} classes at {}x{} with {} saved to {}".format(
+        len(class_names), height, width,
+        ", ".join(sorted(manifest["models"])),
+        os.path.join(args.model_dir, MANIFEST_NAME)))
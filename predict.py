@@ -1,35 +1,88 @@
 import argparse
+import base64
+import csv
+import glob
+import io
+import json
 import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from tensorflow import keras
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
-import matplotlib.pyplot as plt
+import image_cache
+from image_cache import load_image
+from instrumentation import add_arguments, file_size, setup, span
+from model_bundle import ModelBundle
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
 
 def load_class_names(model_dir):
-    class_names_path = os.path.join(model_dir, 'class_names.txt')
-    if not os.path.exists(class_names_path):
-        msg = "Class names file not found: {}".format(class_names_path)
-        raise FileNotFoundError(msg)
+    return ModelBundle.load(model_dir).class_names
+
+
+def load_model(model_path, backend='keras', num_threads=None):
+    """Load a Keras model, or a TFLite one wrapped to look like it"""
+    with span("model_load") as s:
+        if s:
+            s.bytes_read = file_size(model_path)
+        if backend == 'tflite':
+            from tflite_export import TFLiteModel
+            return TFLiteModel(model_path, num_threads)
+        from tensorflow import keras
+        # Inference needs no optimizer or loss; skipping them also keeps
+        # predict_on_batch off the slower compiled-for-training path
+        return keras.models.load_model(model_path, compile=False)
+
+
+def load_predictor(model_paths, backend='keras', num_threads=None, views=1,
+                   bundle=None, warmup=()):
+    """Load one model, or a TTAEnsemble for several models or views
 
-    with open(class_names_path, 'r') as f:
-        class_names = [line.strip() for line in f.readlines()]
-    return class_names
+    With a ModelBundle every model is checked against it first, raising
+    ValueError on a mismatch, and the predictor is then run once at each
+    batch size in warmup so real requests never pay for graph tracing.
+    """
+    models = []
+    for path in model_paths:
+        model = load_model(path, backend, num_threads)
+        if bundle is not None:
+            bundle.check(model, path)
+        models.append(model)
+    if len(models) == 1 and views == 1:
+        predictor = models[0]
+    else:
+        from tta import TTAEnsemble
+        predictor = TTAEnsemble(models, views)
+    if bundle is not None and warmup:
+        with span("warmup"):
+            bundle.warmup(predictor, warmup)
+    return predictor
+
+
+def load_and_preprocess(image_path, img_height=224, img_width=224):
+    """Decode an image (path or file object) for MobileNetV2"""
+    from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
+
+    img = load_image(image_path, (img_width, img_height))
+    return preprocess_input(img.astype(np.float32))
 
 
 def predict_image(image_path, model_path, class_names,
-                  img_height=224, img_width=224, show_plot=True):
-    model = keras.models.load_model(model_path)
+                  img_height=224, img_width=224, show_plot=True,
+                  model=None, plot_path=None):
+    if model is None:
+        model = load_model(model_path)
 
-    img = image.load_img(image_path, target_size=(img_height, img_width))
-    img_array = image.img_to_array(img)
-    img_array = preprocess_input(img_array)
+    img_array = load_and_preprocess(image_path, img_height, img_width)
     img_array = np.expand_dims(img_array, axis=0)
 
-    predictions = model.predict(img_array, verbose=0)
+    with span("inference"):
+        predictions = np.asarray(model.predict_on_batch(img_array))
     predicted_class_idx = np.argmax(predictions[0])
     confidence = predictions[0][predicted_class_idx]
 
@@ -47,32 +100,271 @@ def predict_image(image_path, model_path, class_names,
         prob = predictions[0][idx]*100
         print("  {}: {:.2f}%".format(class_names[idx], prob))
 
-    if show_plot:
-        plt.figure(figsize=(12, 5))
+    if show_plot or plot_path:
+        import reporting
+        reporting.get_pyplot(interactive=plot_path is None)
+        fig = reporting.prediction_figure(image_path, class_names,
+                                          predictions[0])
+        if plot_path:
+            reporting.save_figure(fig, plot_path)
+            print("Prediction chart saved to {}".format(plot_path))
+        else:
+            reporting.show_figure(fig)
+
+    return predicted_class, confidence, predictions[0]
 
-        plt.subplot(1, 2, 1)
-        img_display = image.load_img(image_path)
-        plt.imshow(img_display)
-        title = "Predicted: {}\nConfidence: {:.1f}%".format(
-            predicted_class, confidence*100)
-        plt.title(title)
-        plt.axis('off')
 
-        plt.subplot(1, 2, 2)
-        y_pos = np.arange(len(class_names))
-        plt.barh(y_pos, predictions[0] * 100)
-        plt.yticks(y_pos, class_names)
-        plt.xlabel('Confidence (%)')
-        plt.title('Prediction Probabilities')
-        plt.xlim(0, 100)
+def collect_image_paths(sources):
+    """Expand directories, glob patterns and plain files into image paths"""
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                for f in sorted(files):
+                    if f.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.append(os.path.join(root, f))
+        elif os.path.isfile(source):
+            paths.append(source)
+        else:
+            matches = sorted(glob.glob(source, recursive=True))
+            paths.extend(p for p in matches
+                         if os.path.isfile(p) and
+                         p.lower().endswith(IMAGE_EXTENSIONS))
+    return list(dict.fromkeys(paths))
 
-        for i, v in enumerate(predictions[0] * 100):
-            plt.text(v + 1, i, '{:.1f}%'.format(v), va='center')
 
-        plt.tight_layout()
-        plt.show()
+def iter_batches(image_paths, batch_size=32, img_height=224, img_width=224,
+                 workers=4):
+    """Yield (paths, batch) pairs, decoding the next batch in background
 
-    return predicted_class, confidence, predictions[0]
+    The last batch is padded to batch_size so the model always sees the same
+    input shape; only the first len(paths) rows are meaningful.
+    """
+    def load(path):
+        try:
+            return load_and_preprocess(path, img_height, img_width)
+        except (OSError, ValueError) as e:
+            # stdout may be carrying the JSONL results
+            print("Warning: could not read {}: {}".format(path, e),
+                  file=sys.stderr)
+            return None
+
+    chunks = [image_paths[i:i + batch_size]
+              for i in range(0, len(image_paths), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = pool.map(load, chunks[0]) if chunks else None
+        for i, chunk in enumerate(chunks):
+            arrays = list(pending)
+            if i + 1 < len(chunks):
+                pending = pool.map(load, chunks[i + 1])
+            kept = [(p, a) for p, a in zip(chunk, arrays) if a is not None]
+            if not kept:
+                continue
+            batch = np.zeros((batch_size, img_height, img_width, 3),
+                             dtype=np.float32)
+            for j, (_, array) in enumerate(kept):
+                batch[j] = array
+            yield [p for p, _ in kept], batch
+
+
+def top_k_results(paths, probabilities, class_names, top_k=3):
+    """Turn a batch of probability rows into result dicts"""
+    results = []
+    for path, probs in zip(paths, probabilities):
+        order = np.argsort(probs)[::-1][:top_k]
+        results.append({
+            'image': path,
+            'prediction': class_names[order[0]],
+            'confidence': float(probs[order[0]]),
+            'top_k': [[class_names[idx], float(probs[idx])]
+                      for idx in order]
+        })
+    return results
+
+
+def predict_batch(image_paths, model, class_names, batch_size=32,
+                  top_k=3, img_height=224, img_width=224, workers=4):
+    """Classify many images with an already loaded model"""
+    for paths, batch in iter_batches(image_paths, batch_size, img_height,
+                                     img_width, workers):
+        with span("inference"):
+            predictions = np.asarray(model.predict_on_batch(batch))
+        yield from top_k_results(paths, predictions[:len(paths)],
+                                 class_names, top_k)
+
+
+def predict_shards(shard_dir, model, class_names, batch_size=32, top_k=3):
+    """Classify every image of a directory packed by shards.py"""
+    from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
+    from shards import ShardDataset
+
+    dataset = ShardDataset(shard_dir)
+    if dataset.resize != 'nearest':
+        print("Warning: {} was packed with {} resizing, predictions may "
+              "differ from those on the source images".format(
+                  shard_dir, dataset.resize), file=sys.stderr)
+    for images, _, indices in dataset.iter_batches(batch_size):
+        batch = preprocess_input(images.astype(np.float32))
+        with span("inference"):
+            predictions = np.asarray(model.predict_on_batch(batch))
+        paths = [dataset.sources[i] for i in indices]
+        yield from top_k_results(paths, predictions, class_names, top_k)
+
+
+def collect_into(results, sink):
+    """Pass results through while keeping a copy in sink"""
+    for result in results:
+        sink.append(result)
+        yield result
+
+
+def write_results(results, output_path=None, output_format=None):
+    """Stream result dicts to a CSV or JSONL file (stdout if no path)"""
+    if output_format is None:
+        output_format = ('csv' if output_path and
+                         output_path.lower().endswith('.csv') else 'jsonl')
+    out = open(output_path, 'w', newline='') if output_path else None
+    stream = out if out else sys.stdout
+    count = 0
+    try:
+        if output_format == 'csv':
+            writer = csv.writer(stream)
+            writer.writerow(['image', 'prediction', 'confidence', 'top_k'])
+        for result in results:
+            if output_format == 'csv':
+                top = ";".join("{}:{:.4f}".format(name, prob)
+                               for name, prob in result['top_k'])
+                writer.writerow([result['image'], result['prediction'],
+                                 "{:.4f}".format(result['confidence']), top])
+            else:
+                stream.write(json.dumps(result) + "\n")
+            count += 1
+    finally:
+        if out:
+            out.close()
+    return count
+
+
+def parse_request(line, number):
+    """(id, image path or file object) of a streamed JSONL request
+
+    A request is {"id": ..., "image": path} or {"id": ..., "image_b64":
+    base64 bytes}; the id defaults to the line number.
+    """
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("request is not a JSON object")
+    request_id = record.get('id', number)
+    if 'image_b64' in record:
+        if not isinstance(record['image_b64'], str):
+            raise ValueError("'image_b64' is not a string")
+        data = base64.b64decode(record['image_b64'], validate=True)
+        return request_id, io.BytesIO(data)
+    if isinstance(record.get('image'), str):
+        return request_id, record['image']
+    raise ValueError("request has no 'image' path or 'image_b64' field")
+
+
+def _read_requests(stream, lines, errors):
+    # Blocks once the queue is full, so a fast producer cannot make the
+    # backlog (and memory) grow without bound
+    try:
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                lines.put((number, line, time.perf_counter()))
+    except Exception as e:
+        # Raised again by stream_predict, on the main thread
+        errors.append(e)
+    finally:
+        lines.put(None)
+
+
+def _gather(lines, batch_size, max_delay):
+    """Batches of queued requests, sent full or max_delay after the first"""
+    while True:
+        item = lines.get()
+        if item is None:
+            return
+        batch = [item]
+        deadline = item[2] + max_delay
+        while len(batch) < batch_size:
+            try:
+                item = lines.get(
+                    timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                yield batch
+                return
+            batch.append(item)
+        yield batch
+
+
+def stream_predict(stream, out, model, class_names, batch_size=32, top_k=3,
+                   workers=4, max_delay=0.01, stats=None, img_height=224,
+                   img_width=224):
+    """Classify JSONL requests from stream, writing JSONL results to out
+
+    Requests are read on a background thread into a queue of two batches,
+    batched like serve.py and answered in order, one flush per batch.
+    Each result carries its id and latency_ms, from reading the request
+    to having its answer; bad requests get an "error" result instead.
+    Returns the serve.LatencyStats the latencies were recorded in. If
+    reading the stream fails, the requests read so far are answered and
+    the error is raised.
+    """
+    from serve import LatencyStats
+
+    stats = stats or LatencyStats(window=100000)
+    lines = queue.Queue(maxsize=2 * batch_size)
+    errors = []
+    threading.Thread(target=_read_requests, args=(stream, lines, errors),
+                     daemon=True).start()
+
+    def load(item):
+        number, line, arrival = item
+        try:
+            request_id, source = parse_request(line, number)
+        except ValueError as e:
+            return {'id': number, 'error': str(e)}, None
+        image = source if isinstance(source, str) else None
+        try:
+            array = load_and_preprocess(source, img_height, img_width)
+        except (OSError, ValueError) as e:
+            return {'id': request_id, 'image': image, 'error': str(e)}, None
+        return {'id': request_id, 'image': image}, array
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in _gather(lines, batch_size, max_delay):
+            loaded = list(pool.map(load, batch))
+            kept = [i for i, (_, array) in enumerate(loaded)
+                    if array is not None]
+            if kept:
+                inputs = np.zeros((batch_size, img_height, img_width, 3),
+                                  dtype=np.float32)
+                for j, i in enumerate(kept):
+                    inputs[j] = loaded[i][1]
+                with span("inference"):
+                    predictions = np.asarray(model.predict_on_batch(inputs))
+                answers = top_k_results([loaded[i][0]['image'] for i in kept],
+                                        predictions[:len(kept)], class_names,
+                                        top_k)
+                for i, answer in zip(kept, answers):
+                    loaded[i][0].update(answer)
+            done = time.perf_counter()
+            stats.record_batch(len(kept))
+            for (_, _, arrival), (result, array) in zip(batch, loaded):
+                latency = done - arrival
+                result['latency_ms'] = latency * 1000
+                if array is None:
+                    stats.count('errors')
+                else:
+                    stats.record(latency)
+                out.write(json.dumps(result) + "\n")
+            out.flush()
+    if errors:
+        raise errors[0]
+    return stats
 
 
 if __name__ == "__main__":
@@ -83,30 +375,237 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         'image',
-        help='Path to the image file to classify'
+        nargs='*',
+        help='Image file to classify, or several files, directories, '
+             'glob patterns or a shards.py directory for batch mode'
+    )
+    parser.add_argument(
+        '--stream',
+        metavar='FILE',
+        help='Classify the JSONL requests of FILE (- for stdin) as they '
+             'are read, {"id": ..., "image": path} or {"id": ..., '
+             '"image_b64": ...} per line, writing JSONL results to '
+             '--output or stdout and throughput and latency to stderr'
+    )
+    parser.add_argument(
+        '--max-delay-ms',
+        type=float,
+        default=10.0,
+        help='Stream mode: longest a request waits for its batch to fill '
+             '(default: 10)'
     )
     parser.add_argument(
         '--no-plot',
         action='store_true',
         help='Disable visualization plot'
     )
+    parser.add_argument(
+        '--plot-file',
+        help='Save the single-image chart to this PNG instead of '
+             'displaying it'
+    )
+    parser.add_argument(
+        '--report',
+        metavar='DIR',
+        help='Batch mode: write a summary HTML report with charts to DIR'
+    )
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='Force batch mode even for a single image'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=32,
+        help='Number of images per forward pass in batch mode '
+             '(default: 32)'
+    )
+    parser.add_argument(
+        '--top-k',
+        type=int,
+        default=3,
+        help='Number of class probabilities to report per image '
+             '(default: 3)'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='Batch results file, CSV if it ends with .csv, JSONL '
+             'otherwise (default: JSONL on stdout)'
+    )
+    parser.add_argument(
+        '--backend',
+        choices=['keras', 'tflite'],
+        default='keras',
+        help='Inference engine, tflite uses ./model/best_model.tflite '
+             '(default: keras)'
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        help='Interpreter threads for the tflite backend'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Threads decoding images in batch mode (default: 4)'
+    )
+    parser.add_argument(
+        '--tta',
+        type=int,
+        default=1,
+        metavar='VIEWS',
+        help='Average over this many flipped, rotated and cropped views '
+             'of each image, 1 to 8; a forward pass then holds '
+             'batch size x VIEWS images (default: 1, no augmentation)'
+    )
+    parser.add_argument(
+        '--ensemble',
+        action='store_true',
+        help='Average best_model and final_model, one forward pass each'
+    )
+    parser.add_argument(
+        '--tta-latency',
+        action='store_true',
+        help='Time every view count, alone and with the ensemble, on the '
+             'given images (one batch) and exit'
+    )
+    add_arguments(parser)
+    image_cache.add_arguments(parser)
 
     args = parser.parse_args()
+    if not args.image and not args.stream:
+        parser.error("give an image or --stream")
+    from tta import VIEWS
+    if not 1 <= args.tta <= len(VIEWS):
+        parser.error("--tta takes 1 to {} views".format(len(VIEWS)))
+    setup(args)
+    image_cache.setup(args)
 
-    if not os.path.exists(args.image):
-        print("Error: Image file not found: {}".format(args.image))
-        exit(1)
+    single = (len(args.image) == 1 and os.path.isfile(args.image[0])
+              and not args.batch)
+    extension = '.tflite' if args.backend == 'tflite' else '.keras'
+    model_paths = [os.path.join('./model', 'best_model' + extension)]
+    if args.ensemble or args.tta_latency:
+        final_path = os.path.join('./model', 'final_model' + extension)
+        if args.ensemble or os.path.exists(final_path):
+            model_paths.append(final_path)
+    for model_path in model_paths:
+        if not os.path.exists(model_path):
+            print("Error: Model file not found: {}".format(model_path))
+            exit(1)
+    model_path = model_paths[0]
 
-    model_path = './model/best_model.keras'
-    if not os.path.exists(model_path):
-        print("Error: Model file not found: {}".format(model_path))
+    shard_dir = (args.image[0] if len(args.image) == 1 and
+                 os.path.isfile(os.path.join(args.image[0], 'index.json'))
+                 else None)
+    if args.tta_latency or not (args.stream or single or shard_dir):
+        image_paths = collect_image_paths(args.image)
+        if args.tta_latency:
+            image_paths = image_paths[:args.batch_size]
+        if not image_paths:
+            print("Error: No images found in {}".format(
+                " ".join(args.image)))
+            exit(1)
+
+    # One load for every mode: the manifest, then each model checked
+    # against it and traced at the batch size it is about to serve
+    try:
+        bundle = ModelBundle.load('./model')
+        if args.tta_latency:
+            models = [load_predictor([p], args.backend, args.threads,
+                                     bundle=bundle) for p in model_paths]
+        else:
+            model = load_predictor(
+                model_paths, args.backend, args.threads, args.tta, bundle,
+                warmup=() if single else (args.batch_size,))
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e))
         exit(1)
+    class_names = bundle.class_names
+    img_height, img_width = bundle.img_height, bundle.img_width
 
-    class_names = load_class_names('./model')
+    if args.tta_latency:
+        from tta import latency_report
+        batch = np.stack([load_and_preprocess(p, img_height, img_width)
+                          for p in image_paths])
+        counts = [n for n in (1, 2, 4, 8) if n <= len(VIEWS)]
+        print("{} images per batch".format(len(batch)))
+        print("{:>6} {:>5} {:>12} {:>12} {:>6} {:>8}".format(
+            "models", "views", "ms/batch", "ms/image", "cost", "changed"))
+        for row in latency_report(models, batch, counts):
+            print("{:>6} {:>5} {:>12.1f} {:>12.2f} {:>5.1f}x {:>7.1%}"
+                  .format(row['models'], row['views'], row['ms_per_batch'],
+                          row['ms_per_image'], row['relative_cost'],
+                          row['changed']))
+        exit(0)
 
-    predict_image(
-        args.image,
-        model_path,
-        class_names,
-        show_plot=not args.no_plot
-    )
+    if args.stream:
+        source = (sys.stdin if args.stream == '-'
+                  else open(args.stream, encoding='utf-8'))
+        out = (open(args.output, 'w', encoding='utf-8') if args.output
+               else sys.stdout)
+        try:
+            stats = stream_predict(source, out, model, class_names,
+                                   batch_size=args.batch_size,
+                                   top_k=args.top_k, workers=args.workers,
+                                   max_delay=args.max_delay_ms / 1000,
+                                   img_height=img_height,
+                                   img_width=img_width)
+        except (OSError, ValueError) as e:
+            # stdout may be carrying the JSONL results
+            print("Error: {}".format(e), file=sys.stderr)
+            exit(1)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        snap = stats.snapshot()
+        print("Streamed {} requests ({} errors) in {:.2f}s: {:.1f} "
+              "requests/sec, mean batch {:.1f}".format(
+                  snap['requests'], snap['errors'], snap['uptime_s'],
+                  snap['throughput_rps'], snap['mean_batch_size']),
+              file=sys.stderr)
+        if snap['requests']:
+            print("Latency ms: p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  "
+                  "max {:.1f}".format(snap['p50_ms'], snap['p95_ms'],
+                                      snap['p99_ms'], snap['max_ms']),
+                  file=sys.stderr)
+        exit(0)
+
+    if single:
+        predict_image(
+            args.image[0],
+            model_path,
+            class_names,
+            img_height=img_height,
+            img_width=img_width,
+            show_plot=not args.no_plot,
+            plot_path=args.plot_file,
+            model=model
+        )
+        exit(0)
+
+    start = time.perf_counter()
+    if shard_dir:
+        results = predict_shards(shard_dir, model, class_names,
+                                 batch_size=args.batch_size,
+                                 top_k=args.top_k)
+    else:
+        results = predict_batch(image_paths, model, class_names,
+                                batch_size=args.batch_size,
+                                top_k=args.top_k, img_height=img_height,
+                                img_width=img_width, workers=args.workers)
+    kept = []
+    if args.report:
+        results = collect_into(results, kept)
+    count = write_results(results, args.output)
+    elapsed = time.perf_counter() - start
+    print("Classified {} images in {:.2f}s ({:.1f} images/sec)".format(
+        count, elapsed, count / elapsed if elapsed else 0.0),
+        file=sys.stderr)
+    if args.report:
+        import reporting
+        path = reporting.write_prediction_report(kept, args.report)
+        print("Report saved to {}".format(path), file=sys.stderr)
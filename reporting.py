@@ -0,0 +1,144 @@
+import html
+import os
+from collections import Counter
+
+_pyplot = None
+
+
+def get_pyplot(interactive=False):
+    """Import pyplot on first use with a suitable backend
+
+    The backend is chosen by the first call: Agg for file output, TkAgg
+    when interactive is requested and a display is available. Callers
+    that want to show a figure must ask for it before building one.
+    """
+    global _pyplot
+    if _pyplot is None:
+        import matplotlib
+        backend = 'Agg'
+        if interactive and (os.environ.get('DISPLAY') or os.name == 'nt'):
+            backend = 'TkAgg'
+        try:
+            matplotlib.use(backend)
+        except ImportError:
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        _pyplot = plt
+    return _pyplot
+
+
+def is_interactive():
+    plt = get_pyplot()
+    return plt.get_backend().lower() != 'agg'
+
+
+def distribution_figure(subdirectories, directory):
+    plt = get_pyplot()
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))  # 1 ligne, 2 colonnes
+    values = list(subdirectories.values())  # number of pics in the folder
+    labels = list(subdirectories.keys())  # name of the folder
+    axes[0].pie(values, labels=labels, autopct='%1.1f%%')
+    axes[1].bar(labels, values)
+    axes[1].set_xlabel('Folders')
+    axes[1].set_ylabel('Number of Images')
+    # Alignement à droite pour meilleure lisibilité
+    plt.setp(axes[1].xaxis.get_majorticklabels(), rotation=45, ha='right')
+    fig.suptitle("Distribution in folder \"{}\"".format(directory))
+    fig.tight_layout()
+    return fig
+
+
+def prediction_figure(image_path, class_names, probabilities):
+    """Picture next to a bar chart of the class probabilities"""
+    import numpy as np
+    from PIL import Image
+
+    plt = get_pyplot()
+    idx = int(np.argmax(probabilities))
+    fig = plt.figure(figsize=(12, 5))
+
+    ax = fig.add_subplot(1, 2, 1)
+    with Image.open(image_path) as img:
+        ax.imshow(img.convert('RGB'))
+    ax.set_title("Predicted: {}\nConfidence: {:.1f}%".format(
+        class_names[idx], probabilities[idx] * 100))
+    ax.axis('off')
+
+    ax = fig.add_subplot(1, 2, 2)
+    y_pos = np.arange(len(class_names))
+    ax.barh(y_pos, probabilities * 100)
+    ax.set_yticks(y_pos, class_names)
+    ax.set_xlabel('Confidence (%)')
+    ax.set_title('Prediction Probabilities')
+    ax.set_xlim(0, 100)
+    for i, v in enumerate(probabilities * 100):
+        ax.text(v + 1, i, '{:.1f}%'.format(v), va='center')
+
+    fig.tight_layout()
+    return fig
+
+
+def save_figure(fig, path):
+    fig.savefig(path)
+    get_pyplot().close(fig)
+    return path
+
+
+def show_figure(fig):
+    if is_interactive():
+        get_pyplot().show()
+    else:
+        print("No display available, use an output file to save the plot")
+    get_pyplot().close(fig)
+
+
+def write_prediction_report(results, out_dir, title="Prediction report"):
+    """Summarize many predictions in one HTML page with two charts
+
+    results are the dicts produced by predict.top_k_results. Only
+    aggregate figures are drawn, so the cost does not grow with one
+    figure per image.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    plt = get_pyplot()
+    predicted = Counter(r['prediction'] for r in results)
+    confidences = [r['confidence'] * 100 for r in results]
+
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    labels = sorted(predicted)
+    axes[0].bar(labels, [predicted[name] for name in labels])
+    axes[0].set_ylabel('Images')
+    axes[0].set_title('Predicted classes')
+    plt.setp(axes[0].xaxis.get_majorticklabels(), rotation=45, ha='right')
+    axes[1].hist(confidences, bins=20, range=(0, 100))
+    axes[1].set_xlabel('Confidence (%)')
+    axes[1].set_title('Confidence distribution')
+    fig.tight_layout()
+    save_figure(fig, os.path.join(out_dir, 'summary.png'))
+
+    rows = "\n".join(
+        "<tr><td>{}</td><td>{}</td><td>{:.1f}%</td><td>{}</td></tr>".format(
+            html.escape(r['image']), html.escape(r['prediction']),
+            r['confidence'] * 100,
+            ", ".join("{} {:.1f}%".format(html.escape(n), p * 100)
+                      for n, p in r['top_k']))
+        for r in sorted(results, key=lambda r: r['confidence']))
+    page = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>body{{font-family:sans-serif}}td,th{{padding:2px 8px}}</style>
+</head><body>
+<h1>{title}</h1>
+<p>{count} images, mean confidence {mean:.1f}%</p>
+<img src="summary.png" alt="summary">
+<h2>Predictions, least confident first</h2>
+<table><tr><th>Image</th><th>Prediction</th><th>Confidence</th>
+<th>Top classes</th></tr>
+{rows}
+</table></body></html>
+""".format(title=html.escape(title), count=len(results),
+           mean=sum(confidences) / len(confidences) if confidences else 0,
+           rows=rows)
+    path = os.path.join(out_dir, 'report.html')
+    with open(path, 'w') as f:
+        f.write(page)
+    return path
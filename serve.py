@@ -0,0 +1,303 @@
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from model_bundle import ModelBundle
+from predict import load_and_preprocess, load_predictor, top_k_results
+
+
+class LatencyStats:
+    """Thread-safe request counters and a rolling latency window"""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.started = time.monotonic()
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_images = 0
+
+    def record(self, latency):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batched_images += size
+
+    def count(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64)
+            uptime = time.monotonic() - self.started
+            snap = {
+                'uptime_s': uptime,
+                'requests': self.requests,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch_size': (self.batched_images / self.batches
+                                    if self.batches else 0.0),
+                'throughput_rps': self.requests / uptime if uptime else 0.0,
+            }
+        if len(latencies):
+            for q in (50, 95, 99):
+                snap['p{}_ms'.format(q)] = float(
+                    np.percentile(latencies, q) * 1000)
+            snap['max_ms'] = float(latencies.max() * 1000)
+        else:
+            snap['p50_ms'] = snap['p95_ms'] = snap['p99_ms'] = None
+            snap['max_ms'] = None
+        return snap
+
+
+class MicroBatcher:
+    """Group concurrent requests into batches for a single model
+
+    A request waits at most max_delay seconds for others to join its batch;
+    a batch is dispatched as soon as it holds max_batch images. The queue is
+    bounded so callers get queue.Full instead of unbounded latency.
+    """
+
+    def __init__(self, model, class_names, max_batch=32, max_delay=0.01,
+                 max_queue=256, top_k=3, stats=None):
+        self.model = model
+        self.class_names = class_names
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.top_k = top_k
+        self.stats = stats or LatencyStats()
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.running = False
+
+    def warmup(self, input_shape):
+        """Run every padded batch size once so no request pays tracing"""
+        size = 1
+        while True:
+            self.model.predict_on_batch(
+                np.zeros((size,) + tuple(input_shape), dtype=np.float32))
+            if size >= self.max_batch:
+                break
+            size *= 2
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def submit(self, name, array):
+        """Queue one preprocessed image, raises queue.Full when saturated"""
+        future = Future()
+        self.queue.put_nowait((name, array, future))
+        return future
+
+    def _collect(self):
+        try:
+            first = self.queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        items = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(items) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while self.running:
+            items = self._collect()
+            if not items:
+                continue
+            # Pad to a power of two so the model only sees a handful of
+            # distinct batch shapes.
+            size = 1
+            while size < len(items):
+                size *= 2
+            batch = np.zeros((size,) + items[0][1].shape, dtype=np.float32)
+            for i, (_, array, _) in enumerate(items):
+                batch[i] = array
+            try:
+                predictions = np.asarray(self.model.predict_on_batch(batch))
+            except Exception as e:
+                for _, _, future in items:
+                    future.set_exception(e)
+                continue
+            self.stats.record_batch(len(items))
+            results = top_k_results([name for name, _, _ in items],
+                                    predictions[:len(items)],
+                                    self.class_names, self.top_k)
+            for (_, _, future), result in zip(items, results):
+                future.set_result(result)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of uploads would otherwise overflow the default backlog of 5
+    request_queue_size = 128
+
+
+def resolve_image(image_root, path):
+    """Real path of path under image_root, or None if it leads outside"""
+    root = os.path.realpath(image_root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    return resolved if os.path.commonpath([root, resolved]) == root else None
+
+
+def make_handler(batcher, img_height=224, img_width=224, timeout=30.0,
+                 image_root=None):
+    """Handler class for the server
+
+    Uploads are always accepted. A JSON {"path": ...} body names a file
+    under image_root instead; it is refused without one.
+    """
+    stats = batcher.stats
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, stats.snapshot())
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': 'not found'})
+                return
+            start = time.monotonic()
+            length = int(self.headers.get('Content-Length', 0))
+            data = self.rfile.read(length)
+            try:
+                if self.headers.get('Content-Type') == 'application/json':
+                    name = json.loads(data)['path']
+                    source = (resolve_image(image_root, name)
+                              if image_root else None)
+                    if source is None:
+                        stats.count('errors')
+                        self._send_json(403, {
+                            'error': 'only files under the --image-root '
+                                     'of the server can be named'})
+                        return
+                else:
+                    source = io.BytesIO(data)
+                    name = self.headers.get('X-Image-Name', 'upload')
+                array = load_and_preprocess(source, img_height, img_width)
+            except (OSError, ValueError, KeyError) as e:
+                stats.count('errors')
+                self._send_json(400, {'error': str(e)})
+                return
+            try:
+                future = batcher.submit(name, array)
+            except queue.Full:
+                stats.count('rejected')
+                self._send_json(503, {'error': 'server busy'})
+                return
+            try:
+                result = future.result(timeout=timeout)
+            except Exception as e:
+                stats.count('errors')
+                self._send_json(500, {'error': str(e)})
+                return
+            stats.record(time.monotonic() - start)
+            self._send_json(200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='serve.py',
+        description='Serve plant disease predictions over HTTP with '
+                    'dynamic micro-batching'
+    )
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to bind (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on (default: 8080)')
+    parser.add_argument('--model', default='./model/best_model.keras',
+                        help='Model file (default: '
+                             './model/best_model.keras)')
+    parser.add_argument('--max-batch', type=int, default=32,
+                        help='Maximum images per forward pass (default: 32)')
+    parser.add_argument('--max-delay-ms', type=float, default=10.0,
+                        help='Longest a request waits for its batch to fill '
+                             '(default: 10)')
+    parser.add_argument('--max-queue', type=int, default=256,
+                        help='Pending requests before answering 503 '
+                             '(default: 256)')
+    parser.add_argument('--top-k', type=int, default=3,
+                        help='Class probabilities per answer (default: 3)')
+    parser.add_argument('--image-root',
+                        help='Also accept JSON {"path": ...} requests for '
+                             'files under this directory (default: '
+                             'uploads only)')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print("Error: Model file not found: {}".format(args.model))
+        exit(1)
+    if args.image_root and not os.path.isdir(args.image_root):
+        print("Error: Image root not found: {}".format(args.image_root))
+        exit(1)
+
+    try:
+        bundle = ModelBundle.load(os.path.dirname(args.model))
+        model = load_predictor([args.model], bundle=bundle)
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e))
+        exit(1)
+    batcher = MicroBatcher(model, bundle.class_names,
+                           max_batch=args.max_batch,
+                           max_delay=args.max_delay_ms / 1000,
+                           max_queue=args.max_queue,
+                           top_k=args.top_k)
+    batcher.warmup(bundle.input_shape)
+    batcher.start()
+    server = InferenceServer((args.host, args.port),
+                             make_handler(batcher, bundle.img_height,
+                                          bundle.img_width,
+                                          image_root=args.image_root))
+    print("Serving on http://{}:{}  (POST /predict, GET /metrics)".format(
+        args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
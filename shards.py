@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+INDEX_NAME = "index.json"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def is_shard_dir(path):
+    return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+
+def load_resized(path, size=224):
+    """Decode a picture to a (size, size, 3) uint8 array
+
+    Resizing is nearest neighbour, as predict.py resizes what it serves.
+    """
+    with Image.open(path) as img:
+        img = img.convert("RGB").resize((size, size), Image.NEAREST)
+        return np.asarray(img, dtype=np.uint8)
+
+
+def pack_dataset(data_dir, out_dir, size=224, shard_size=4096, workers=8):
+    """Pack an images/<class>/ tree into raw uint8 .npy shards plus index
+
+    Each shard is an (n, size, size, 3) uint8 array that readers open
+    memory-mapped; index.json records class names and counts, and the
+    shard, offset, label and source file of every image.
+    """
+    class_names = sorted(d for d in os.listdir(data_dir)
+                         if os.path.isdir(os.path.join(data_dir, d)))
+    sources, labels = [], []
+    for label, class_name in enumerate(class_names):
+        class_dir = os.path.join(data_dir, class_name)
+        for f in sorted(os.listdir(class_dir)):
+            if f.lower().endswith(IMAGE_EXTENSIONS):
+                sources.append(os.path.join(class_name, f))
+                labels.append(label)
+    if not sources:
+        print("No images found in {}".format(data_dir))
+        return None
+
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for shard_id, first in enumerate(range(0, len(sources), shard_size)):
+            chunk = sources[first:first + shard_size]
+            name = "shard-{:05d}.npy".format(shard_id)
+            out = np.lib.format.open_memmap(
+                os.path.join(out_dir, name), mode="w+", dtype=np.uint8,
+                shape=(len(chunk), size, size, 3))
+            paths = [os.path.join(data_dir, s) for s in chunk]
+            for i, array in enumerate(pool.map(
+                    lambda p: load_resized(p, size), paths)):
+                out[i] = array
+            out.flush()
+            del out
+            shards.append({"file": name, "count": len(chunk)})
+            done = first + len(chunk)
+            print("\r{}/{} images packed ({:.1f} images/sec)".format(
+                done, len(sources), done / (time.perf_counter() - start)),
+                end="", flush=True)
+    print()
+
+    index = {
+        "size": size,
+        "resize": "nearest",
+        "class_names": class_names,
+        "class_counts": {name: labels.count(i)
+                         for i, name in enumerate(class_names)},
+        "shards": shards,
+        "labels": labels,
+        "sources": sources,
+    }
+    with open(os.path.join(out_dir, INDEX_NAME), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+class ShardDataset:
+    """Random and sequential access to a packed shard directory"""
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, INDEX_NAME)) as f:
+            index = json.load(f)
+        self.size = index["size"]
+        # Directories packed before the resize was recorded are bilinear
+        self.resize = index.get("resize", "bilinear")
+        self.class_names = index["class_names"]
+        self.class_counts = index["class_counts"]
+        self.labels = np.array(index["labels"], dtype=np.int32)
+        self.sources = index["sources"]
+        self.shards = [np.load(os.path.join(shard_dir, s["file"]),
+                               mmap_mode="r") for s in index["shards"]]
+        counts = [s["count"] for s in index["shards"]]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def check_resize(self):
+        """Raise ValueError unless images were resized as predict.py does"""
+        if self.resize != "nearest":
+            raise ValueError("{} was packed with {} resizing but predict.py "
+                             "serves nearest; pack it again with shards.py"
+                             .format(self.shard_dir, self.resize))
+
+    def locate(self, i):
+        shard = int(np.searchsorted(self.offsets, i, side="right") - 1)
+        return shard, i - self.offsets[shard]
+
+    def __getitem__(self, i):
+        shard, offset = self.locate(i)
+        return self.shards[shard][offset], self.labels[i]
+
+    def read(self, indices):
+        """Gather images for sorted indices, slicing contiguous runs
+
+        Consecutive indices within one shard are copied with a single
+        slice of its memory map.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty((len(indices), self.size, self.size, 3), np.uint8)
+        if not len(indices):
+            return out
+        shards = np.searchsorted(self.offsets, indices, side="right") - 1
+        breaks = np.flatnonzero((np.diff(indices) != 1) |
+                                (np.diff(shards) != 0)) + 1
+        for start, end in zip(np.r_[0, breaks], np.r_[breaks, len(indices)]):
+            shard = shards[start]
+            offset = indices[start] - self.offsets[shard]
+            out[start:end] = self.shards[shard][offset:offset + end - start]
+        return out
+
+    def iter_batches(self, batch_size=32, indices=None, shuffle=False,
+                     seed=None):
+        """Yield (images, labels, indices) batches
+
+        Without shuffling, rows are read in on-disk order. With shuffling,
+        batches are drawn in random order but each batch is read sorted to
+        keep the access pattern as sequential as possible.
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices)
+        if shuffle:
+            indices = np.random.default_rng(seed).permutation(indices)
+        for first in range(0, len(indices), batch_size):
+            batch = np.sort(indices[first:first + batch_size])
+            yield self.read(batch), self.labels[batch], batch
+
+    def split(self, validation_split=0.2, seed=123):
+        """Return (train_indices, val_indices)"""
+        order = np.random.default_rng(seed).permutation(len(self))
+        num_val = int(len(self) * validation_split)
+        return np.sort(order[num_val:]), np.sort(order[:num_val])
+
+    def as_tf_dataset(self, indices=None, batch_size=32, shuffle=False,
+                      seed=None):
+        """tf.data pipeline of (uint8 images, one-hot labels) batches"""
+        import tensorflow as tf
+
+        num_classes = len(self.class_names)
+        epoch = [0]
+
+        def generate():
+            epoch_seed = None if seed is None else seed + epoch[0]
+            epoch[0] += 1
+            for images, labels, _ in self.iter_batches(
+                    batch_size, indices, shuffle, epoch_seed):
+                yield images, np.eye(num_classes, dtype=np.float32)[labels]
+
+        count = len(self) if indices is None else len(indices)
+        return tf.data.Dataset.from_generator(
+            generate,
+            output_signature=(
+                tf.TensorSpec((None, self.size, self.size, 3), tf.uint8),
+                tf.TensorSpec((None, num_classes), tf.float32),
+            )).apply(tf.data.experimental.assert_cardinality(
+                -(-count // batch_size)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='shards.py',
+        description='Pack an images/<class>/ tree into memory-mapped '
+                    'shards, or describe an existing shard directory'
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    pack = sub.add_parser("pack", help="Pack a dataset")
+    pack.add_argument("data_dir", help="Directory of class subdirectories")
+    pack.add_argument("out_dir", help="Directory to write shards to")
+    pack.add_argument("--size", type=int, default=224,
+                      help="Square image resolution (default: 224)")
+    pack.add_argument("--shard-size", type=int, default=4096,
+                      help="Images per shard file (default: 4096)")
+    pack.add_argument("--workers", type=int, default=8,
+                      help="Decoding threads (default: 8)")
+    info = sub.add_parser("info", help="Show class counts of a shard dir")
+    info.add_argument("shard_dir")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        if not os.path.isdir(args.data_dir):
+            print("The directory {} does not exist.".format(args.data_dir))
+            exit(1)
+        pack_dataset(args.data_dir, args.out_dir, args.size,
+                     args.shard_size, args.workers)
+    else:
+        if not is_shard_dir(args.shard_dir):
+            print("{} is not a shard directory.".format(args.shard_dir))
+            exit(1)
+        dataset = ShardDataset(args.shard_dir)
+        print("{} images, {}x{} ({} resize), {} shards".format(
+            len(dataset), dataset.size, dataset.size, dataset.resize,
+            len(dataset.shards)))
+        for name, count in dataset.class_counts.items():
+            print("{}: {} images".format(name, count))
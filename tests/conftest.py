@@ -0,0 +1,25 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# The scripts live at the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+@pytest.fixture
+def make_image(tmp_path):
+    """Write a random RGB image and return its path"""
+    rng = np.random.default_rng(0)
+
+    def make(name="leaf.png", size=(32, 24)):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(path)
+        return str(path)
+
+    return make
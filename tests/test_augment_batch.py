@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from augment_batch import BATCH_AUGMENTATIONS, load_batch, verify
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (4, 64, 48, 3), dtype=np.uint8)
+
+
+def test_kernels_match_pil_on_even_sizes(images):
+    for suffix, diff in verify(images).items():
+        assert diff["max_abs_diff"] == 0, suffix
+
+
+def test_kernels_keep_the_stack_layout(images):
+    for suffix, kernel in BATCH_AUGMENTATIONS.items():
+        out = kernel(images)
+        assert out.dtype == np.uint8, suffix
+        assert out.flags.c_contiguous, suffix
+        expected = (4, 32, 24, 3) if suffix == "_Zoom" else images.shape
+        assert out.shape == expected, suffix
+
+
+def test_load_batch_stacks_pictures(make_image):
+    batch = load_batch([make_image("a.png"), make_image("b.png")])
+    assert batch.shape == (2, 24, 32, 3)
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from augmentation_cache import (DIGEST_EXT, AugmentationCache,
+                                augment_with_cache, fixed_tasks)
+
+
+@pytest.fixture
+def source(make_image):
+    return make_image("images/a/leaf.png")
+
+
+def outputs(source):
+    name, ext = os.path.splitext(source)
+    return [name + suffix + ext for suffix in ("_Rotate", "_Flip")]
+
+
+def test_outputs_are_copies_by_default(source, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    tasks = fixed_tasks(["_Rotate", "_Flip"])
+    assert augment_with_cache(source, tasks, cache_dir) == (2, 0)
+    first = [open(p, "rb").read() for p in outputs(source)]
+    assert augment_with_cache(source, tasks, cache_dir) == (2, 2)
+    assert [open(p, "rb").read() for p in outputs(source)] == first
+    for path in outputs(source):
+        assert os.stat(path).st_nlink == 1
+    entries = list(AugmentationCache(cache_dir).entries())
+    assert len(entries) == 2
+    assert all(links == 0 for _, _, _, links in entries)
+
+
+def test_edited_linked_output_is_not_served(source, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    tasks = fixed_tasks(["_Rotate"])
+    augment_with_cache(source, tasks, cache_dir, link=True)
+    output = outputs(source)[0]
+    assert os.stat(output).st_nlink == 2
+    original = open(output, "rb").read()
+    with open(output, "r+b") as f:
+        f.seek(len(original) // 2)
+        f.write(b"\0" * 16)
+
+    # The edit reached the entry, so the lookup refuses it and recomputes
+    assert augment_with_cache(source, tasks, cache_dir, link=True) == (1, 0)
+    assert open(output, "rb").read() == original
+
+
+def test_eviction_keeps_linked_entries_apart(source, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    augment_with_cache(source, fixed_tasks(["_Rotate"]), cache_dir,
+                       link=True)
+    augment_with_cache(source, fixed_tasks(["_Flip"]), cache_dir)
+    cache = AugmentationCache(cache_dir)
+    sizes = {links: size for _, size, _, links in cache.entries()}
+
+    removed, total, linked = cache.evict(0)
+    assert (removed, total, linked) == (1, 0, sizes[1])
+    (path, _, _, links), = cache.entries()
+    assert links == 1
+    digests = [f for _, _, files in os.walk(cache_dir) for f in files
+               if f.endswith(DIGEST_EXT)]
+    assert digests == [os.path.basename(path) + DIGEST_EXT]
+
+
+def test_entry_without_digest_is_recomputed(source, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    tasks = fixed_tasks(["_Flip"])
+    augment_with_cache(source, tasks, cache_dir)
+    (path, _, _, _), = AugmentationCache(cache_dir).entries()
+    os.remove(path + DIGEST_EXT)
+    assert augment_with_cache(source, tasks, cache_dir) == (1, 0)
+    assert os.path.exists(path + DIGEST_EXT)
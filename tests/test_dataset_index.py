@@ -0,0 +1,41 @@
+import os
+
+from dataset_index import RACY_WINDOW_NS, DatasetIndex, scan_class
+
+
+def test_file_added_in_the_same_tick_is_found(make_image, tmp_path):
+    make_image("images/a/one.png")
+    class_dir = str(tmp_path / "images" / "a")
+    mtime = os.stat(class_dir).st_mtime_ns
+    assert DatasetIndex.scan(str(tmp_path / "images")).counts() == {"a": 1}
+
+    # A coarse clock leaves the directory mtime where the scan saw it
+    make_image("images/a/two.png")
+    os.utime(class_dir, ns=(mtime, mtime))
+    index = DatasetIndex.scan(str(tmp_path / "images"))
+    assert index.counts() == {"a": 2}
+    assert DatasetIndex.load(str(tmp_path / "images")).counts() == {"a": 2}
+
+
+def test_settled_directory_is_not_listed_again(make_image, tmp_path):
+    make_image("images/a/one.png")
+    class_dir = str(tmp_path / "images" / "a")
+    entry = scan_class(class_dir)
+    entry["scanned_ns"] = entry["mtime_ns"] + RACY_WINDOW_NS + 1
+    assert scan_class(class_dir, entry) is entry
+
+
+def test_racy_file_is_read_again(make_image, tmp_path):
+    make_image("images/a/one.png", size=(32, 24))
+    class_dir = str(tmp_path / "images" / "a")
+    entry = scan_class(class_dir)
+    size, mtime_ns = entry["files"]["one.png"][:2]
+    assert entry["files"]["one.png"] == [size, mtime_ns, 32, 24]
+
+    # Same size and mtime, but recorded too soon after the write to trust
+    stale = {"mtime_ns": -1, "scanned_ns": mtime_ns,
+             "files": {"one.png": [size, mtime_ns, 1, 1]}}
+    assert scan_class(class_dir, stale)["files"]["one.png"][2:] == [32, 24]
+
+    stale["scanned_ns"] = mtime_ns + RACY_WINDOW_NS + 1
+    assert scan_class(class_dir, stale)["files"]["one.png"][2:] == [1, 1]
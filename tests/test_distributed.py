@@ -0,0 +1,67 @@
+import json
+import subprocess
+import sys
+import time
+
+import pytest
+
+from distributed import load_config, stale_checkpoints, wait_workers
+
+
+def python(code):
+    return subprocess.Popen([sys.executable, "-c", code])
+
+
+def test_wait_workers_stops_survivors_of_a_failure():
+    survivor = python("import time; time.sleep(60)")
+    processes = [(survivor, None), (python("raise SystemExit(3)"), None)]
+    start = time.perf_counter()
+    assert not wait_workers(processes, interval=0.05)
+    assert time.perf_counter() - start < 30
+    assert survivor.returncode is not None
+
+
+def test_wait_workers_succeeds_when_all_exit_cleanly():
+    processes = [(python("pass"), None), (python("pass"), None)]
+    assert wait_workers(processes, interval=0.05)
+
+
+def test_stale_checkpoints_lists_only_what_training_writes(tmp_path):
+    for name in ("checkpoint", "ckpt-3.index",
+                 "ckpt-3.data-00000-of-00001"):
+        (tmp_path / name).write_text("")
+    (tmp_path / "worker-1").mkdir()
+    (tmp_path / "worker-1" / "ckpt-3.index").write_text("")
+    # Another run of a scaling launch keeps its checkpoints
+    (tmp_path / "workers-2").mkdir()
+    (tmp_path / "workers-2" / "checkpoint").write_text("")
+    stale = sorted(p.rsplit("/", 1)[-1]
+                   for p in stale_checkpoints(str(tmp_path)))
+    assert stale == ["checkpoint", "ckpt-3.data-00000-of-00001",
+                     "ckpt-3.index", "worker-1"]
+
+
+def test_stale_checkpoints_refuses_a_directory_with_other_data(tmp_path):
+    (tmp_path / "checkpoint").write_text("")
+    (tmp_path / "bundle.json").write_text("{}")
+    with pytest.raises(ValueError, match="bundle.json"):
+        stale_checkpoints(str(tmp_path))
+
+
+def test_stale_checkpoints_refuses_foreign_files_in_scratch_dirs(tmp_path):
+    (tmp_path / "worker-1").mkdir()
+    (tmp_path / "worker-1" / "notes.txt").write_text("")
+    with pytest.raises(ValueError, match="worker-1"):
+        stale_checkpoints(str(tmp_path))
+
+
+def test_stale_checkpoints_of_a_missing_directory(tmp_path):
+    assert stale_checkpoints(str(tmp_path / "none")) == []
+
+
+def test_checkpoint_dir_defaults_under_the_output_dir(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({"output_dir": "out"}))
+    assert load_config(str(path))["checkpoint_dir"] == "out/checkpoints"
+    assert load_config(str(path), checkpoint_dir="elsewhere")[
+        "checkpoint_dir"] == "elsewhere"
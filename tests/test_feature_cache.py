@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from feature_cache import (FeatureStore, decode_images, list_images,
+                           preprocessing_signature)
+from predict import load_and_preprocess
+
+
+class MeanExtractor:
+    """Per-channel means as features, counting the images it sees"""
+
+    def __init__(self):
+        self.seen = 0
+
+    def predict(self, ds, verbose=0):
+        features = np.concatenate([batch.numpy().mean(axis=(1, 2))
+                                   for batch in ds])
+        self.seen += len(features)
+        return features
+
+
+def test_decoded_like_predict_serves(make_image):
+    path = make_image(size=(32, 24))
+    batch = next(iter(decode_images([path], 12, 16)))
+    np.testing.assert_allclose(batch.numpy()[0],
+                               load_and_preprocess(path, 12, 16), atol=1e-6)
+
+
+def test_store_computes_only_misses(make_image, tmp_path):
+    paths = [make_image("data/a/{}.png".format(i)) for i in range(3)]
+    signature = preprocessing_signature(12, 16)
+    extractor = MeanExtractor()
+    first = np.array(FeatureStore(str(tmp_path / "cache"), signature)
+                     .get_or_compute(paths, extractor))
+    assert first.shape == (3, 3)
+
+    paths.append(make_image("data/b/0.png"))
+    store = FeatureStore(str(tmp_path / "cache"), signature)
+    features = store.get_or_compute(paths, extractor)
+    assert extractor.seen == 4
+    np.testing.assert_array_equal(features[:3], first)
+    assert list_images(str(tmp_path / "data"))[2] == ["a", "b"]
+
+
+def test_changed_signature_discards_the_store(make_image, tmp_path):
+    paths = [make_image()]
+    extractor = MeanExtractor()
+    FeatureStore(str(tmp_path / "cache"),
+                 preprocessing_signature(12, 16)).get_or_compute(
+                     paths, extractor)
+    signature = dict(preprocessing_signature(12, 16), resize="bilinear")
+    FeatureStore(str(tmp_path / "cache"), signature).get_or_compute(
+        paths, extractor)
+    assert extractor.seen == 2
+
+
+def test_no_images_is_an_error(tmp_path):
+    store = FeatureStore(str(tmp_path), preprocessing_signature(12, 16))
+    with pytest.raises(ValueError, match="no images"):
+        store.get_or_compute([])
@@ -0,0 +1,103 @@
+import os
+from multiprocessing import resource_tracker
+
+import numpy as np
+import pytest
+
+from image_cache import ImageCache, _untracked, decode, parse_spec
+
+# make_image's default 32x24 RGB picture
+IMAGE_BYTES = 32 * 24 * 3
+
+
+@pytest.fixture
+def images(make_image):
+    return [make_image("{}.png".format(name)) for name in "abc"]
+
+
+def test_lru_evicts_the_least_recently_used(images):
+    a, b, c = images
+    cache = ImageCache(max_bytes=2 * IMAGE_BYTES + 100)
+    cache.load(a)
+    cache.load(b)
+    cache.load(a)
+    cache.load(c)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 3, 1)
+    assert (stats["entries"], stats["bytes"]) == (2, 2 * IMAGE_BYTES)
+    cache.load(a)
+    assert cache.stats()["hits"] == 2
+    cache.load(b)
+    assert cache.stats()["misses"] == 4
+
+
+def test_arrays_are_shared_and_read_only(images):
+    cache = ImageCache()
+    array = cache.load(images[0])
+    assert cache.load(images[0]) is array
+    assert not array.flags.writeable
+    np.testing.assert_array_equal(array, decode(images[0]))
+
+
+def test_edited_file_is_decoded_again(images):
+    cache = ImageCache()
+    cache.load(images[0])
+    st = os.stat(images[0])
+    os.utime(images[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    cache.load(images[0])
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["bytes"] == 2 * IMAGE_BYTES
+
+
+def test_oversized_and_disabled_caches_keep_nothing(images):
+    for cache in (ImageCache(max_bytes=IMAGE_BYTES - 1),
+                  ImageCache(max_bytes=0)):
+        cache.load(images[0])
+        cache.load(images[0])
+        stats = cache.stats()
+        assert stats["misses"] == 2
+        assert (stats["entries"], stats["bytes"]) == (0, 0)
+
+
+def test_resized_loads_are_separate_entries(images):
+    cache = ImageCache()
+    assert cache.load(images[0], (8, 8)).shape == (8, 8, 3)
+    assert cache.load(images[0]).shape == (24, 32, 3)
+    assert cache.stats()["entries"] == 2
+
+
+def test_shared_segments_are_attached_then_unlinked(images):
+    creator = ImageCache(shared=True)
+    other = ImageCache(shared=True)
+    try:
+        published = creator.load(images[0])
+        attached = other.load(images[0])
+        assert other.stats()["shared_hits"] == 1
+        np.testing.assert_array_equal(attached, published)
+        assert not attached.flags.writeable
+    finally:
+        creator.close()
+    late = ImageCache(shared=True)
+    try:
+        late.load(images[0])
+        assert late.stats()["misses"] == 1
+        # Views still held keep their mapping after the unlink
+        np.testing.assert_array_equal(attached, decode(images[0]))
+    finally:
+        late.close()
+        other.close()
+
+
+def test_untracked_restores_the_tracker_hook():
+    register = resource_tracker.register
+    with pytest.raises(RuntimeError):
+        with _untracked():
+            assert resource_tracker.register is not register
+            raise RuntimeError
+    assert resource_tracker.register is register
+
+
+def test_parse_spec():
+    assert parse_spec("") == (0, False)
+    assert parse_spec("64M") == (64 << 20, False)
+    assert parse_spec("1G:shared") == (1 << 30, True)
@@ -0,0 +1,91 @@
+import json
+import os
+
+import pytest
+
+from model_bundle import (MANIFEST_NAME, ModelBundle, add_model,
+                          write_class_names, write_manifest)
+
+
+class FakeModel:
+    def __init__(self, classes=2, size=224):
+        self.output_shape = (None, classes)
+        self.input_shape = (None, size, size, 3)
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    for name in ("best_model.keras", "final_model.keras",
+                 "best_model.tflite"):
+        (tmp_path / name).write_bytes(name.encode())
+    return str(tmp_path)
+
+
+def test_manifest_records_only_the_models_named(model_dir):
+    manifest = write_manifest(model_dir, ["a", "b"],
+                              ["best_model.keras", "final_model.keras"])
+    assert sorted(manifest["models"]) == ["best_model.keras",
+                                          "final_model.keras"]
+    with open(os.path.join(model_dir, "class_names.txt")) as f:
+        assert f.read() == "a\nb\n"
+
+
+def test_check_accepts_recorded_models(model_dir):
+    write_manifest(model_dir, ["a", "b"], ["best_model.keras"])
+    add_model(model_dir, "best_model.tflite")
+    bundle = ModelBundle.load(model_dir)
+    for name in ("best_model.keras", "best_model.tflite"):
+        bundle.check(FakeModel(), os.path.join(model_dir, name))
+
+
+def test_check_refuses_an_unrecorded_model(model_dir):
+    write_manifest(model_dir, ["a", "b"], ["best_model.keras"])
+    bundle = ModelBundle.load(model_dir)
+    with pytest.raises(ValueError, match="not part of the bundle"):
+        bundle.check(FakeModel(),
+                     os.path.join(model_dir, "best_model.tflite"))
+
+
+def test_check_refuses_a_changed_model(model_dir):
+    write_manifest(model_dir, ["a", "b"], ["best_model.keras"])
+    path = os.path.join(model_dir, "best_model.keras")
+    with open(path, "ab") as f:
+        f.write(b"!")
+    with pytest.raises(ValueError, match="changed since"):
+        ModelBundle.load(model_dir).check(FakeModel(), path)
+
+
+def test_check_refuses_other_classes_and_sizes(model_dir):
+    write_manifest(model_dir, ["a", "b"], ["best_model.keras"])
+    bundle = ModelBundle.load(model_dir)
+    path = os.path.join(model_dir, "best_model.keras")
+    with pytest.raises(ValueError, match="predicts 3 classes"):
+        bundle.check(FakeModel(classes=3), path)
+    with pytest.raises(ValueError, match="bundle expects"):
+        bundle.check(FakeModel(size=128), path)
+
+
+def test_directory_without_manifest_serves_any_model(model_dir):
+    write_class_names(model_dir, ["a", "b"])
+    bundle = ModelBundle.load(model_dir)
+    assert bundle.manifest["version"] == 0
+    bundle.check(FakeModel(), os.path.join(model_dir, "best_model.tflite"))
+
+
+def test_manifest_must_match_class_names(model_dir):
+    write_manifest(model_dir, ["a", "b"], ["best_model.keras"])
+    write_class_names(model_dir, ["b", "a"])
+    with pytest.raises(ValueError, match="does not match"):
+        ModelBundle.load(model_dir)
+
+
+def test_newer_bundle_version_is_refused(model_dir):
+    write_manifest(model_dir, ["a", "b"], ["best_model.keras"])
+    path = os.path.join(model_dir, MANIFEST_NAME)
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest["version"] += 1
+    with open(path, "w") as f:
+        json.dump(manifest, f)
+    with pytest.raises(ValueError, match="bundle version"):
+        ModelBundle.load(model_dir)
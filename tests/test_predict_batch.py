@@ -0,0 +1,57 @@
+import csv
+import json
+
+import numpy as np
+
+from predict import iter_batches, top_k_results, write_results
+
+
+def test_top_k_results_orders_classes_by_probability():
+    probabilities = np.array([[0.1, 0.7, 0.2], [0.5, 0.2, 0.3]])
+    results = top_k_results(["a.jpg", "b.jpg"], probabilities,
+                            ["rust", "scab", "healthy"], top_k=2)
+    assert [r["prediction"] for r in results] == ["scab", "rust"]
+    assert results[0]["confidence"] == 0.7
+    assert results[1]["top_k"] == [["rust", 0.5], ["healthy", 0.3]]
+
+
+def test_top_k_results_ignores_padding_rows():
+    probabilities = np.eye(3)
+    results = top_k_results(["a.jpg"], probabilities, ["x", "y", "z"])
+    assert len(results) == 1
+
+
+def test_write_results_jsonl_to_stdout(capsys):
+    results = top_k_results(["a.jpg"], np.array([[0.25, 0.75]]),
+                            ["x", "y"])
+    assert write_results(results) == 1
+    line = capsys.readouterr().out.strip()
+    assert json.loads(line)["prediction"] == "y"
+
+
+def test_write_results_csv_from_extension(tmp_path):
+    path = str(tmp_path / "out.csv")
+    results = top_k_results(["a.jpg"], np.array([[0.25, 0.75]]),
+                            ["x", "y"])
+    write_results(results, path)
+    with open(path, newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows == [["image", "prediction", "confidence", "top_k"],
+                    ["a.jpg", "y", "0.7500", "y:0.7500;x:0.2500"]]
+
+
+def test_iter_batches_pads_and_skips_unreadable(make_image, tmp_path,
+                                                capsys):
+    good = [make_image("{}.png".format(i)) for i in range(3)]
+    bad = tmp_path / "bad.jpg"
+    bad.write_bytes(b"not an image")
+    paths = good[:2] + [str(bad)] + good[2:]
+    batches = list(iter_batches(paths, batch_size=2, img_height=8,
+                                img_width=8, workers=2))
+    assert [p for p, _ in batches] == [good[:2], good[2:]]
+    assert all(batch.shape == (2, 8, 8, 3) for _, batch in batches)
+    assert not batches[1][1][1].any()
+    # The warning must not corrupt JSONL results on stdout
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert "bad.jpg" in captured.err
@@ -0,0 +1,83 @@
+import base64
+import io
+import json
+import queue
+
+import numpy as np
+import pytest
+
+from predict import _gather, parse_request, stream_predict
+
+
+class ConstantModel:
+    def predict_on_batch(self, batch):
+        return np.tile([[0.25, 0.75]], (len(batch), 1))
+
+
+def test_parse_request_path_and_default_id():
+    assert parse_request('{"image": "a.png"}', 7) == (7, "a.png")
+    assert parse_request('{"id": "x", "image": "a.png"}', 7) == ("x", "a.png")
+
+
+def test_parse_request_base64():
+    line = json.dumps({"id": 1, "image_b64": base64.b64encode(
+        b"bytes").decode()})
+    request_id, source = parse_request(line, 1)
+    assert request_id == 1
+    assert source.read() == b"bytes"
+
+
+@pytest.mark.parametrize("line", [
+    '[1, 2]',
+    '{"id": 1}',
+    '{"image": 3}',
+    '{"image_b64": 3}',
+    '{"image_b64": null}',
+    '{"image_b64": ["a"]}',
+    '{"image_b64": "not base64!"}',
+    'not json',
+])
+def test_parse_request_rejects_with_value_error(line):
+    with pytest.raises(ValueError):
+        parse_request(line, 1)
+
+
+def test_gather_batches_until_the_end_of_stream():
+    lines = queue.Queue()
+    for number in range(1, 6):
+        lines.put((number, "", 0.0))
+    lines.put(None)
+    batches = [[number for number, _, _ in batch]
+               for batch in _gather(lines, 2, 60)]
+    assert batches == [[1, 2], [3, 4], [5]]
+
+
+def requests(make_image):
+    return [json.dumps({"id": "good", "image": make_image()}) + "\n",
+            json.dumps({"id": "bad", "image_b64": 3}) + "\n",
+            "\n",
+            json.dumps({"image": "missing.png"}) + "\n"]
+
+
+def test_stream_answers_in_order_with_errors(make_image):
+    out = io.StringIO()
+    stats = stream_predict(iter(requests(make_image)), out, ConstantModel(),
+                           ["a", "b"], batch_size=4, img_height=8,
+                           img_width=8)
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r["id"] for r in results] == ["good", 2, 4]
+    assert results[0]["prediction"] == "b"
+    assert "error" in results[1] and "error" in results[2]
+    assert stats.requests == 1 and stats.errors == 2
+
+
+def test_stream_reader_error_is_raised_after_answers(make_image):
+    def broken():
+        yield requests(make_image)[0]
+        raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid byte")
+
+    out = io.StringIO()
+    with pytest.raises(UnicodeDecodeError):
+        stream_predict(broken(), out, ConstantModel(), ["a", "b"],
+                       batch_size=4, img_height=8, img_width=8)
+    assert json.loads(out.getvalue())["id"] == "good"
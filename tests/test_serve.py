@@ -0,0 +1,119 @@
+import json
+import os
+import queue
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+from serve import InferenceServer, MicroBatcher, make_handler, resolve_image
+
+
+class RecordingModel:
+    """Scores from the first pixel, remembering every batch size"""
+
+    def __init__(self):
+        self.sizes = []
+
+    def predict_on_batch(self, batch):
+        self.sizes.append(len(batch))
+        first = batch[:, 0, 0, 0]
+        return np.stack([first, 1 - first], axis=1)
+
+
+@pytest.fixture
+def serve():
+    """Start a server on a free port; yields a POST helper"""
+    servers = []
+
+    def start(batcher, image_root=None):
+        server = InferenceServer(('127.0.0.1', 0), make_handler(
+            batcher, 8, 8, timeout=5, image_root=image_root))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+        def post(body, content_type='application/json'):
+            request = urllib.request.Request(
+                'http://127.0.0.1:{}/predict'.format(server.server_port),
+                data=body, headers={'Content-Type': content_type})
+            try:
+                with urllib.request.urlopen(request) as response:
+                    return response.status, json.load(response)
+            except urllib.error.HTTPError as e:
+                return e.code, json.load(e)
+
+        return post
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_batches_are_padded_to_a_power_of_two():
+    model = RecordingModel()
+    batcher = MicroBatcher(model, ['a', 'b'], max_batch=8, max_delay=0.5)
+    futures = [batcher.submit(str(i), np.full((2, 2, 3), i / 10, np.float32))
+               for i in range(3)]
+    batcher.start()
+    try:
+        results = [f.result(timeout=5) for f in futures]
+    finally:
+        batcher.stop()
+    assert model.sizes == [4]
+    assert [r['image'] for r in results] == ['0', '1', '2']
+    assert results[2]['top_k'][0] == ['b', pytest.approx(0.8)]
+    assert batcher.stats.batches == 1
+    assert batcher.stats.batched_images == 3
+
+
+def test_full_queue_answers_503(serve, make_image):
+    # Not started, so the one queue slot stays taken
+    batcher = MicroBatcher(RecordingModel(), ['a', 'b'], max_queue=1)
+    batcher.submit('waiting', np.zeros((8, 8, 3), np.float32))
+    post = serve(batcher)
+    with open(make_image(), 'rb') as f:
+        status, body = post(f.read(), 'image/png')
+    assert (status, body) == (503, {'error': 'server busy'})
+    assert batcher.stats.rejected == 1
+
+
+def test_paths_need_an_image_root(serve, make_image):
+    batcher = MicroBatcher(RecordingModel(), ['a', 'b'])
+    post = serve(batcher)
+    status, _ = post(json.dumps({'path': make_image()}).encode())
+    assert status == 403
+
+
+def test_paths_stay_under_the_image_root(serve, make_image, tmp_path):
+    make_image('root/a/leaf.png')
+    make_image('secret.png')
+    os.symlink(str(tmp_path / 'secret.png'), str(tmp_path / 'root' / 'l.png'))
+    batcher = MicroBatcher(RecordingModel(), ['a', 'b'])
+    batcher.start()
+    try:
+        post = serve(batcher, str(tmp_path / 'root'))
+        for path in ('../secret.png', str(tmp_path / 'secret.png'), 'l.png'):
+            status, _ = post(json.dumps({'path': path}).encode())
+            assert status == 403, path
+        status, body = post(json.dumps({'path': 'a/leaf.png'}).encode())
+    finally:
+        batcher.stop()
+    assert status == 200
+    assert body['image'] == 'a/leaf.png'
+
+
+def test_resolve_image(tmp_path):
+    root = str(tmp_path)
+    assert resolve_image(root, 'a/b.png') == os.path.join(
+        os.path.realpath(root), 'a', 'b.png')
+    assert resolve_image(root, 'a/../../b.png') is None
+
+
+def test_submit_raises_when_saturated():
+    batcher = MicroBatcher(RecordingModel(), ['a'], max_queue=1)
+    batcher.submit('one', np.zeros((2, 2, 3), np.float32))
+    with pytest.raises(queue.Full):
+        batcher.submit('two', np.zeros((2, 2, 3), np.float32))
@@ -0,0 +1,59 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from shards import INDEX_NAME, ShardDataset, load_resized, pack_dataset
+
+
+@pytest.fixture
+def packed(tmp_path, make_image):
+    """Seven images in shards of three: runs must split at 3 and 6"""
+    for i in range(4):
+        make_image("images/a/{}.png".format(i))
+    for i in range(3):
+        make_image("images/b/{}.png".format(i))
+    out = str(tmp_path / "packed")
+    pack_dataset(str(tmp_path / "images"), out, size=8, shard_size=3,
+                 workers=2)
+    return out
+
+
+def test_pack_records_nearest_resizing(packed, tmp_path):
+    dataset = ShardDataset(packed)
+    assert dataset.resize == "nearest"
+    assert len(dataset.shards) == 3
+    np.testing.assert_array_equal(
+        dataset[4][0],
+        load_resized(str(tmp_path / "images" / dataset.sources[4]), 8))
+    dataset.check_resize()
+
+
+@pytest.mark.parametrize("indices", [
+    [0, 1, 2, 3, 4, 5, 6],
+    [2, 3],
+    [1, 2, 4, 5, 6],
+    [0, 6],
+    [5],
+    [],
+])
+def test_read_matches_item_access(packed, indices):
+    dataset = ShardDataset(packed)
+    batch = dataset.read(indices)
+    assert batch.shape == (len(indices), 8, 8, 3)
+    for row, i in zip(batch, indices):
+        np.testing.assert_array_equal(row, dataset[i][0])
+
+
+def test_legacy_bilinear_pack_is_refused(packed):
+    path = os.path.join(packed, INDEX_NAME)
+    with open(path) as f:
+        index = json.load(f)
+    del index["resize"]
+    with open(path, "w") as f:
+        json.dump(index, f)
+    dataset = ShardDataset(packed)
+    assert dataset.resize == "bilinear"
+    with pytest.raises(ValueError, match="pack it again"):
+        dataset.check_resize()
@@ -0,0 +1,44 @@
+import pytest
+
+from model_bundle import read_validation_files, write_validation_files
+from tflite_export import split_files
+
+
+@pytest.fixture
+def data_dir(tmp_path, make_image):
+    for name in ("rust/a.png", "rust/b.png", "scab/c.png", "scab/d.png"):
+        make_image("images/" + name, (8, 8))
+    return str(tmp_path / "images")
+
+
+def test_validation_files_round_trip(tmp_path, data_dir):
+    paths = [data_dir + "/scab/d.png", data_dir + "/rust/a.png"]
+    write_validation_files(str(tmp_path), data_dir, paths)
+    assert read_validation_files(str(tmp_path)) == ["rust/a.png",
+                                                    "scab/d.png"]
+
+
+def test_shard_training_removes_an_older_split(tmp_path, data_dir):
+    write_validation_files(str(tmp_path), data_dir, [data_dir + "/rust/a.png"])
+    write_validation_files(str(tmp_path), data_dir, None)
+    with pytest.raises(ValueError, match="train again"):
+        read_validation_files(str(tmp_path))
+
+
+def test_split_files_keeps_the_recorded_split(data_dir):
+    training, validation = split_files(data_dir, ["rust/a.png", "scab/d.png"])
+    assert [p[len(data_dir) + 1:] for p in training] == ["rust/b.png",
+                                                         "scab/c.png"]
+    assert [p[len(data_dir) + 1:] for p in validation] == ["rust/a.png",
+                                                           "scab/d.png"]
+
+
+def test_split_files_rejects_other_data(data_dir):
+    with pytest.raises(ValueError, match="1 of the 2 validation images"):
+        split_files(data_dir, ["rust/a.png", "rust/gone.png"])
+
+
+def test_split_files_rejects_shards(tmp_path):
+    (tmp_path / "index.json").write_text("{}")
+    with pytest.raises(ValueError, match="shard directory"):
+        split_files(str(tmp_path), [])
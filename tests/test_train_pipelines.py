@@ -0,0 +1,38 @@
+import numpy as np
+import tensorflow as tf
+
+from predict import load_and_preprocess
+from train import build_augmenter, make_tf_datasets, preprocess_dataset
+
+
+def test_validation_images_match_what_predict_serves(make_image, tmp_path):
+    for name in ("a", "b"):
+        for i in range(5):
+            make_image("data/{}/{}.png".format(name, i), size=(32, 24))
+    _, val_ds, class_names = make_tf_datasets(
+        str(tmp_path / "data"), 12, 16, batch_size=4)
+    assert class_names == ["a", "b"]
+    images = np.concatenate([batch.numpy() for batch, _ in val_ds])
+    assert len(images) == len(val_ds.file_paths) == 2
+    for image, path in zip(images, val_ds.file_paths):
+        np.testing.assert_allclose(image, load_and_preprocess(path, 12, 16),
+                                   atol=1e-6)
+
+
+def test_preprocess_dataset_resizes_like_predict(make_image):
+    path = make_image(size=(32, 24))
+    pixels = load_and_preprocess(path, 24, 32)
+    # Undo MobileNetV2's scaling to get back the decoded pixels
+    raw = (pixels + 1) * 127.5
+    ds = tf.data.Dataset.from_tensors((raw[None], np.zeros((1, 2))))
+    image = next(iter(preprocess_dataset(ds, 12, 16)))[0].numpy()[0]
+    np.testing.assert_allclose(image, load_and_preprocess(path, 12, 16),
+                               atol=1e-5)
+
+
+def test_augmenter_keeps_shape_and_range():
+    images = np.random.default_rng(0).uniform(
+        0, 255, (2, 16, 16, 3)).astype(np.float32)
+    out = build_augmenter(seed=1)(images, training=True).numpy()
+    assert out.shape == images.shape
+    assert out.min() >= 0 and out.max() <= 255
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("plantcv")
+
+from benchmark import list_dataset, make_synthetic_dataset  # noqa: E402
+from Transformation import (FastTransformationPipeline,  # noqa: E402
+                            TransformationPipeline, fidelity)
+
+
+@pytest.fixture(scope="module")
+def paths(tmp_path_factory):
+    root = make_synthetic_dataset(str(tmp_path_factory.mktemp("images")),
+                                  classes=4, images=4, resolution=1024)
+    return list_dataset(root)[0]
+
+
+@pytest.mark.parametrize("work_size", [256, 512])
+def test_fast_landmarks_stay_close_to_the_full_ones(paths, work_size):
+    reports = [fidelity(TransformationPipeline(path),
+                        FastTransformationPipeline(path, work_size))
+               for path in paths]
+    working_px = 1024 / work_size
+    assert all(r["scale"] == work_size / 1024 for r in reports)
+    # A band width changed by a one-pixel extent difference can move a
+    # few landmarks much further, so only typical errors are pinned
+    assert np.mean([r["landmarks_mean_px"] for r in reports]) <= working_px
+    worst = np.median([r["landmarks_max_px"] for r in reports])
+    assert worst <= 2 * working_px
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from benchmark import time_model
+from tta import VIEWS, TTAEnsemble, center_crop, make_views
+
+
+class MeanModel:
+    """Two-class scores from each image's mean, so views can differ"""
+
+    def __init__(self):
+        self.batches = []
+
+    def predict_on_batch(self, batch):
+        self.batches.append(len(batch))
+        mean = batch.reshape(len(batch), -1).mean(axis=1) / 255
+        return np.stack([mean, 1 - mean], axis=1)
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (3, 16, 16, 3)).astype(np.float32)
+
+
+def test_center_crop_keeps_source_values(images):
+    cropped = center_crop(images)
+    assert cropped.shape == images.shape
+    # Nearest neighbour only copies pixels of the crop, never blends them
+    for image, crop in zip(images, cropped):
+        assert set(np.unique(crop)) <= set(np.unique(image[1:15, 1:15]))
+
+
+def test_views_are_grouped_image_by_image(images):
+    views = make_views(images, 3)
+    assert views.shape == (9, 16, 16, 3)
+    np.testing.assert_array_equal(views[3], images[1])
+    np.testing.assert_array_equal(views[4], images[1][:, ::-1])
+    np.testing.assert_array_equal(views[5], images[1][::-1])
+
+
+def test_ensemble_averages_views_then_models(images):
+    models = [MeanModel(), MeanModel()]
+    probs = TTAEnsemble(models, 2).predict_on_batch(images)
+    expected = MeanModel().predict_on_batch(images)
+    # A horizontal flip keeps the mean, so the average is unchanged
+    np.testing.assert_allclose(probs, expected, rtol=1e-6)
+    assert [m.batches for m in models] == [[6], [6]]
+
+
+@pytest.mark.parametrize("views", [0, len(VIEWS) + 1])
+def test_ensemble_refuses_views_out_of_range(views):
+    with pytest.raises(ValueError, match="views must be between"):
+        TTAEnsemble([MeanModel()], views)
+
+
+def test_time_model_warms_up_then_repeats(images):
+    model = MeanModel()
+    assert time_model(model, images, repeats=4) >= 0
+    assert model.batches == [3] * 5
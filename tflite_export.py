@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
+from benchmark import time_model
+from model_bundle import read_class_names, read_validation_files
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+QUANTIZATIONS = ('none', 'float16', 'int8')
+
+
+def split_files(data_dir, validation_files):
+    """(training, validation) image paths of data_dir
+
+    validation_files is the split recorded by the training run, relative
+    to data_dir; ValueError if data_dir does not hold all of it.
+    """
+    from feature_cache import list_images
+
+    if os.path.isfile(os.path.join(data_dir, 'index.json')):
+        raise ValueError("{} is a shard directory, image files are "
+                         "needed".format(data_dir))
+    held_out = set(validation_files)
+    training, validation = [], []
+    for path in list_images(data_dir)[0]:
+        name = os.path.relpath(path, data_dir).replace(os.sep, '/')
+        if name in held_out:
+            validation.append(path)
+        else:
+            training.append(path)
+    if len(validation) != len(held_out):
+        raise ValueError("{} of the {} validation images of the model are "
+                         "missing from {}".format(
+                             len(held_out) - len(validation), len(held_out),
+                             data_dir))
+    return training, validation
+
+
+def calibration_dataset(data_dir, validation_files, img_height=224,
+                        img_width=224, num_samples=200, seed=123):
+    """Representative inputs drawn evenly from the training images
+
+    The images the model validated on are left out, so the int8 model is
+    never calibrated on the ones compare_models judges it by.
+    """
+    paths = split_files(data_dir, validation_files)[0]
+    if not paths:
+        raise ValueError("No training images in {}".format(data_dir))
+    order = np.random.default_rng(seed).permutation(len(paths))
+    chosen = [paths[i] for i in order[:num_samples]]
+
+    def generate():
+        for path in chosen:
+            img = keras.utils.load_img(path,
+                                       target_size=(img_height, img_width))
+            array = preprocess_input(keras.utils.img_to_array(img))
+            yield [np.expand_dims(array, 0).astype(np.float32)]
+
+    return generate
+
+
+def export_tflite(model, output_path, quantization='none', data_dir=None,
+                  num_calibration=200, validation_files=None):
+    """Convert a Keras model (or .keras path) to a TFLite flatbuffer
+
+    float16 stores weights as half floats; int8 quantizes weights and
+    activations using calibration images from data_dir, outside the
+    validation_files of the model (read next to a .keras path by
+    default). Inputs and outputs stay float32 so callers feed the usual
+    preprocessed batch.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError("quantization must be one of {}".format(
+            ", ".join(QUANTIZATIONS)))
+    if isinstance(model, str):
+        if quantization == 'int8' and validation_files is None:
+            validation_files = read_validation_files(
+                os.path.dirname(model) or '.')
+        model = keras.models.load_model(model)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if data_dir is None or validation_files is None:
+            raise ValueError("int8 quantization needs calibration images "
+                             "and the validation split of the model")
+        height, width = model.input_shape[1:3]
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = calibration_dataset(
+            data_dir, validation_files, height, width, num_calibration)
+    tflite_model = converter.convert()
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+    # Next to a bundled model, the export becomes part of the bundle
+    from model_bundle import add_model
+    add_model(os.path.dirname(output_path) or '.',
+              os.path.basename(output_path))
+    print("TFLite model ({}) saved to {} ({:.1f} MB)".format(
+        quantization, output_path, len(tflite_model) / 1e6))
+    return output_path
+
+
+class TFLiteModel:
+    """TFLite interpreter behind the predict_on_batch interface of Keras"""
+
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path,
+                                               num_threads=num_threads)
+        inputs = self.interpreter.get_input_details()[0]
+        outputs = self.interpreter.get_output_details()[0]
+        self.input_index = inputs['index']
+        self.output_index = outputs['index']
+        # Keras-style shapes with an unknown batch axis
+        self.input_shape = (None,) + tuple(map(int, inputs['shape'][1:]))
+        self.output_shape = (None,) + tuple(map(int, outputs['shape'][1:]))
+        self.batch_size = None
+
+    def predict_on_batch(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        if batch.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index,
+                                                 batch.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch.shape[0]
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+
+def compare_models(keras_path, tflite_path, data_dir, img_height=224,
+                   img_width=224, batch_size=32, num_threads=None):
+    """Accuracy, agreement and latency of both models on the val split
+
+    The split is the one recorded next to keras_path by training, read
+    as predict.py reads images.
+    """
+    from predict import iter_batches
+
+    model_dir = os.path.dirname(keras_path) or '.'
+    class_names = read_class_names(model_dir)
+    paths = split_files(data_dir, read_validation_files(model_dir))[1]
+    if not paths:
+        raise ValueError("The model was trained without validation images")
+    models = {
+        'keras': keras.models.load_model(keras_path),
+        'tflite': TFLiteModel(tflite_path, num_threads),
+    }
+    labels, predictions = [], {name: [] for name in models}
+    for batch_paths, batch in iter_batches(paths, batch_size, img_height,
+                                           img_width):
+        labels.append([class_names.index(os.path.basename(
+            os.path.dirname(path))) for path in batch_paths])
+        for name, model in models.items():
+            predictions[name].append(np.argmax(
+                model.predict_on_batch(batch)[:len(batch_paths)], axis=1))
+    labels = np.concatenate(labels)
+    predictions = {k: np.concatenate(v) for k, v in predictions.items()}
+
+    sample = np.zeros((1, img_height, img_width, 3), np.float32)
+    report = {
+        'images': int(len(labels)),
+        'agreement': float(np.mean(predictions['keras'] ==
+                                   predictions['tflite'])),
+        'models': {},
+    }
+    for name, model in models.items():
+        path = keras_path if name == 'keras' else tflite_path
+        report['models'][name] = {
+            'path': path,
+            'size_mb': os.path.getsize(path) / 1e6,
+            'accuracy': float(np.mean(predictions[name] == labels)),
+            'latency_ms': {
+                str(n): time_model(model, np.repeat(sample, n, 0)) * 1000
+                for n in (1, batch_size)
+            },
+        }
+    return report
+
+
+def print_report(report):
+    print("\n{} validation images, keras/tflite agreement {:.2f}%".format(
+        report['images'], report['agreement'] * 100))
+    for name, stats in report['models'].items():
+        latency = ", ".join("batch {}: {:.1f} ms".format(n, ms)
+                            for n, ms in stats['latency_ms'].items())
+        print("  {:<7} accuracy {:.2f}%  size {:.1f} MB  {}".format(
+            name, stats['accuracy'] * 100, stats['size_mb'], latency))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='tflite_export.py',
+        description='Export the trained model to TFLite and compare it '
+                    'with the Keras model'
+    )
+    parser.add_argument('--model', default='./model/best_model.keras',
+                        help='Keras model to export '
+                             '(default: ./model/best_model.keras)')
+    parser.add_argument('-o', '--output',
+                        help='TFLite file (default: next to the model)')
+    parser.add_argument('-q', '--quantization', choices=QUANTIZATIONS,
+                        default='none',
+                        help='Post-training quantization (default: none)')
+    parser.add_argument('-data', '--data_dir', default='./images',
+                        help='Training images for calibration and the '
+                             'comparison (default: ./images)')
+    parser.add_argument('--calibration-samples', type=int, default=200,
+                        help='Images used to calibrate int8 (default: 200)')
+    parser.add_argument('--compare', action='store_true',
+                        help='Report accuracy/latency against Keras on the '
+                             'validation split')
+    parser.add_argument('--report',
+                        help='Write the comparison report as JSON here')
+    parser.add_argument('--threads', type=int,
+                        help='TFLite interpreter threads')
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.model)[0] + '.tflite'
+    validation_files = None
+    if args.quantization == 'int8' or args.compare or args.report:
+        try:
+            validation_files = read_validation_files(
+                os.path.dirname(args.model) or '.')
+            split_files(args.data_dir, validation_files)
+        except (OSError, ValueError) as e:
+            print("Error: {}".format(e))
+            exit(1)
+    export_tflite(args.model, output, args.quantization, args.data_dir,
+                  args.calibration_samples, validation_files)
+    if args.compare or args.report:
+        report = compare_models(args.model, output, args.data_dir,
+                                num_threads=args.threads)
+        report['quantization'] = args.quantization
+        print_report(report)
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
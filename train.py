@@ -1,16 +1,77 @@
 import argparse
+import json
+import math
 import os
+import time
+import numpy as np
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
-import matplotlib.pyplot as plt
-
-
-def create_model(num_classes, img_height=224, img_width=224):
+from model_bundle import (write_class_names, write_manifest,
+                          write_validation_files)
+
+BASE_BATCH_SIZE = 32
+BASE_LEARNING_RATE = 1e-3
+
+# Option values of each --preset; explicit command line flags win
+PRESETS = {
+    'default': {
+        'batch_size': 32,
+        'intra_threads': 0,
+        'inter_threads': 0,
+        'precision': 'float32',
+        'jit_compile': False,
+        'lr_schedule': 'constant',
+        'fine_tune_epochs': 0,
+        'unfreeze_blocks': 3,
+    },
+    'performance': {
+        'batch_size': 128,
+        'intra_threads': os.cpu_count(),
+        'inter_threads': 2,
+        'precision': 'auto',
+        'jit_compile': True,
+        'lr_schedule': 'cosine',
+        'fine_tune_epochs': 0,
+        'unfreeze_blocks': 3,
+    },
+}
+
+
+def bfloat16_supported():
+    """True when the CPU computes bfloat16 natively (AVX512_BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def configure_runtime(intra_threads=0, inter_threads=0, precision='float32'):
+    """Set TensorFlow thread pools and the Keras dtype policy
+
+    Must run before TensorFlow executes its first op. 0 threads keeps
+    TensorFlow's choice. precision 'auto' selects mixed_bfloat16 when the
+    CPU supports it and float32 otherwise. Returns the policy name.
+    """
+    if intra_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+    if inter_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+    if precision == 'auto':
+        precision = 'mixed_bfloat16' if bfloat16_supported() else 'float32'
+    keras.mixed_precision.set_global_policy(precision)
+    return precision
+
+
+def create_model(num_classes, img_height=224, img_width=224,
+                 weights='imagenet'):
     base_model = keras.applications.MobileNetV2(
         input_shape=(img_height, img_width, 3),
         include_top=False,
-        weights='imagenet'
+        weights=weights
     )
 
     base_model.trainable = False
@@ -21,12 +82,66 @@ def create_model(num_classes, img_height=224, img_width=224):
         layers.Dropout(0.3),
         layers.Dense(128, activation='relu'),
         layers.Dropout(0.2),
-        layers.Dense(num_classes, activation='softmax')
+        # float32 probabilities, whatever the compute policy
+        layers.Dense(num_classes, activation='softmax', dtype='float32')
     ])
     return model
 
 
+def block_number(layer_name):
+    """MobileNetV2 block of a layer: 0 for the stem, 17 for the last conv"""
+    if layer_name.startswith('block_'):
+        return int(layer_name.split('_')[1])
+    if layer_name.startswith('Conv_1') or layer_name == 'out_relu':
+        return 17
+    return 0
+
+
+def unfreeze_top_blocks(model, blocks):
+    """Make the last blocks of the backbone trainable for fine-tuning
+
+    blocks counts inverted residual blocks from the top; the final 1x1
+    convolution is unfrozen along with them. Batch normalization layers
+    stay frozen so their statistics survive the small fine-tuning updates.
+    Returns the number of trainable backbone layers.
+    """
+    base_model = model.layers[0]
+    base_model.trainable = True
+    first = 17 - blocks if blocks > 0 else 18
+    for layer in base_model.layers:
+        layer.trainable = (block_number(layer.name) >= first and
+                           not isinstance(layer,
+                                          layers.BatchNormalization))
+    return sum(1 for layer in base_model.layers if layer.trainable)
+
+
+def create_head(num_classes, feature_dim):
+    """The classification layers of create_model, fed pooled features"""
+    return keras.Sequential([
+        keras.Input(shape=(feature_dim,)),
+        layers.Dropout(0.3),
+        layers.Dense(128, activation='relu'),
+        layers.Dropout(0.2),
+        layers.Dense(num_classes, activation='softmax', dtype='float32')
+    ])
+
+
+def attach_head(head, num_classes, img_height=224, img_width=224):
+    """Build the full create_model network carrying the head's weights"""
+    model = create_model(num_classes, img_height, img_width)
+    full_dense = [la for la in model.layers
+                  if isinstance(la, layers.Dense)]
+    head_dense = [la for la in head.layers
+                  if isinstance(la, layers.Dense)]
+    for target, source in zip(full_dense, head_dense):
+        target.set_weights(source.get_weights())
+    return model
+
+
 def plot_training_history(history, output_dir):
+    import reporting
+    plt = reporting.get_pyplot()
+
     acc = history.history['accuracy']
     val_acc = history.history['val_accuracy']
     loss = history.history['loss']
@@ -54,14 +169,122 @@ def plot_training_history(history, output_dir):
 
     plt.tight_layout()
     plt.savefig(os.path.join(output_dir, 'training_history.png'))
+    plt.close()
     msg = os.path.join(output_dir, 'training_history.png')
     print("Training history plot saved to " + msg)
 
 
-def train_model(data_dir, output_dir, epochs=10,
-                img_height=224, img_width=224):
-    os.makedirs(output_dir, exist_ok=True)
+def build_augmenter(seed=None):
+    """On-graph equivalent of the ImageDataGenerator augmentation settings"""
+    return keras.Sequential([
+        layers.RandomRotation(40 / 360, fill_mode='nearest', seed=seed),
+        layers.RandomTranslation(0.3, 0.3, fill_mode='nearest', seed=seed),
+        # shear_range is an angle in degrees for ImageDataGenerator
+        layers.RandomShear(x_factor=math.tan(math.radians(0.2)),
+                           fill_mode='nearest', seed=seed),
+        layers.RandomZoom(0.3, fill_mode='nearest', seed=seed),
+        layers.RandomFlip('horizontal_and_vertical', seed=seed),
+    ], name='augmenter')
+
+
+def random_brightness(images, low=0.7, high=1.3):
+    """Scale each image by a factor in [low, high], like brightness_range"""
+    factors = tf.random.uniform([tf.shape(images)[0], 1, 1, 1], low, high)
+    return tf.clip_by_value(images * factors, 0.0, 255.0)
+
+
+def make_tf_datasets(data_dir, img_height=224, img_width=224,
+                     batch_size=32, validation_split=0.2, seed=123):
+    """Build train/validation tf.data pipelines from a class directory tree
+
+    Decoding, augmentation and preprocessing run on the graph in parallel;
+    the validation split is cached after its first pass and both splits are
+    prefetched. Returns (train_ds, val_ds, class_names).
+    """
+    train_ds, val_ds = keras.utils.image_dataset_from_directory(
+        data_dir,
+        label_mode='categorical',
+        image_size=(img_height, img_width),
+        # Nearest, as flow_from_directory and predict.py resize
+        interpolation='nearest',
+        batch_size=batch_size,
+        validation_split=validation_split,
+        subset='both',
+        seed=seed
+    )
+    class_names = train_ds.class_names
+    file_paths = val_ds.file_paths
+    train_ds, val_ds = prepare_datasets(train_ds, val_ds)
+    # Kept, as image_dataset_from_directory does, for the split record
+    val_ds.file_paths = file_paths
+    return train_ds, val_ds, class_names
+
+
+def augment_dataset(ds, img_height=None, img_width=None):
+    """Augment and preprocess batched (image, label) training data"""
+    preprocess = keras.applications.mobilenet_v2.preprocess_input
+    augmenter = build_augmenter()
+
+    def augment(images, labels):
+        images = tf.cast(images, tf.float32)
+        if img_height is not None:
+            images = tf.image.resize(images, (img_height, img_width),
+                                     method='nearest')
+        images = tf.cast(augmenter(images, training=True), tf.float32)
+        images = random_brightness(images)
+        return preprocess(images), labels
+
+    return ds.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def preprocess_dataset(ds, img_height=None, img_width=None):
+    """Preprocess batched (image, label) evaluation data"""
+    preprocess = keras.applications.mobilenet_v2.preprocess_input
 
+    def prepare(images, labels):
+        images = tf.cast(images, tf.float32)
+        if img_height is not None:
+            images = tf.image.resize(images, (img_height, img_width),
+                                     method='nearest')
+        return preprocess(images), labels
+
+    return ds.map(prepare, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def prepare_datasets(train_ds, val_ds, img_height=None, img_width=None):
+    """Augment, preprocess, cache and prefetch batched (image, label) data"""
+    autotune = tf.data.AUTOTUNE
+    train_ds = (augment_dataset(train_ds, img_height, img_width)
+                .prefetch(autotune))
+    val_ds = (preprocess_dataset(val_ds, img_height, img_width)
+              .cache()
+              .prefetch(autotune))
+    return train_ds, val_ds
+
+
+def make_shard_datasets(shard_dir, img_height=224, img_width=224,
+                        batch_size=32, validation_split=0.2, seed=123):
+    """tf.data pipelines over a directory packed by shards.py"""
+    from shards import ShardDataset
+
+    dataset = ShardDataset(shard_dir)
+    dataset.check_resize()
+    print("Found {} packed images belonging to {} classes.".format(
+        len(dataset), len(dataset.class_names)))
+    train_idx, val_idx = dataset.split(validation_split, seed)
+    train_ds = dataset.as_tf_dataset(train_idx, batch_size, shuffle=True,
+                                     seed=seed)
+    val_ds = dataset.as_tf_dataset(val_idx, batch_size)
+    if dataset.size == img_height == img_width:
+        img_height = img_width = None
+    train_ds, val_ds = prepare_datasets(train_ds, val_ds,
+                                        img_height, img_width)
+    return train_ds, val_ds, dataset.class_names
+
+
+def make_generators(data_dir, img_height=224, img_width=224,
+                    batch_size=32):
+    """Legacy ImageDataGenerator pipeline, returns (train, val, class_names)"""
     preprocess = keras.applications.mobilenet_v2.preprocess_input
     train_datagen = ImageDataGenerator(
         preprocessing_function=preprocess,
@@ -85,7 +308,7 @@ def train_model(data_dir, output_dir, epochs=10,
     train_generator = train_datagen.flow_from_directory(
         data_dir,
         target_size=(img_height, img_width),
-        batch_size=32,
+        batch_size=batch_size,
         class_mode='categorical',
         subset='training'
     )
@@ -93,28 +316,118 @@ def train_model(data_dir, output_dir, epochs=10,
     validation_generator = val_datagen.flow_from_directory(
         data_dir,
         target_size=(img_height, img_width),
-        batch_size=32,
+        batch_size=batch_size,
         class_mode='categorical',
         subset='validation'
     )
 
-    num_classes = len(train_generator.class_indices)
+    items = train_generator.class_indices.items()
+    class_names = [name for name, _ in sorted(items, key=lambda x: x[1])]
+    return train_generator, validation_generator, class_names
+
+
+def steps_per_epoch(data):
+    """Batches per epoch of a generator or a tf.data dataset"""
+    if isinstance(data, tf.data.Dataset):
+        return int(data.cardinality())
+    return len(data)
+
+
+def learning_rate(batch_size, steps, epochs, schedule='constant',
+                  base_rate=BASE_LEARNING_RATE, warmup_epochs=1):
+    """Learning rate, or schedule, matched to the batch size
+
+    'constant' keeps base_rate. 'cosine' scales it linearly with
+    batch_size / 32, warms up to it over warmup_epochs and decays it to
+    zero along a cosine by the last step.
+    """
+    if schedule == 'constant':
+        return base_rate
+    peak = base_rate * batch_size / BASE_BATCH_SIZE
+    total = steps * epochs
+    warmup = min(steps * warmup_epochs, total // 2)
+    return keras.optimizers.schedules.CosineDecay(
+        0.0 if warmup else peak, max(1, total - warmup),
+        warmup_target=peak if warmup else None, warmup_steps=warmup)
+
+
+class StepsPerSecond(keras.callbacks.Callback):
+    """Report training throughput at the end of every epoch
+
+    With a batch_size, examples/sec is also added to the epoch logs so
+    the History and the CSV log record it.
+    """
+
+    def __init__(self, batch_size=None):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = self.last = time.perf_counter()
+        self.steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        self.last = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Validation runs before this hook, so time up to the last step
+        elapsed = self.last - self.start
+        rate = self.steps / elapsed if elapsed else 0.0
+        if self.batch_size is None:
+            print("Epoch {}: {:.2f} steps/sec".format(epoch + 1, rate))
+            return
+        if logs is not None:
+            logs['examples_per_sec'] = rate * self.batch_size
+        print("Epoch {}: {:.2f} steps/sec, {:.1f} examples/sec".format(
+            epoch + 1, rate, rate * self.batch_size))
+
+
+def train_model(data_dir, output_dir, epochs=10,
+                img_height=224, img_width=224, loader='generator',
+                batch_size=32, lr_schedule='constant', jit_compile=False,
+                fine_tune_epochs=0, unfreeze_blocks=3):
+    """Train the head over the frozen backbone, then optionally fine-tune
+
+    With fine_tune_epochs, a second stage unfreezes the top
+    unfreeze_blocks backbone blocks and trains at a tenth of the rate.
+    Per-epoch metrics and examples/sec go to training_log.csv and a
+    summary of the run to training_profile.json.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    if os.path.isfile(os.path.join(data_dir, 'index.json')):
+        train_generator, validation_generator, class_names = \
+            make_shard_datasets(data_dir, img_height, img_width, batch_size)
+    elif loader == 'tfdata':
+        train_generator, validation_generator, class_names = \
+            make_tf_datasets(data_dir, img_height, img_width, batch_size)
+    else:
+        train_generator, validation_generator, class_names = \
+            make_generators(data_dir, img_height, img_width, batch_size)
+
+    num_classes = len(class_names)
     print("\nFound {} classes:".format(num_classes))
-    for class_name, class_idx in train_generator.class_indices.items():
+    for class_idx, class_name in enumerate(class_names):
         print("  {}: {}".format(class_idx, class_name))
 
-    class_names_path = os.path.join(output_dir, 'class_names.txt')
-    with open(class_names_path, 'w') as f:
-        items = train_generator.class_indices.items()
-        for class_name, class_idx in sorted(items, key=lambda x: x[1]):
-            f.write("{}\n".format(class_name))
+    write_class_names(output_dir, class_names)
+    # filepaths of a DirectoryIterator, file_paths of a tf.data split,
+    # neither for packed shards
+    write_validation_files(
+        output_dir, data_dir,
+        getattr(validation_generator, 'filepaths', None) or
+        getattr(validation_generator, 'file_paths', None))
 
     model = create_model(num_classes, img_height, img_width)
 
+    steps = steps_per_epoch(train_generator)
     model.compile(
-        optimizer='adam',
+        optimizer=keras.optimizers.Adam(
+            learning_rate(batch_size, steps, epochs, lr_schedule)),
         loss='categorical_crossentropy',
-        metrics=['accuracy']
+        metrics=['accuracy'],
+        jit_compile=jit_compile
     )
 
     class StopAt90Percent(keras.callbacks.Callback):
@@ -138,17 +451,47 @@ def train_model(data_dir, output_dir, epochs=10,
             verbose=0
         ),
         # StopAt90Percent()
+        StepsPerSecond(batch_size)
     ]
+    log_path = os.path.join(output_dir, 'training_log.csv')
+    if os.path.exists(log_path):
+        os.remove(log_path)
 
     print("\nStarting training...")
     history = model.fit(
         train_generator,
         validation_data=validation_generator,
         epochs=epochs,
-        callbacks=callbacks,
+        callbacks=callbacks + [keras.callbacks.CSVLogger(log_path,
+                                                         append=True)],
         verbose=1
     )
 
+    if fine_tune_epochs:
+        trainable = unfreeze_top_blocks(model, unfreeze_blocks)
+        print("\nFine-tuning the top {} blocks ({} backbone layers)..."
+              .format(unfreeze_blocks, trainable))
+        model.compile(
+            optimizer=keras.optimizers.Adam(learning_rate(
+                batch_size, steps, fine_tune_epochs, lr_schedule,
+                BASE_LEARNING_RATE / 10)),
+            loss='categorical_crossentropy',
+            metrics=['accuracy'],
+            jit_compile=jit_compile
+        )
+        done = len(history.epoch)
+        fine_tune = model.fit(
+            train_generator,
+            validation_data=validation_generator,
+            initial_epoch=done,
+            epochs=done + fine_tune_epochs,
+            callbacks=callbacks + [keras.callbacks.CSVLogger(log_path,
+                                                             append=True)],
+            verbose=1
+        )
+        for key, values in fine_tune.history.items():
+            history.history.setdefault(key, []).extend(values)
+
     final_model_path = os.path.join(output_dir, 'final_model.keras')
     model.save(final_model_path)
 
@@ -157,13 +500,128 @@ def train_model(data_dir, output_dir, epochs=10,
     val_loss, val_accuracy = model.evaluate(
         validation_generator, verbose=0
     )
+    write_manifest(output_dir, class_names,
+                   ('best_model.keras', 'final_model.keras'), img_height,
+                   img_width, data_dir, (1, batch_size))
     print("\nTraining complete!")
     print("Final accuracy: {:.2f}%".format(val_accuracy*100))
     print("Models saved to {}/".format(output_dir))
 
+    rates = history.history.get('examples_per_sec', [])
+    profile = {
+        'batch_size': batch_size,
+        'precision': keras.mixed_precision.global_policy().name,
+        'intra_threads':
+            tf.config.threading.get_intra_op_parallelism_threads(),
+        'inter_threads':
+            tf.config.threading.get_inter_op_parallelism_threads(),
+        'jit_compile': jit_compile,
+        'lr_schedule': lr_schedule,
+        'epochs': epochs,
+        'fine_tune_epochs': fine_tune_epochs,
+        'unfreeze_blocks': unfreeze_blocks if fine_tune_epochs else 0,
+        'examples_per_sec': rates,
+        'best_val_accuracy': max(history.history['val_accuracy']),
+        'final_val_accuracy': val_accuracy,
+    }
+    with open(os.path.join(output_dir, 'training_profile.json'), 'w') as f:
+        json.dump(profile, f, indent=2)
+
     return model, history
 
 
+def train_on_cached_features(data_dir, output_dir, cache_dir, epochs=10,
+                             img_height=224, img_width=224, batch_size=32,
+                             validation_split=0.2, seed=123):
+    """Train only the head on backbone features computed once and cached
+
+    Images are not augmented in this mode: each image contributes one
+    fixed feature vector. The saved models are full networks usable by
+    predict.py.
+    """
+    from feature_cache import (FeatureStore, list_images,
+                               preprocessing_signature)
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths, labels, class_names = list_images(data_dir)
+    if not paths:
+        raise ValueError("No images found in {}".format(data_dir))
+    num_classes = len(class_names)
+    print("\nFound {} images in {} classes:".format(len(paths), num_classes))
+    for class_idx, class_name in enumerate(class_names):
+        print("  {}: {}".format(class_idx, class_name))
+    write_class_names(output_dir, class_names)
+
+    store = FeatureStore(cache_dir,
+                         preprocessing_signature(img_height, img_width))
+    features = store.get_or_compute(paths)
+
+    order = np.random.default_rng(seed).permutation(len(paths))
+    num_val = int(len(paths) * validation_split)
+    val_idx, train_idx = np.sort(order[:num_val]), np.sort(order[num_val:])
+    write_validation_files(output_dir, data_dir,
+                           [paths[i] for i in val_idx])
+    y = keras.utils.to_categorical(labels, num_classes)
+    x_train, y_train = features[train_idx], y[train_idx]
+    x_val, y_val = features[val_idx], y[val_idx]
+
+    head = create_head(num_classes, features.shape[1])
+    head.compile(
+        optimizer='adam',
+        loss='categorical_crossentropy',
+        metrics=['accuracy']
+    )
+    best_weights = os.path.join(output_dir, 'best_head.weights.h5')
+    callbacks = [
+        keras.callbacks.ModelCheckpoint(
+            best_weights,
+            save_best_only=True,
+            save_weights_only=True,
+            monitor='val_accuracy',
+            mode='max',
+            verbose=0
+        ),
+        keras.callbacks.EarlyStopping(
+            monitor='val_loss',
+            patience=15,
+            restore_best_weights=True,
+            verbose=0
+        ),
+        StepsPerSecond()
+    ]
+
+    print("\nStarting head training on cached features...")
+    history = head.fit(
+        x_train, y_train,
+        validation_data=(x_val, y_val),
+        batch_size=batch_size,
+        epochs=epochs,
+        shuffle=True,
+        callbacks=callbacks,
+        verbose=1
+    )
+
+    model = attach_head(head, num_classes, img_height, img_width)
+    model.save(os.path.join(output_dir, 'final_model.keras'))
+    head.load_weights(best_weights)
+    best_model = attach_head(head, num_classes, img_height, img_width)
+    best_model.save(os.path.join(output_dir, 'best_model.keras'))
+    os.remove(best_weights)
+
+    plot_training_history(history, output_dir)
+
+    write_manifest(output_dir, class_names,
+                   ('best_model.keras', 'final_model.keras'), img_height,
+                   img_width, data_dir, (1, batch_size))
+
+    val_loss, val_accuracy = head.evaluate(x_val, y_val, verbose=0)
+    print("\nTraining complete!")
+    print("Best validation accuracy: {:.2f}%".format(val_accuracy*100))
+    print("Models saved to {}/".format(output_dir))
+
+    return best_model, history
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog='train.py',
@@ -174,8 +632,8 @@ if __name__ == "__main__":
         '-data',
         '--data_dir',
         default='./images',
-        help='Directory containing subdirectories of images '
-             '(default: ./images)'
+        help='Directory containing subdirectories of images, or a shard '
+             'directory packed by shards.py (default: ./images)'
     )
     parser.add_argument(
         '-out',
@@ -184,9 +642,143 @@ if __name__ == "__main__":
         help='Directory to save the trained model (default: ./model)'
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '--loader',
+        choices=['generator', 'tfdata'],
+        default='generator',
+        help='Input pipeline: legacy ImageDataGenerator or parallel '
+             'tf.data (default: generator)'
+    )
+    parser.add_argument(
+        '--preset',
+        choices=sorted(PRESETS),
+        default='default',
+        help='Starting values for the options below: default, or '
+             'performance for bfloat16, XLA, all CPU threads and batches '
+             'of 128 with a scaled cosine learning rate'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='Training batch size (default: 32, performance: 128)'
+    )
+    parser.add_argument(
+        '--intra-threads',
+        type=int,
+        help='Threads used inside one op, 0 for TensorFlow\'s choice '
+             '(default: 0, performance: all CPUs)'
+    )
+    parser.add_argument(
+        '--inter-threads',
+        type=int,
+        help='Ops run concurrently, 0 for TensorFlow\'s choice '
+             '(default: 0, performance: 2)'
+    )
+    parser.add_argument(
+        '--precision',
+        choices=['float32', 'mixed_bfloat16', 'auto'],
+        help='Compute dtype policy; auto uses mixed_bfloat16 when the '
+             'CPU supports it (default: float32, performance: auto)'
+    )
+    parser.add_argument(
+        '--jit-compile',
+        action=argparse.BooleanOptionalAction,
+        help='Compile training steps with XLA (default: off, '
+             'performance: on)'
+    )
+    parser.add_argument(
+        '--lr-schedule',
+        choices=['constant', 'cosine'],
+        help='constant 1e-3, or 1e-3 * batch_size / 32 with one warm-up '
+             'epoch and cosine decay (default: constant, '
+             'performance: cosine)'
+    )
+    parser.add_argument(
+        '--fine-tune-epochs',
+        type=int,
+        help='Epochs of a second stage training the top backbone blocks '
+             '(default: 0, no fine-tuning)'
+    )
+    parser.add_argument(
+        '--unfreeze-blocks',
+        type=int,
+        help='Backbone blocks to unfreeze for fine-tuning, out of 16 '
+             '(default: 3)'
+    )
 
-    train_model(
-        args.data_dir,
-        args.output_dir
+    parser.add_argument(
+        '--epochs',
+        type=int,
+        default=10,
+        help='Number of training epochs (default: 10)'
+    )
+    parser.add_argument(
+        '--export-tflite',
+        choices=['none', 'float16', 'int8'],
+        help='After training, also write best_model.tflite with this '
+             'post-training quantization'
     )
+    parser.add_argument(
+        '--feature-cache',
+        metavar='DIR',
+        help='Train only the classification head on MobileNetV2 '
+             'features cached in DIR (computed on first use)'
+    )
+
+    args = parser.parse_args()
+    if (args.export_tflite == 'int8' and
+            os.path.isfile(os.path.join(args.data_dir, 'index.json'))):
+        parser.error("--export-tflite int8 calibrates on image files, "
+                     "not a shard directory")
+
+    # Refuse unusable data before the runtime is set up and a model built
+    from shards import ShardDataset, is_shard_dir
+    if is_shard_dir(args.data_dir):
+        try:
+            ShardDataset(args.data_dir).check_resize()
+        except ValueError as e:
+            print("Error: {}".format(e))
+            exit(1)
+    elif args.feature_cache:
+        from feature_cache import list_images
+        if not list_images(args.data_dir)[0]:
+            print("Error: No images found in {}".format(args.data_dir))
+            exit(1)
+
+    options = dict(PRESETS[args.preset])
+    options.update((key, value) for key, value in vars(args).items()
+                   if key in options and value is not None)
+    policy = configure_runtime(options['intra_threads'],
+                               options['inter_threads'],
+                               options['precision'])
+    print("Precision policy: {}".format(policy))
+
+    if args.feature_cache:
+        train_on_cached_features(
+            args.data_dir,
+            args.output_dir,
+            args.feature_cache,
+            epochs=args.epochs,
+            batch_size=options['batch_size']
+        )
+    else:
+        train_model(
+            args.data_dir,
+            args.output_dir,
+            epochs=args.epochs,
+            loader=args.loader,
+            batch_size=options['batch_size'],
+            lr_schedule=options['lr_schedule'],
+            jit_compile=options['jit_compile'],
+            fine_tune_epochs=options['fine_tune_epochs'],
+            unfreeze_blocks=options['unfreeze_blocks']
+        )
+
+    if args.export_tflite:
+        from tflite_export import export_tflite
+        export_tflite(
+            os.path.join(args.output_dir, 'best_model.keras'),
+            os.path.join(args.output_dir, 'best_model.tflite'),
+            args.export_tflite,
+            args.data_dir
+        )
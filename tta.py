@@ -0,0 +1,123 @@
+import numpy as np
+
+CROP_FRACTION = 0.875
+
+
+def flip_lr(images):
+    return images[:, :, ::-1]
+
+
+def flip_ud(images):
+    return images[:, ::-1]
+
+
+def center_crop(images, fraction=CROP_FRACTION):
+    """Central crop of each image, resized back with nearest neighbour
+
+    Nearest, as predict.py resizes what it serves, so the crop views are
+    no smoother than the pictures the models were trained on.
+    """
+    import tensorflow as tf
+
+    h, w = images.shape[1:3]
+    dh, dw = round(h * (1 - fraction) / 2), round(w * (1 - fraction) / 2)
+    return tf.image.resize(images[:, dh:h - dh, dw:w - dw], (h, w),
+                           method="nearest").numpy()
+
+
+# (name, on the center crop, transform), in the order views are added
+VIEWS = [
+    ("identity", False, lambda x: x),
+    ("flip_lr", False, flip_lr),
+    ("flip_ud", False, flip_ud),
+    ("rot90", False, lambda x: np.rot90(x, 1, axes=(1, 2))),
+    ("rot180", False, lambda x: np.rot90(x, 2, axes=(1, 2))),
+    ("rot270", False, lambda x: np.rot90(x, 3, axes=(1, 2))),
+    ("crop", True, lambda x: x),
+    ("crop_flip_lr", True, flip_lr),
+]
+
+
+def make_views(images, count):
+    """Stack the first count views of every image, image by image
+
+    images is an (N, H, W, 3) batch of square, preprocessed images; the
+    result is (N * count, H, W, 3) with the views of image i at rows
+    i * count to (i + 1) * count - 1.
+    """
+    if not 1 <= count <= len(VIEWS):
+        raise ValueError("views must be between 1 and {}".format(len(VIEWS)))
+    images = np.asarray(images)
+    if count == 1:
+        return images
+    if images.shape[1] != images.shape[2]:
+        raise ValueError("test-time augmentation needs square images")
+    out = np.empty((len(images), count) + images.shape[1:], images.dtype)
+    cropped = None
+    for i, (_, on_crop, transform) in enumerate(VIEWS[:count]):
+        source = images
+        if on_crop:
+            if cropped is None:
+                cropped = center_crop(images)
+            source = cropped
+        out[:, i] = transform(source)
+    return out.reshape((-1,) + images.shape[1:])
+
+
+class TTAEnsemble:
+    """Several models averaged over several views, behind predict_on_batch
+
+    It stands in for a single model anywhere predict.py takes one. Each
+    batch is expanded to all its views once and every model scores the
+    expanded batch in a single forward pass; probabilities are averaged
+    over views, then over models.
+    """
+
+    def __init__(self, models, views=1):
+        if not 1 <= views <= len(VIEWS):
+            raise ValueError("views must be between 1 and {}".format(
+                len(VIEWS)))
+        self.models = list(models)
+        self.views = views
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch)
+        expanded = make_views(batch, self.views)
+        total = 0
+        for model in self.models:
+            probs = np.asarray(model.predict_on_batch(expanded))
+            total = total + probs.reshape(len(batch), self.views,
+                                          -1).mean(axis=1)
+        return total / len(self.models)
+
+
+def latency_report(models, batch, view_counts=(1, 2, 4, 8), repeats=5):
+    """Latency of every view count, with and without the whole ensemble
+
+    Returns one dict per (models, views) setting with the median ms per
+    batch and per image, the cost relative to a single plain pass and the
+    share of images whose top class differs from that pass.
+    """
+    from benchmark import time_model
+
+    batch = np.asarray(batch)
+    settings = [(models[:1], n) for n in view_counts]
+    if len(models) > 1:
+        settings += [(models, n) for n in view_counts]
+    reference = None
+    rows = []
+    for subset, views in settings:
+        model = TTAEnsemble(subset, views)
+        seconds = time_model(model, batch, repeats)
+        top = np.argmax(model.predict_on_batch(batch), axis=-1)
+        if reference is None:
+            reference, base = top, seconds
+        rows.append({
+            "models": len(subset),
+            "views": views,
+            "ms_per_batch": seconds * 1000,
+            "ms_per_image": seconds * 1000 / len(batch),
+            "relative_cost": seconds / base if base else 0.0,
+            "changed": float(np.mean(top != reference)),
+        })
+    return rows